@@ -1,13 +1,21 @@
 import asyncio
 import sys
 import logging
-import os
-import pandas as pd
 from pymodbus.exceptions import ConnectionException, ModbusException
-from pymodbus.client import AsyncModbusTcpClient
 import time
-from openpyxl import Workbook, load_workbook
-from datetime import datetime
+from address_map import REGISTER_KINDS, get_address_map
+from config_cache import kind_plan
+from live_table import LiveTableWriter
+from metrics import PlcMetrics, registry
+from pipeline import (DEFAULT_CONNECTIONS, DEFAULT_MAX_IN_FLIGHT, DEFAULT_UNIT_ID,
+                      PipelinedModbusClient)
+from connection import Backoff, ConnectionHealth
+from scheduler import PollScheduler
+from frame import SampleFrame
+from points import BitDecoder, PointDecoder
+from rate_control import RateController
+from read_plan import gap_points
+from write_behind import get_write_queue
 
 
 
@@ -29,287 +37,387 @@ logging.getLogger("pymodbus").setLevel(logging.WARNING)
 # Configuration paths
 SAVED_ADDRESS_FILE_PATH = "config/saveAddress.xlsx"
 SELECTED_PLC_FILE = "config/selectedPlc.txt"
-sampling_frequency = 1000
+DEFAULT_SAMPLING_FREQUENCY = 1000  # ms
+STATS_LOG_INTERVAL = 60  # seconds between scheduler statistics log lines
+DEBUG_SAMPLE_INTERVAL = 10  # seconds between per-cycle value dumps at DEBUG level
+# Exception codes of a gateway that cannot reach the unit: path unavailable, target failed to respond
+GATEWAY_EXCEPTIONS = (0x0A, 0x0B)
+LOGGED_BLOCKS = 3  # failing blocks listed in one log line
+
+# Register type -> (address sheet kind, client read method)
+READ_FUNCTIONS = {
+    "coil_states": ("Coils", "read_coils"),
+    "input_status_states": ("Input Bits", "read_discrete_inputs"),
+    "input_register_states": ("Analog Inputs", "read_input_registers"),
+    "holding_register_states": ("Holding Registers", "read_holding_registers"),
+}
 
 # Initialize plc_state dictionary
 plc_state = {}
+# Polling schedule (and its jitter statistics) per PLC
+plc_schedules = {}
 
 
-def get_modbus_addresses_with_check(sheet_name):
-    """Read Modbus addresses from Excel sheet."""
-    try:
-        df = pd.read_excel(SAVED_ADDRESS_FILE_PATH, sheet_name=sheet_name)
-    except Exception as e:
-        logger.error(f"Error reading Excel file: {e}")
-        return {"Coils": [], "Input Bits": [], "Analog Inputs": []}
+def _collect_metrics(registry):
+    connected = registry.gauge("connected", "1 while reads from the PLC succeed", ("plc",))
+    failures = registry.gauge("consecutive_failures", "Failed cycles or probes in a row", ("plc",))
+    states = {str(plc_id): state for plc_id, state in list(plc_state.items())}
+    for family in (connected, failures):
+        # PLCs whose loop has ended
+        for (plc,) in [values for values in family.children if values[0] not in states]:
+            family.remove(plc)
+    for plc, state in states.items():
+        connected.child(plc).set(1 if state["connected"] else 0)
+        failures.child(plc).set(state["consecutive_failures"])
 
-    if df.empty:
-        logger.warning(f"Sheet '{sheet_name}' is empty")
-        return {"Coils": [], "Input Bits": [], "Analog Inputs": []}
 
-    # Extract and adjust addresses
-    coils = df['MODBUS ADDRESS (Coils)'].dropna().astype(int).tolist()
-    input_bits = [addr - 10000 for addr in
-                  df['MODBUS ADDRESS (Input Bits)'].dropna().astype(int).tolist()]
-    analog_inputs = [addr - 30000 for addr in
-                     df['MODBUS ADDRESS (Analog Inputs)'].dropna().astype(int).tolist()]
+registry.add_collector(_collect_metrics)
 
-    return {
-        "Coils": coils,
-        "Input Bits": input_bits,
-        "Analog Inputs": analog_inputs
-    }
+
+def get_modbus_addresses_with_check(sheet_name):
+    """Read Modbus addresses for a PLC sheet (cached until the workbook changes)."""
+    return get_address_map(sheet_name, SAVED_ADDRESS_FILE_PATH).as_dict()
 
 
 def get_coils(sheet_name):
     """Get coil addresses for selected PLC."""
-    logger.info(f"COILS: {get_modbus_addresses_with_check(sheet_name)["Coils"]}")
-    return get_modbus_addresses_with_check(sheet_name)["Coils"]
+    coils = get_address_map(sheet_name, SAVED_ADDRESS_FILE_PATH)["Coils"]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"COILS: {coils.tolist()}")
+    return coils
 
 
 def get_input_bits(sheet_name):
     """Get input bit addresses for selected PLC."""
-    logger.info(f"INPUT BITS: {get_modbus_addresses_with_check(sheet_name)["Input Bits"]}")
-    return get_modbus_addresses_with_check(sheet_name)["Input Bits"]
+    input_bits = get_address_map(sheet_name, SAVED_ADDRESS_FILE_PATH)["Input Bits"]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"INPUT BITS: {input_bits.tolist()}")
+    return input_bits
 
 
 def get_inputs_register(sheet_name):
     """Get input register addresses for selected PLC."""
-    logger.info(f"INPUT REGISTERS: {get_modbus_addresses_with_check(sheet_name)["Analog Inputs"]}")
-    return get_modbus_addresses_with_check(sheet_name)["Analog Inputs"]
+    registers = get_address_map(sheet_name, SAVED_ADDRESS_FILE_PATH)["Analog Inputs"]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"INPUT REGISTERS: {registers.tolist()}")
+    return registers
 
 
-def show_popup_and_wait(message):
-    """Handle connection failures with user input."""
-    logger.info(message)
-    response = input("Retry? (y/n): ").strip().lower()
-    return response == 'y'
+def get_holding_registers(sheet_name):
+    """Get holding register addresses for selected PLC."""
+    registers = get_address_map(sheet_name, SAVED_ADDRESS_FILE_PATH)["Holding Registers"]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"HOLDING REGISTERS: {registers.tolist()}")
+    return registers
 
 
-async def check_connection(client, plc_id, retry_interval=5):
-    """Verify Modbus connection with retry logic."""
-    try:
-        logger.info("Checking connection...")
-        connection_ok = False
-
-        # Try reading different register types
-        for read_func, addresses in [
-            (client.read_coils, get_coils(plc_id)),
-            (client.read_discrete_inputs, get_input_bits(plc_id)),
-            (client.read_input_registers, get_inputs_register(plc_id))
-        ]:
-            if addresses:
-                logger.info(f"Check Connection: Addresses: {addresses}")
-                # getLength =  addresses
-                response = await read_func(address=0, count=len(addresses))
-                if not response.isError():
-                    connection_ok = True
-                    break
-
-        plc_state[plc_id] = {"connected": connection_ok}
-        logger.info(f"PLC {plc_id} connected: {connection_ok}")
-        return connection_ok
+async def check_connection(client, plc_id, plans):
+    """
+    Probe the connection by reading the first configured block of each
+    register type until the PLC answers.  Any answer proves the link, a
+    Modbus exception response included (a block the PLC does not have is a
+    configuration problem), except a gateway's report that the unit behind
+    it did not respond.
+    """
+    probed = False
+    for register_type, (_, read_method) in READ_FUNCTIONS.items():
+        read_func = getattr(client, read_method)
+        blocks = plans[register_type].blocks
+        if not blocks:
+            continue
+        probed = True
+        try:
+            response = await read_func(address=blocks[0].start - 1, count=blocks[0].count)
+        except Exception as e:
+            # No answer at all; the other register types would not fare better
+            logger.error(f"Connection error: {e}")
+            break
+        if not response.isError():
+            logger.info(f"PLC {plc_id} connected: True")
+            return True
+        exception_code = getattr(response, "exception_code", None)
+        if exception_code not in GATEWAY_EXCEPTIONS:
+            logger.warning(f"PLC {plc_id} connected, but block {blocks[0].start}+{blocks[0].count} "
+                           f"of {register_type} answers with exception {exception_code}")
+            return True
+    if probed:
+        logger.info(f"PLC {plc_id} connected: False")
+        return False
+
+    # Nothing configured to read; an open socket is all we can check
+    return client.connected
+
+async def append_to_excel(frame, register_types):
+    """Queue the given register types of a SampleFrame for the storage writer."""
+    queue = get_write_queue()
+    for register_type in register_types:
+        queue.put(frame.plc_id, register_type, frame.timestamp, frame.values[register_type],
+                  frame.addresses[register_type])
+
+
+def _block_range(block):
+    return f"{block.start}-{block.start + block.count - 1}"
+
+
+async def read_registers(client, read_func, decoder, out, schedule=None, name="registers"):
+    """
+    Generic register reading function driven by a decoder's compiled read plan.
+    Each block of the plan is one Modbus request; all of them are issued at
+    once and the client keeps as many in flight as the PLC allows.  The raw
+    responses are copied into the decoder's buffer and decoded into ``out``
+    in place.  Works for coils, discrete inputs, input and holding registers.
+    With a BlockSchedule (see rate_control.py) only the blocks due this cycle
+    are read, and how each fared is recorded on it.  Blocks not read, or
+    whose read failed, hold their previous values.  A block that starts or
+    stops failing is logged, by ``name`` and its address range.  Returns
+    the number of failed requests.
+    """
+    blocks = decoder.plan.blocks
+    indices = schedule.due() if schedule is not None else range(len(blocks))
+    if not indices:
+        return 0
+    responses = await asyncio.gather(
+        # Adjust for zero-based addressing
+        *(read_func(address=blocks[i].start - 1, count=blocks[i].count) for i in indices),
+        return_exceptions=True)
+
+    previous = [decoder.errors[i] for i in indices]
+    errors = decoder.fill(responses, indices)
+    if schedule is not None:
+        schedule.record(indices, responses, errors)
+    failed = len(errors) - errors.count(None)
+    if failed < len(indices):
+        decoder.decode_into(out)
+    # Log blocks once when they start or stop failing, not every cycle they fail
+    failing = [f"{_block_range(blocks[i])}: {error}"
+               for i, error, was in zip(indices, errors, previous) if error is not None and was is None]
+    if failing:
+        logger.error(f"Reading {name} failed for {len(failing)} block(s), whose points hold "
+                     f"their last values: {'; '.join(failing[:LOGGED_BLOCKS])}"
+                     f"{' ...' if len(failing) > LOGGED_BLOCKS else ''}")
+    recovered = [_block_range(blocks[i])
+                 for i, error, was in zip(indices, errors, previous) if error is None and was is not None]
+    if recovered:
+        logger.info(f"Reading {name} succeeds again for {', '.join(recovered[:LOGGED_BLOCKS])}"
+                    f"{' ...' if len(recovered) > LOGGED_BLOCKS else ''}")
+    return failed
+
+
+def compile_plans(plc_id, address_map, gap_threshold=None):
+    """
+    Compile read plans for a PLC's coils, discrete inputs, input and holding
+    registers.  Returns (plans, decoders): a BitDecoder per bit type and a
+    PointDecoder per register type, whose plan covers every register of its
+    typed points.
+    """
+    plans = {}
+    decoders = {}
+    for register_type, (kind, _) in READ_FUNCTIONS.items():
+        # Precompiled in the configuration cache unless the threshold is new
+        plans[register_type] = kind_plan(address_map, kind, gap_threshold)
+        if kind in REGISTER_KINDS:
+            decoders[register_type] = PointDecoder(address_map.points[kind], plans[register_type])
+        else:
+            decoders[register_type] = BitDecoder(address_map[kind], plans[register_type])
+    naive = sum(plan.naive_requests for plan in plans.values())
+    merged = sum(plan.requests for plan in plans.values())
+    logger.info(f"PLC {plc_id} read plan: {naive} -> {merged} requests per cycle "
+                f"(gap threshold {gap_points(gap_threshold)} registers)")
+    return plans, decoders
 
-    except Exception as e:
-        logger.error(f"Connection error: {e}")
-        plc_state[plc_id] = {"connected": False}
-
-        if not show_popup_and_wait(f"Connection failed: {e}"):
-            logger.info("Connection attempts cancelled")
-            exit(0)
-
-        time.sleep(retry_interval)
-        logger.info("Retrying connection...")
-        return check_connection(client, plc_id, retry_interval)
-
-async def append_to_excel(data):
-    """Append Modbus data to separate Excel files based on PLC ID and register type."""
-    logger.info(f"EXCEL DATA: {data}")
-    plc_id = data["plc_id"]
-    coil_states = data["coil_states"]
-    input_status_states = data["input_status_states"]
-    input_register_states = data["input_register_states"]
-
-    # Create folder based on PLC ID if it doesn't exist
-    folder_path = os.path.join("modbus_data", plc_id)
-    os.makedirs(folder_path, exist_ok=True)
-
-    # Define file paths for each register type
-    coil_file = os.path.join(folder_path, "coil_states.xlsx")
-    input_status_file = os.path.join(folder_path, "input_status_states.xlsx")
-    input_register_file = os.path.join(folder_path, "input_register_states.xlsx")
-
-    # Append data to each file asynchronously
-    await asyncio.gather(
-        _append_register_data(coil_file, "Coil States", coil_states),
-        _append_register_data(input_status_file, "Input Status States", input_status_states),
-        _append_register_data(input_register_file, "Input Register States", input_register_states, is_input_register=True)
-    )
-
-async def _append_register_data(file_path, sheet_name, data, is_input_register=False):
-    """Helper function to append data to a specific Excel file."""
-    if not data:  # Skip if data is empty
-        logger.info(f"No data to append for {sheet_name}")
-        return
 
-    try:
-        # Load or create the workbook
-        if os.path.exists(file_path):
-            wb = load_workbook(file_path)
-            ws = wb.active
-        else:
-            wb = Workbook()
-            ws = wb.active
-            ws.title = sheet_name
-            # Create headers
-            addresses = [f"{addr:05}" for addr in sorted(data.keys())]
-            ws.append(["Date", "Time"] + addresses)
-
-        # Append data
-        timestamp = datetime.now()
-        date = timestamp.strftime("%Y-%m-%d")
-        time = timestamp.strftime("%H:%M:%S")
-
-
-        # For input registers and coil states, append values in order of addresses
-        values = [data[addr] for addr in sorted(data.keys())]
-        ws.append([date, time] + values)
-        # Save the workbook
-        wb.save(file_path)
-        logger.info(f"Data appended to {file_path}")
+def read_priorities(address_map):
+    """Priorities of the addresses a PLC's read plans cover, by register type."""
+    return {register_type: address_map.read_priorities(kind)
+            for register_type, (kind, _) in READ_FUNCTIONS.items()}
 
-    except Exception as e:
-        logger.error(f"Error appending data to {file_path}: {e}")
 
-async def read_registers(client, read_func, addresses, max_count=2000):
+def sampling_interval(sampling_frequency):
+    """Poll period in seconds for a "Sampling Frequency" in milliseconds."""
+    if not sampling_frequency or sampling_frequency <= 0:
+        sampling_frequency = DEFAULT_SAMPLING_FREQUENCY
+    return sampling_frequency / 1000
+
+
+class PollerControl:
     """
-    Generic register reading function with address grouping.
-    Handles non-sequential addresses by splitting them into sequential ranges.
-    Works for coils, discrete inputs, and input registers.
+    Settings for a running client loop, handed over by the config watcher and
+    applied between two cycles, so no cycle mixes old and new read plans.
+    Keys: sampling_frequency, address_map, gap_threshold, change_filter.
     """
-    results = {}
+
+    def __init__(self):
+        self.pending = {}
+
+    def update(self, **settings):
+        self.pending.update(settings)
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+
+def open_live_table_writer(plc_id, frame):
+    """Create the shared-memory live value table for a PLC (None if unavailable)."""
     try:
-        sorted_addrs = sorted(addresses)
-        start = sorted_addrs[0]
-        prev_addr = start
-
-        for addr in sorted_addrs[1:]:
-            # If the address is not sequential or exceeds max_count, read the current range
-            if addr != prev_addr + 1 or (addr - start + 1) > max_count:
-                count = prev_addr - start + 1
-                read_address = start - 1  # Adjust for zero-based addressing
-
-                # Handle input registers separately
-                if read_func == client.read_input_registers:
-                    response = await read_func(address=read_address, count=count)
-                    if not response.isError():
-                        results.update({
-                            a: response.registers[i]
-                            for i, a in enumerate(range(start, prev_addr + 1))
-                            if a in addresses
-                        })
-                else:
-                    # Handle coils and discrete inputs
-                    response = await read_func(address=read_address, count=count)
-                    if not response.isError():
-                        results.update({
-                            a: response.bits[i]
-                            for i, a in enumerate(range(start, prev_addr + 1))
-                            if a in addresses
-                        })
-
-                start = addr  # Start a new range
-
-            prev_addr = addr
-
-        # Read the last range
-        count = prev_addr - start + 1
-        read_address = start - 1  # Adjust for zero-based addressing
-
-        if read_func == client.read_input_registers:
-            response = await read_func(address=read_address, count=count)
-            if not response.isError():
-                results.update({
-                    a: response.registers[i]
-                    for i, a in enumerate(range(start, prev_addr + 1))
-                    if a in addresses
-                })
-        else:
-            response = await read_func(address=read_address, count=count)
-            if not response.isError():
-                results.update({
-                    a: response.bits[i]
-                    for i, a in enumerate(range(start, prev_addr + 1))
-                    if a in addresses
-                })
-        await asyncio.sleep(sampling_frequency / 1000)
-        return results
-
-    except ModbusException as e:
-        logger.error(f"Modbus error while reading registers: {e}")
-        return {}
+        return LiveTableWriter(plc_id, frame.addresses)
     except Exception as e:
-        logger.error(f"Unexpected error while reading registers: {e}")
-        return {}
+        logger.error(f"Live value table unavailable for PLC {plc_id}: {e}")
+        return None
 
 
-async def modbus_client_loop(plc_id, ip, port,sampling_frequency):
-    """Main Modbus client loop."""
-    logger.info(f"Starting Modbus client loop for PLC {plc_id} at {ip}:{port}")
+async def modbus_client_loop(plc_id, ip, port, sampling_frequency, gap_threshold=None,
+                             change_filter=None, max_in_flight=None, connections=None,
+                             control=None, unit_id=None, adaptive=True):
+    """
+    Main Modbus client loop.
+    With a ChangeFilter only samples that changed (or heartbeat rows) are stored.
+    ``max_in_flight`` caps the requests outstanding at the PLC at once and
+    ``connections`` the sockets opened to it; loops for other unit IDs at the
+    same IP:port share them.  A PollerControl passes in new settings while the
+    loop runs.  Unless ``adaptive`` is false, a RateController slows polling
+    down while the PLC struggles (see rate_control.py).
+    """
+    max_in_flight = max_in_flight or DEFAULT_MAX_IN_FLIGHT
+    connections = connections or DEFAULT_CONNECTIONS
+    unit_id = DEFAULT_UNIT_ID if unit_id is None else unit_id
+    logger.info(f"Starting Modbus client loop for PLC {plc_id} at {ip}:{port} unit {unit_id} "
+                f"({max_in_flight:g} requests in flight over {connections:g} connection(s))")
 
     # Update the selected_plc value dynamically
     selected_plc = plc_id
-    coils = get_coils(selected_plc)
-    input_status = get_input_bits(selected_plc)
-    input_register = get_inputs_register(selected_plc)
-    sampling_frequency = sampling_frequency
-
-    async with AsyncModbusTcpClient(ip, port=port) as client:
-        while True:
-            # Ensure the client is connected
-            if not client.connected:
-                logger.error("Client not connected. Attempting to reconnect...")
-                if not await client.connect():
-                    logger.error("Connection failed")
-                    if not show_popup_and_wait("Connection failed - retry?"):
-                        logger.info("User cancelled retry. Exiting...")
-                        break
-                    continue
-
-            # Check connection status
-            if not await check_connection(client, selected_plc):
-                logger.warning(f"Connection check failed for PLC {selected_plc}. Retrying...")
-                await asyncio.sleep(5)  # Wait before retrying
-                continue
-
-            try:
-                # Read all registers in parallel
-                coil_states, input_states, register_states = await asyncio.gather(
-                    read_registers(client, client.read_coils, coils),
-                    read_registers(client, client.read_discrete_inputs, input_status),
-                    read_registers(client, client.read_input_registers, input_register, max_count=125)
-                )
-
-                # Log the results
-                logger.debug(f"Coil States: {coil_states}")
-                logger.debug(f"Input Status States: {input_states}")
-                logger.debug(f"Input Register States: {register_states}")
-
-                # Save results to Excel
-                await append_to_excel({
-                    "plc_id": selected_plc,
-                    "coil_states": coil_states,
-                    "input_status_states": input_states,
-                    "input_register_states": register_states
-                })
-
-            except ModbusException as e:
-                logger.error(f"Modbus error during register reading: {e}")
-            except Exception as e:
-                logger.error(f"Unexpected error during register reading: {e}")
-
-            # Wait for the next sampling interval
-            await asyncio.sleep(3)
+    get_coils(selected_plc)
+    get_input_bits(selected_plc)
+    get_inputs_register(selected_plc)
+    get_holding_registers(selected_plc)
+    metrics = PlcMetrics(selected_plc)
+    scheduler = PollScheduler(sampling_interval(sampling_frequency), name=selected_plc,
+                              metrics=metrics)
+    plc_schedules[selected_plc] = scheduler
+    next_stats_log = time.monotonic() + STATS_LOG_INTERVAL
+    next_debug_log = 0.0
+    address_map = get_address_map(selected_plc, SAVED_ADDRESS_FILE_PATH)
+    plans, decoders = compile_plans(selected_plc, address_map, gap_threshold)
+
+    health = ConnectionHealth()
+    backoff = Backoff()
+    plc_state[selected_plc] = health.state()
+
+    frame = SampleFrame(selected_plc, decoders)
+    live_table = open_live_table_writer(selected_plc, frame)
+    try:
+        async with PipelinedModbusClient(ip, port=port, max_in_flight=max_in_flight,
+                                         connections=connections, unit_id=unit_id,
+                                         metrics=metrics) as client:
+            controller = RateController(selected_plc, scheduler, client, metrics, enabled=adaptive)
+            controller.set_plans(plans, read_priorities(address_map))
+            while True:
+                # Wait for the next sampling deadline
+                await scheduler.wait()
+
+                # Apply configuration changes between cycles
+                if control is not None and control.pending:
+                    settings = control.take()
+                    if "sampling_frequency" in settings:
+                        controller.set_interval(sampling_interval(settings["sampling_frequency"]))
+                    change_filter = settings.get("change_filter", change_filter)
+                    if "address_map" in settings or "gap_threshold" in settings:
+                        address_map = settings.get("address_map", address_map)
+                        gap_threshold = settings.get("gap_threshold", gap_threshold)
+                        plans, decoders = compile_plans(selected_plc, address_map, gap_threshold)
+                        controller.set_plans(plans, read_priorities(address_map))
+                        frame = SampleFrame(selected_plc, decoders)
+                        if live_table is not None:
+                            live_table.close()
+                        live_table = open_live_table_writer(selected_plc, frame)
+                    logger.info(f"PLC {selected_plc} configuration updated: {', '.join(settings)}")
+                if time.monotonic() >= next_stats_log:
+                    logger.info(f"PLC {selected_plc} schedule: {scheduler.stats()}")
+                    logger.info(f"PLC {selected_plc} rate control: {controller.stats()}")
+                    if change_filter is not None:
+                        logger.info(f"PLC {selected_plc} recorded samples: {change_filter.stats()}")
+                    next_stats_log += STATS_LOG_INTERVAL
+
+                # Reconnect (or probe after a failure / long idle) with exponential backoff
+                if not client.connected or health.needs_probe():
+                    if not client.connected:
+                        logger.error(f"PLC {selected_plc} not connected. Attempting to reconnect...")
+                        metrics.reconnects.inc()
+                        await client.connect()
+                    if not client.connected or not await check_connection(client, selected_plc, plans):
+                        health.record_failure("connection failed")
+                        plc_state[selected_plc] = health.state()
+                        delay = backoff.next_delay()
+                        logger.warning(f"Connection check failed for PLC {selected_plc}. "
+                                       f"Retrying in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                        scheduler.resync()
+                        continue
+
+                try:
+                    # Read the blocks due this cycle in parallel, decoding into the frame in place
+                    controller.begin_cycle()
+                    started = time.monotonic()
+                    failures = await asyncio.gather(*(
+                        read_registers(client, getattr(client, read_method), decoders[register_type],
+                                       frame.values[register_type],
+                                       controller.schedules[register_type],
+                                       f"{register_type} of PLC {selected_plc}")
+                        for register_type, (_, read_method) in READ_FUNCTIONS.items()
+                    ))
+                    frame.timestamp = time.time()
+                    controller.end_cycle(time.monotonic() - started)
+                    metrics.read_errors.inc(sum(failures))
+                    for register_type, failed in zip(READ_FUNCTIONS, failures):
+                        frame.received[register_type] = (
+                            failed < controller.schedules[register_type].requested)
+                    held = [decoder.held(frame.timestamp) for decoder in decoders.values()]
+                    metrics.held_blocks.set(sum(count for count, _ in held))
+                    metrics.held_value_age.set(max(age for _, age in held))
+
+                    # A cycle with requests to make but nothing returned counts as a failure
+                    if (any(frame.received.values())
+                            or not any(schedule.requested
+                                       for schedule in controller.schedules.values())):
+                        health.record_success()
+                        backoff.reset()
+                    else:
+                        health.record_failure("no data returned")
+                    plc_state[selected_plc] = health.state()
+
+                    # Publish the latest values for the UI and the Modbus server; a cycle
+                    # that returned nothing leaves the previous sample (and its age) in place
+                    if live_table is not None and any(frame.received.values()):
+                        live_table.publish(frame)
+
+                    # Store register types that returned anything (and changed enough, with a
+                    # filter); blocks that failed or were put off hold their last values
+                    record = [register_type for register_type in READ_FUNCTIONS
+                              if frame.received[register_type]
+                              and (change_filter is None
+                                   or change_filter.should_record(register_type,
+                                                                  frame.values[register_type]))]
+
+                    # Dump a sample cycle now and then; every cycle would cost more than the read
+                    if logger.isEnabledFor(logging.DEBUG) and time.monotonic() >= next_debug_log:
+                        next_debug_log = time.monotonic() + DEBUG_SAMPLE_INTERVAL
+                        for register_type in READ_FUNCTIONS:
+                            logger.debug(f"{register_type}: {frame.as_dict(register_type)}")
+                        logger.debug(f"PLC {selected_plc} recording {record}")
+
+                    # Save results to Excel
+                    await append_to_excel(frame, record)
+
+                except ModbusException as e:
+                    logger.error(f"Modbus error during register reading: {e}")
+                except Exception as e:
+                    logger.error(f"Unexpected error during register reading: {e}")
+    finally:
+        if live_table is not None:
+            live_table.close()
+        plc_schedules.pop(selected_plc, None)
+        plc_state.pop(selected_plc, None)
+        metrics.remove()
 
 async def main():
     """Main async function."""
@@ -0,0 +1,184 @@
+"""
+Cached Modbus address maps parsed from config/saveAddress.xlsx.
+
+Parsing the workbook with pandas is by far the most expensive thing the poller
+does, so every sheet is parsed once into an ``AddressMap`` and reused until the
+workbook's modification time changes.  The parsed maps are kept in the
+compiled configuration cache (see config_cache.py), so pandas is only needed
+after the workbook was edited.
+
+Analog inputs and holding registers may carry optional "Data Type",
+"Byte Order", "Word Order", "Scale" and "Offset" columns, suffixed with the
+address kind as in "Data Type (Holding Registers)"; see points.py.  Every
+kind may also have a "Priority (...)" column: "high", "normal" (the default)
+or "low", which the rate controller (rate_control.py) uses to decide which
+points to slow down first when a PLC struggles.
+"""
+import logging
+import os
+from array import array
+
+from points import Point
+
+logger = logging.getLogger("ModbusClient")
+
+SAVED_ADDRESS_FILE_PATH = "config/saveAddress.xlsx"
+
+# Address kind -> (sheet column, Modbus reference offset)
+ADDRESS_COLUMNS = {
+    "Coils": ("MODBUS ADDRESS (Coils)", 0),
+    "Input Bits": ("MODBUS ADDRESS (Input Bits)", 10000),
+    "Analog Inputs": ("MODBUS ADDRESS (Analog Inputs)", 30000),
+    "Holding Registers": ("MODBUS ADDRESS (Holding Registers)", 40000),
+}
+
+# Address kinds read as 16-bit registers, which can hold typed points
+REGISTER_KINDS = ("Analog Inputs", "Holding Registers")
+# Point column prefix -> Point argument
+POINT_COLUMNS = {
+    "Data Type": "data_type",
+    "Byte Order": "byte_order",
+    "Word Order": "word_order",
+    "Scale": "scale",
+    "Offset": "offset",
+}
+PRIORITIES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+
+def contiguous_ranges(addresses):
+    """Split sorted addresses into (start, count) runs of consecutive addresses."""
+    ranges = []
+    start = prev = None
+    for addr in addresses:
+        if start is None:
+            start = prev = addr
+        elif addr == prev + 1:
+            prev = addr
+        else:
+            ranges.append((start, prev - start + 1))
+            start = prev = addr
+    if start is not None:
+        ranges.append((start, prev - start + 1))
+    return tuple(ranges)
+
+
+class AddressMap:
+    """
+    Sorted addresses and contiguous read ranges for one PLC sheet.
+    Register kinds also get their typed ``points`` (plain uint16 by default),
+    ``priorities`` holds the addresses that are not of normal priority, and
+    ``plans`` keeps the read plans compiled for it by (kind, gap).
+    """
+
+    __slots__ = ("sheet_name", "mtime", "addresses", "ranges", "points", "priorities", "plans")
+
+    def __init__(self, sheet_name, mtime, addresses, points=None, priorities=None):
+        self.sheet_name = sheet_name
+        self.mtime = mtime
+        self.addresses = {kind: array("i", sorted(set(addresses.get(kind, ()))))
+                          for kind in ADDRESS_COLUMNS}
+        self.ranges = {kind: contiguous_ranges(addrs) for kind, addrs in self.addresses.items()}
+        points = points or {}
+        self.points = {}
+        for kind in REGISTER_KINDS:
+            typed = {point.address: point for point in points.get(kind, ())}
+            self.points[kind] = tuple(typed.get(addr) or Point(addr) for addr in self.addresses[kind])
+        priorities = priorities or {}
+        self.priorities = {kind: {int(addr): priority
+                                  for addr, priority in dict(priorities.get(kind, {})).items()
+                                  if priority != DEFAULT_PRIORITY}
+                           for kind in ADDRESS_COLUMNS}
+        self.plans = {}
+
+    def __getitem__(self, kind):
+        return self.addresses[kind]
+
+    def as_dict(self):
+        return {kind: addrs.tolist() for kind, addrs in self.addresses.items()}
+
+    def read_priorities(self, kind):
+        """
+        {address: priority} of what a read plan of ``kind`` covers, for the
+        addresses not of normal priority; a typed point's priority applies to
+        each of its registers.
+        """
+        priorities = self.priorities[kind]
+        if kind not in REGISTER_KINDS or not priorities:
+            return priorities
+        return {addr: priorities[point.address] for point in self.points[kind]
+                if point.address in priorities for addr in point.registers()}
+
+    def layout_key(self):
+        """Addresses and point settings; equal keys poll and decode identically."""
+        return (tuple(tuple(addrs) for addrs in self.addresses.values()),
+                tuple(tuple(point.spec for point in points) for points in self.points.values()),
+                tuple(tuple(sorted(priorities.items())) for priorities in self.priorities.values()))
+
+
+def parse_sheet(sheet_name, df, mtime):
+    """Parse one sheet (a pandas DataFrame) of the address workbook into an AddressMap."""
+    addresses = {}
+    points = {}
+    priorities = {}
+    if not df.empty:
+        for kind, (column, offset) in ADDRESS_COLUMNS.items():
+            if column in df:
+                addresses[kind] = [addr - offset for addr in
+                                   df[column].dropna().astype(int).tolist()]
+                if kind in REGISTER_KINDS:
+                    points[kind] = _parse_points(sheet_name, df, kind, column, offset)
+                priorities[kind] = _parse_priorities(sheet_name, df, kind, column, offset)
+    if not any(addresses.values()):
+        logger.warning(f"Sheet '{sheet_name}' is empty")
+    return AddressMap(sheet_name, mtime, addresses, points, priorities)
+
+
+def _parse_points(sheet_name, df, kind, column, offset):
+    """Typed points of one register kind; rows without type columns stay plain."""
+    columns = {f"{prefix} ({kind})": arg for prefix, arg in POINT_COLUMNS.items()
+               if f"{prefix} ({kind})" in df}
+    if not columns:
+        return []
+    rows = df[[column] + list(columns)].dropna(subset=[column])
+    points = []
+    for row in rows.itertuples(index=False):
+        kwargs = {arg: value for arg, value in zip(columns.values(), row[1:])
+                  if value is not None and value == value}  # skip NaN
+        try:
+            points.append(Point(int(row[0]) - offset, **kwargs))
+        except ValueError as e:
+            logger.error(f"Sheet '{sheet_name}': {e}; reading it as uint16")
+    return points
+
+
+def _parse_priorities(sheet_name, df, kind, column, offset):
+    """{address: priority} of one address kind, for rows that set one."""
+    priority_column = f"Priority ({kind})"
+    if priority_column not in df:
+        return {}
+    priorities = {}
+    for addr, priority in df[[column, priority_column]].dropna().itertuples(index=False):
+        priority = str(priority).strip().lower()
+        if priority not in PRIORITIES:
+            logger.error(f"Sheet '{sheet_name}': unknown priority {priority!r} at {int(addr)}; "
+                         f"using {DEFAULT_PRIORITY}")
+            continue
+        priorities[int(addr) - offset] = priority
+    return priorities
+
+
+def get_address_map(sheet_name, path=SAVED_ADDRESS_FILE_PATH):
+    """Return the cached AddressMap for a sheet, re-parsing only if the file changed."""
+    from config_cache import load_config
+
+    if not os.path.exists(path):
+        logger.error(f"Error reading Excel file: {path} not found")
+        return AddressMap(sheet_name, None, {})
+
+    maps = load_config(address_path=path).address_maps
+    address_map = maps.get(sheet_name)
+    if address_map is None:
+        logger.error(f"Sheet '{sheet_name}' not found in {path}")
+        return AddressMap(sheet_name, None, {})
+    return address_map
@@ -1,36 +1,82 @@
 import webview
-import pandas as pd
-import numpy as np
+import importlib.util
 import os
-import asyncio
-from main_modbus import modbus_client_loop, read_selected_plc, get_coils, get_input_bits, get_inputs_register
+import json
+import time
+import urllib.request
+from config_cache import CONFIG_CHECK_INTERVAL, load_config
+from live_push import DeltaPusher
+from live_table import REATTACH_AFTER, open_live_table
+from metrics import METRICS_HOST, metrics_port
 
-try:
-    import openpyxl
-except ImportError:
+# Needed to recompile the configuration cache after a workbook is edited
+if importlib.util.find_spec("openpyxl") is None:
     print("Error: 'openpyxl' is required. Install it using: pip install openpyxl")
     exit(1)
 
+METRICS_TIMEOUT = 2.0  # seconds to wait for the poller's metrics endpoint
+
+REGISTER_COLUMNS = [
+    'PLC OUTPUT NO',
+    'MODBUS ADDRESS (Coils)',
+    'States (Coils)',
+    'INPUT BIT NO',
+    'MODBUS ADDRESS (Input Bits)',
+    'States (Input Bits)',
+    'PLC ANALOG INPUT SLOT',
+    'MODBUS ADDRESS (Analog Inputs)',
+    'Values',
+    'MODBUS ADDRESS (Holding Registers)',
+    'Values (Holding Registers)'
+]
+
+# Live value column -> (address column, address offset, live table register type)
+LIVE_COLUMNS = [
+    ('States (Coils)', 'MODBUS ADDRESS (Coils)', 0, 'coil_states'),
+    ('States (Input Bits)', 'MODBUS ADDRESS (Input Bits)', 10000, 'input_status_states'),
+    ('Values', 'MODBUS ADDRESS (Analog Inputs)', 30000, 'input_register_states'),
+    ('Values (Holding Registers)', 'MODBUS ADDRESS (Holding Registers)', 40000, 'holding_register_states'),
+]
+
+
 class Api:
     def __init__(self):
-        self.plc_config_path = 'plc_data.xlsx'
-        self.save_address_path = 'saveAddress.xlsx'
-        self.modbus_data = {
-            "coil_states": {},
-            "input_status_states": {},
-            "input_register_states": {}
-        }
+        self.plc_config_path = os.path.join('config', 'plc_data.xlsx')
+        self.save_address_path = os.path.join('config', 'saveAddress.xlsx')
+        # Static config cache: path -> (mtime, parsed data), re-checked every few seconds
+        self._file_cache = {}
+        self._last_checked = {}
+        self._live_tables = {}  # plc_name -> LiveTableReader
+        self._live_index = {}  # plc_name -> (static rows, per-row positions in the live table)
+
+    def _cached(self, key, path, loader):
+        """Return loader(), re-running it only when the file at ``path`` changed."""
+        now = time.monotonic()
+        cached = self._file_cache.get(key)
+        if cached is not None and now - self._last_checked.get(key, 0) < CONFIG_CHECK_INTERVAL:
+            return cached[1]
+        self._last_checked[key] = now
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, loader())
+            self._file_cache[key] = cached
+        return cached[1]
+
+    def _config(self):
+        """Both workbooks, compiled (see config_cache.py)"""
+        return load_config(plc_path=self.plc_config_path, address_path=self.save_address_path)
 
     def _load_plc_config(self):
+        return self._cached(self.plc_config_path, self.plc_config_path, self._read_plc_config)
+
+    def _read_plc_config(self):
         """Load PLC configuration data"""
         if not os.path.exists(self.plc_config_path):
             print(f"Error: File '{self.plc_config_path}' not found.")
             return []
 
         try:
-            df = pd.read_excel(self.plc_config_path)
-            df.replace({np.nan: None}, inplace=True)
-            return df.to_dict('records')
+            return self._config().plcs
         except Exception as e:
             print(f"Error loading PLC config: {e}")
             return []
@@ -40,13 +86,59 @@ class Api:
         config_data = self._load_plc_config()
         return list(set(item['PLC'] for item in config_data if 'PLC' in item))
 
+    def _load_register_data(self, plc_name):
+        """Static register rows for a PLC sheet, cached until saveAddress.xlsx changes."""
+        def read_sheet():
+            if not os.path.exists(self.save_address_path):
+                print(f"Error: File '{self.save_address_path}' not found.")
+                return []
+            rows = self._config().rows.get(plc_name)
+            if rows is None:
+                raise ValueError(f"Worksheet named '{plc_name}' not found")
+            # Holding register columns are optional in older sheets
+            return [{column: row[column] for column in REGISTER_COLUMNS if column in row}
+                    for row in rows]
+
+        return self._cached((self.save_address_path, plc_name), self.save_address_path, read_sheet)
+
+    def _live_table(self, plc_name):
+        table = self._live_tables.get(plc_name)
+        if table is None:
+            table = open_live_table(plc_name)
+            if table is not None:
+                self._live_tables[plc_name] = table
+                self._live_index.pop(plc_name, None)
+        return table
+
+    def _drop_live_table(self, plc_name):
+        table = self._live_tables.pop(plc_name, None)
+        self._live_index.pop(plc_name, None)
+        if table is not None:
+            table.close()
+
+    def _row_index(self, plc_name, rows, table):
+        """Per row, the (column, register type, position) of each live value."""
+        cached = self._live_index.get(plc_name)
+        if cached is not None and cached[0] is rows:
+            return cached[1]
+
+        index = []
+        for row in rows:
+            cells = []
+            for column, address_column, offset, register_type in LIVE_COLUMNS:
+                address = row.get(address_column)
+                if address is not None:
+                    position = table.index[register_type].get(int(address) - offset)
+                    if position is not None:
+                        cells.append((column, register_type, position))
+            index.append(cells)
+        self._live_index[plc_name] = (rows, index)
+        return index
+
     def get_plc_data(self, plc_name):
-        """Get data for selected PLC from both files"""
+        """Get config and register data for a PLC, with the latest values from its poller"""
         config_data = self._load_plc_config()
-        print("Loaded PLC config data:", config_data)  # Debug
-
         plc_info = next((item for item in config_data if item.get('PLC') == plc_name), None)
-        print(f"PLC info for {plc_name}:", plc_info)  # Debug
 
         if not plc_info:
             return {
@@ -56,33 +148,25 @@ class Api:
             }
 
         try:
-            # Get register data from saveAddress
-            if not os.path.exists(self.save_address_path):
-                print(f"Error: File '{self.save_address_path}' not found.")
-                register_data = []
-            else:
-                df = pd.read_excel(
-                    self.save_address_path,
-                    sheet_name=plc_name,
-                    usecols=[
-                        'PLC OUTPUT NO',
-                        'MODBUS ADDRESS (Coils)',
-                        'States (Coils)',
-                        'INPUT BIT NO',
-                        'MODBUS ADDRESS (Input Bits)',
-                        'States (Input Bits)',
-                        'PLC ANALOG INPUT SLOT',
-                        'MODBUS ADDRESS (Analog Inputs)',
-                        'Values'
-                    ]
-                )
-                register_data = df.replace({np.nan: None}).to_dict('records')
-                print(f"Register data for {plc_name}:", register_data)  # Debug
+            rows = self._load_register_data(plc_name)
+            register_data = [dict(row) for row in rows]
+            updated = None
+
+            table = self._live_table(plc_name)
+            if table is not None:
+                _, updated, values = table.read()
+                for row, cells in zip(register_data, self._row_index(plc_name, rows, table)):
+                    for column, register_type, position in cells:
+                        row[column] = values[register_type][position]
+                if time.time() - updated > REATTACH_AFTER:
+                    # The poller may have restarted with a new table; re-attach next call
+                    self._drop_live_table(plc_name)
 
             return {
                 'sampling_frequency': plc_info.get('Sampling Frequency', 'N/A'),
                 'change_in_data': plc_info.get('Change in Data', 'N/A'),
-                'register_data': register_data
+                'register_data': register_data,
+                'updated': updated
             }
 
         except Exception as e:
@@ -94,43 +178,74 @@ class Api:
             }
 
     def create_plc_window(self, plc_name):
-        # Create a new webview window for the PLC
+        # Create a new webview window for the PLC, with its own push subscription
+        window_api = PlcWindowApi(self)
         window = webview.create_window(
             f'{plc_name} Data',
             url='web/plc_window.html',  # Create a template HTML file
-            js_api=self,
+            js_api=window_api,
             width=1400,
             height=800
         )
+        window_api.attach(window)
         return True
 
-    def get_modbus_data(self):
-        """Return the latest Modbus data"""
-        return self.modbus_data
+    def get_modbus_data(self, plc_name):
+        """Return the latest Modbus data published by the PLC's poller"""
+        table = self._live_table(plc_name)
+        if table is None:
+            return {"coil_states": {}, "input_status_states": {}, "input_register_states": {},
+                    "holding_register_states": {}}
+        _, _, values = table.read()
+        return {register_type: dict(zip(table.addresses[register_type], values[register_type]))
+                for register_type in values}
+
+    def get_metrics(self):
+        """Snapshot of the poller's metrics, fetched from its local metrics endpoint"""
+        port = metrics_port()
+        if not port:
+            return {'error': 'Metrics endpoint disabled (NODEPORT_METRICS_PORT=0)'}
+        url = f'http://{METRICS_HOST}:{port}/metrics.json'
+        try:
+            with urllib.request.urlopen(url, timeout=METRICS_TIMEOUT) as response:
+                return {'metrics': json.load(response)}
+        except Exception as e:
+            return {'error': f'Poller metrics unavailable at {url}: {e}'}
 
-    async def run_modbus_client(self):
-        """Run the Modbus client loop in the background"""
-        while True:
-            try:
-                # Fetch the latest Modbus data
-                coil_states, input_status_states, input_register_states = await modbus_client_loop("127.0.0.1", 502)
+class PlcWindowApi:
+    """JS API of one PLC window: static data on request, live values pushed as deltas."""
 
-                # Update the global modbus_data dictionary
-                self.modbus_data["coil_states"] = coil_states
-                self.modbus_data["input_status_states"] = input_status_states
-                self.modbus_data["input_register_states"] = input_register_states
+    def __init__(self, api):
+        self._api = api
+        self._window = None
+        self._pusher = DeltaPusher(self._push)
+
+    def attach(self, window):
+        self._window = window
+        window.events.closed += self._pusher.stop
+
+    def _push(self, delta):
+        if self._window is not None:
+            self._window.evaluate_js(f"window.applyDelta && window.applyDelta({json.dumps(delta)})")
+
+    def get_plc_data(self, plc_name):
+        return self._api.get_plc_data(plc_name)
+
+    def subscribe(self, plc_name):
+        """Push changed values of ``plc_name`` to this window as they are polled."""
+        self._pusher.subscribe(plc_name)
+        return True
+
+    def unsubscribe(self, plc_name):
+        self._pusher.unsubscribe(plc_name)
+        return True
 
-            except Exception as e:
-                print(f"Error in Modbus client loop: {e}")
 
 if __name__ == '__main__':
     api = Api()
     data = api.get_plc_list()
     print(data)
 
-    # Start the Modbus client loop in the background
-    asyncio.create_task(api.run_modbus_client())
-
     # Start the webview window
     window = webview.create_window(
         'PLC Monitor',
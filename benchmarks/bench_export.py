@@ -0,0 +1,133 @@
+"""
+Throughput and memory of the streaming history export (export.py).
+
+    python benchmarks/bench_export.py --plcs 4 --days 7 --points 40
+    python benchmarks/bench_export.py --plcs 50 --days 30 --format parquet --jobs 8 --output export.json
+
+Writes ``--days`` of synthetic 1 Hz history (``--rate``) for ``--plcs``
+PLCs into a temporary data directory, each register type recorded with
+``--store-fraction`` of the cycles as a change filter would, and compresses
+every segment but the newest as the retention job does.  The export then runs
+in a child process, so its peak RSS can be reported on its own; a flat peak
+across ``--days`` is what the streaming is for.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame import record_dtype  # noqa: E402
+from storage import SegmentStorage, compress_segment, list_segments  # noqa: E402
+
+DAY = 86400
+# Register type -> (value dtype, share of the points)
+TYPES = {
+    "coil_states": (np.uint8, 0.25),
+    "input_status_states": (np.uint8, 0.25),
+    "input_register_states": (np.uint16, 0.25),
+    "holding_register_states": (np.float64, 0.25),
+}
+GENERATE_ROWS = 86400  # records generated per append
+
+
+def generate(data_dir, plcs, days, rate, points, store_fraction, seed=0):
+    """Synthetic recorded history; returns the number of stored records."""
+    rng = np.random.default_rng(seed)
+    storage = SegmentStorage(data_dir=data_dir)
+    start = time.time() - days * DAY
+    stored = 0
+    for plc in range(plcs):
+        plc_id = f"BENCH{plc + 1}"
+        for register_type, (dtype, share) in TYPES.items():
+            addresses = list(range(1, max(1, int(points * share)) + 1))
+            total = int(days * DAY * rate)
+            for offset in range(0, total, GENERATE_ROWS):
+                ts = start + (offset + np.arange(min(GENERATE_ROWS, total - offset))) / rate
+                ts = ts[rng.random(len(ts)) < store_fraction]
+                records = np.zeros(len(ts), dtype=record_dtype(dtype, len(addresses)))
+                records["ts"] = ts
+                records["values"] = rng.integers(0, 2 if dtype == np.uint8 else 1000,
+                                                 size=(len(ts), len(addresses)))
+                storage.append_records(plc_id, register_type, addresses, records)
+                stored += len(ts)
+            storage.close()
+            for path in list_segments(plc_id, register_type, data_dir)[:-1]:
+                compress_segment(path)
+    return stored
+
+
+def _child(data_dir, output, fmt, jobs, plcs):
+    from export import export
+
+    started = time.perf_counter()
+    rows = sum(rows for _, _, rows, _ in export([f"BENCH{i + 1}" for i in range(plcs)], output,
+                                                fmt, data_dir=data_dir, jobs=jobs))
+    elapsed = time.perf_counter() - started
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({"rows": rows, "seconds": elapsed, "peak_rss_bytes": peak * 1024}))
+
+
+def run(args):
+    with tempfile.TemporaryDirectory(prefix="bench_export_") as directory:
+        data_dir = os.path.join(directory, "modbus_data")
+        started = time.perf_counter()
+        stored = generate(data_dir, args.plcs, args.days, args.rate, args.points, args.store_fraction)
+        generated = time.perf_counter() - started
+        output = os.path.join(directory, "export")
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", data_dir, output, args.format,
+             str(args.jobs), str(args.plcs)],
+            capture_output=True, text=True, check=True)
+        child = json.loads(result.stdout.strip().splitlines()[-1])
+        size = sum(os.path.getsize(os.path.join(output, name)) for name in os.listdir(output))
+    return {
+        "benchmark": "export",
+        "timestamp": time.time(),
+        "config": {"plcs": args.plcs, "days": args.days, "rate_hz": args.rate, "points": args.points,
+                   "store_fraction": args.store_fraction, "format": args.format, "jobs": args.jobs},
+        "stored_records": stored,
+        "generate_seconds": generated,
+        "rows": child["rows"],
+        "seconds": child["seconds"],
+        "rows_per_s": child["rows"] / child["seconds"],
+        "output_bytes": size,
+        "peak_rss_bytes": child["peak_rss_bytes"],
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        data_dir, output, fmt, jobs, plcs = sys.argv[2:7]
+        _child(data_dir, output, fmt, int(jobs), int(plcs))
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--plcs", type=int, default=2)
+    parser.add_argument("--days", type=float, default=2)
+    parser.add_argument("--rate", type=float, default=1.0, help="samples per second")
+    parser.add_argument("--points", type=int, default=40, help="addresses per PLC")
+    parser.add_argument("--store-fraction", type=float, default=0.5,
+                        help="share of cycles stored per register type")
+    parser.add_argument("--format", choices=("csv", "xlsx", "parquet"), default="csv")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args)
+    print(f"{results['rows']} rows in {results['seconds']:.1f}s ({results['rows_per_s']:.0f} rows/s), "
+          f"peak RSS {results['peak_rss_bytes'] / 2**20:.0f} MiB", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
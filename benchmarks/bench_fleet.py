@@ -0,0 +1,267 @@
+"""
+End-to-end throughput of the poller against a fleet of local simulators.
+
+    python benchmarks/bench_fleet.py --plcs 20 --interval 100 --duration 30
+    python benchmarks/bench_fleet.py --plcs 50 --latency 5 --error-rate 0.01 --output fleet.json
+    python benchmarks/bench_fleet.py --isolate --float32 200 --blocks 4
+    python benchmarks/bench_fleet.py --plcs 1 --units 30 --latency 2 --interval 1000
+
+Starts ``--plcs`` simulators (see simulator.py), writes plc_data.xlsx and
+saveAddress.xlsx for them into a temporary working directory and runs
+``main.run_client_loops`` exactly as the service does, recording to a
+temporary data directory.  After ``--warmup`` seconds the counters are reset
+and the run is measured for ``--duration`` seconds.
+
+Reported: point values read and samples stored per second, poll cycle
+duration percentiles, scheduling jitter and missed deadlines, CPU time and
+resident memory.  By default the simulators share the process, so CPU and
+memory include them; ``--isolate`` runs them in a child process instead.
+With ``--units`` every simulator is a gateway to that many devices on one
+serial bus, each configured as its own PLC row with a "Unit ID".
+The results are printed as JSON (or written to ``--output``) so runs can be
+compared over time; everything runs offline on localhost.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ModBus  # noqa: E402
+import scheduler  # noqa: E402
+from main import run_client_loops  # noqa: E402
+from simulator import BASE_PORT, AddressLayout, FleetProcess, SimulatorFleet  # noqa: E402
+from write_behind import get_write_queue  # noqa: E402
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def write_config(directory, plcs, ports, layout, interval_ms, options, units=1):
+    """Write config/plc_data.xlsx and config/saveAddress.xlsx for the fleet."""
+    import pandas as pd
+
+    config = os.path.join(directory, "config")
+    os.makedirs(config, exist_ok=True)
+    endpoints = [(port, unit_id) for port in ports[:plcs] for unit_id in range(1, units + 1)]
+    names = [f"BENCH{i + 1}" for i in range(len(endpoints))]
+    rows = [{"PLC": name, "IP Address": "127.0.0.1", "Port": port,
+             **({"Unit ID": unit_id} if units > 1 else {}),
+             "Sampling Frequency": interval_ms, **options}
+            for name, (port, unit_id) in zip(names, endpoints)]
+    pd.DataFrame(rows).to_excel(os.path.join(config, "plc_data.xlsx"), index=False)
+    sheet = layout.sheet()
+    with pd.ExcelWriter(os.path.join(config, "saveAddress.xlsx")) as writer:
+        for name in names:
+            sheet.to_excel(writer, sheet_name=name, index=False)
+    return names
+
+
+def _rss_bytes():
+    """Current resident set size (Linux), else the peak."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return _peak_rss_bytes()
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _snapshot():
+    queue = get_write_queue().stats()
+    return {"time": time.perf_counter(), "cpu": _cpu_seconds(), "queue": queue}
+
+
+async def measure(names, warmup, duration):
+    """Run the poller, reset its counters after the warm-up and collect the results."""
+    poller = asyncio.ensure_future(run_client_loops())
+    try:
+        await asyncio.sleep(warmup)
+        missing = [name for name in names if name not in ModBus.plc_schedules]
+        if missing:
+            raise RuntimeError(f"{len(missing)} PLC(s) did not start polling: {missing[:5]}")
+        for name in names:
+            ModBus.plc_schedules[name].reset_stats()
+        start = _snapshot()
+        await asyncio.sleep(duration)
+        end = _snapshot()
+        schedules = {name: ModBus.plc_schedules[name] for name in names}
+        cycle_times = np.concatenate([np.fromiter(s.cycle_times, dtype=float)
+                                      for s in schedules.values()])
+        stats = {name: s.stats() for name, s in schedules.items()}
+        states = {name: dict(ModBus.plc_state.get(name, {})) for name in names}
+    finally:
+        poller.cancel()
+        try:
+            await poller
+        except asyncio.CancelledError:
+            pass
+    return start, end, cycle_times, stats, states
+
+
+def summarize(args, layout, start, end, cycle_times, stats, states, fleet_stats):
+    elapsed = end["time"] - start["time"]
+    cycles = sum(s["cycles"] for s in stats.values())
+    ticks = sum(s["ticks"] for s in stats.values())
+    stored = end["queue"]["enqueued"] - start["queue"]["enqueued"]
+    jitter_means = [s["jitter_mean_ms"] for s in stats.values()]
+    return {
+        "benchmark": "fleet",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "plcs": args.plcs,
+            "units": args.units,
+            "points_per_plc": layout.points,
+            "blocks": args.blocks,
+            "float32": args.float32,
+            "interval_ms": args.interval,
+            "latency_ms": args.latency,
+            "jitter_ms": args.jitter,
+            "error_rate": args.error_rate,
+            "max_in_flight": args.max_in_flight,
+            "connections": args.connections,
+            "change_in_data": args.change_in_data,
+            "isolated_simulators": args.isolate,
+            "warmup_s": args.warmup,
+            "duration_s": elapsed,
+        },
+        "throughput": {
+            "cycles_per_s": ticks / elapsed,
+            "points_per_s": ticks * layout.points / elapsed,
+            "stored_samples_per_s": stored / elapsed,
+            "expected_cycles_per_s": args.plcs * args.units * 1000 / args.interval,
+        },
+        "cycle_ms": {
+            "count": cycles,
+            "mean": float(cycle_times.mean() * 1000) if cycle_times.size else None,
+            "max": float(cycle_times.max() * 1000) if cycle_times.size else None,
+            **{f"p{p:g}": float(np.percentile(cycle_times, p) * 1000) if cycle_times.size else None
+               for p in PERCENTILES},
+        },
+        "jitter_ms": {
+            "mean": float(np.mean(jitter_means)) if jitter_means else None,
+            "max": max((s["jitter_max_ms"] for s in stats.values()), default=None),
+            "missed_deadlines": sum(s["missed"] for s in stats.values()),
+        },
+        "cpu": {
+            "seconds": end["cpu"] - start["cpu"],
+            "percent": (end["cpu"] - start["cpu"]) / elapsed * 100,
+        },
+        "memory": {
+            "rss_bytes": _rss_bytes(),
+            "peak_rss_bytes": _peak_rss_bytes(),
+        },
+        "storage_queue": {key: end["queue"][key] - start["queue"][key]
+                          for key in ("enqueued", "written", "dropped")}
+        | {"max_depth": end["queue"]["max_depth"], "max_flush_ms": end["queue"]["max_flush_ms"]},
+        "connections": {
+            "connected": sum(1 for state in states.values() if state.get("connected")),
+            "plcs": args.plcs * args.units,
+        },
+        "simulators": fleet_stats,
+        "plcs": stats,
+    }
+
+
+def run(args):
+    layout = AddressLayout(args.coils, args.inputs, args.registers, args.holding, args.float32,
+                           args.blocks)
+    fleet_class = FleetProcess if args.isolate else SimulatorFleet
+    fleet = fleet_class(args.plcs, layout, base_port=args.port, latency=args.latency / 1000,
+                        jitter=args.jitter / 1000, error_rate=args.error_rate, units=args.units)
+
+    # Keep every measured cycle for the percentiles, not just the recent ones
+    expected = int((args.warmup + args.duration) * 1000 / args.interval) + 1
+    scheduler.CYCLE_HISTORY = max(scheduler.CYCLE_HISTORY, expected)
+
+    options = {"Max In Flight": args.max_in_flight, "Connections": args.connections}
+    if args.change_in_data is not None:
+        options["Change in Data"] = args.change_in_data
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_fleet_") as directory, fleet:
+        names = write_config(directory, args.plcs, fleet.ports, layout, args.interval, options,
+                             args.units)
+        os.chdir(directory)  # config/ and modbus_data/ are relative to the working directory
+        try:
+            results = summarize(args, layout, *asyncio.run(measure(names, args.warmup, args.duration)),
+                                fleet.stats())
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def print_summary(results):
+    throughput, cycle, jitter = results["throughput"], results["cycle_ms"], results["jitter_ms"]
+    config = results["config"]
+    print(f"{config['plcs'] * config['units']} PLCs x {config['points_per_plc']} points every "
+          f"{config['interval_ms']:g} ms for {config['duration_s']:.1f} s", file=sys.stderr)
+    print(f"  cycles/s {throughput['cycles_per_s']:.1f} of {throughput['expected_cycles_per_s']:.1f}, "
+          f"points/s {throughput['points_per_s']:.0f}, "
+          f"stored samples/s {throughput['stored_samples_per_s']:.1f}", file=sys.stderr)
+    if cycle["count"]:
+        print(f"  cycle ms p50 {cycle['p50']:.2f}  p90 {cycle['p90']:.2f}  p99 {cycle['p99']:.2f}  "
+              f"max {cycle['max']:.2f}", file=sys.stderr)
+    print(f"  jitter ms mean {jitter['mean']:.2f}  max {jitter['max']:.2f}  "
+          f"missed deadlines {jitter['missed_deadlines']}", file=sys.stderr)
+    print(f"  CPU {results['cpu']['percent']:.1f}%  RSS {results['memory']['rss_bytes'] / 2**20:.1f} MiB "
+          f"(peak {results['memory']['peak_rss_bytes'] / 2**20:.1f} MiB)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--plcs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=BASE_PORT, help="port of the first simulator")
+    parser.add_argument("--coils", type=int, default=64)
+    parser.add_argument("--inputs", type=int, default=64)
+    parser.add_argument("--registers", type=int, default=100)
+    parser.add_argument("--holding", type=int, default=50)
+    parser.add_argument("--float32", type=int, default=0, help="float32 holding points")
+    parser.add_argument("--blocks", type=int, default=1, help="blocks per address kind")
+    parser.add_argument("--units", type=int, default=1,
+                        help="unit IDs behind each simulator, polled as separate PLC rows")
+    parser.add_argument("--interval", type=float, default=100, help="sampling interval in ms")
+    parser.add_argument("--latency", type=float, default=0.0, help="ms added to every read")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many ms more")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of reads answered with an exception")
+    parser.add_argument("--max-in-flight", type=int, default=1)
+    parser.add_argument("--connections", type=int, default=1)
+    parser.add_argument("--change-in-data", type=float, default=None,
+                        help="deadband; by default every sample is stored")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--isolate", action="store_true", help="run the simulators in a child process")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--log-level", default="ERROR", help="poller log level during the run")
+    args = parser.parse_args()
+
+    logging.getLogger("ModbusClient").setLevel(args.log_level.upper())
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    results = run(args)
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
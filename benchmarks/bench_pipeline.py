@@ -0,0 +1,140 @@
+"""
+Poll cycle time against a local pymodbus simulator as in-flight depth grows.
+
+    python benchmarks/bench_pipeline.py --blocks 15 --latency 5
+    python benchmarks/bench_pipeline.py --latency 0 --connections 4 --depths 1,4
+
+The simulator runs in its own process.  With ``--latency`` the client talks
+to it through a gateway that delays every request and response by half the
+round trip, like a network hop to a real PLC.  The pymodbus server answers
+one request per connection at a time, so the gateway forwards concurrent
+requests over a pool of upstream connections (``--device-concurrency``).
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ModBus import read_registers  # noqa: E402
+from frame import SampleFrame  # noqa: E402
+from pipeline import MBAP, PipelinedModbusClient  # noqa: E402
+from points import Point, PointDecoder  # noqa: E402
+from read_plan import MAX_REGISTERS_PER_REQUEST, compile_read_plan  # noqa: E402
+
+SERVER_PORT = 15020
+GATEWAY_PORT = 15021
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(MBAP.size)
+    return header + await reader.readexactly(MBAP.unpack(header)[2] - 1)
+
+
+async def _gateway(latency, upstreams):
+    pool = asyncio.Queue()
+    for _ in range(upstreams):
+        pool.put_nowait(await asyncio.open_connection("127.0.0.1", SERVER_PORT))
+
+    async def forward(frame, writer):
+        await asyncio.sleep(latency / 2)
+        reader_up, writer_up = await pool.get()
+        try:
+            writer_up.write(frame)
+            response = await _read_frame(reader_up)
+        finally:
+            pool.put_nowait((reader_up, writer_up))
+        await asyncio.sleep(latency / 2)
+        writer.write(response)
+
+    async def handle(reader, writer):
+        tasks = set()
+        try:
+            while True:
+                task = asyncio.ensure_future(forward(await _read_frame(reader), writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    await asyncio.start_server(handle, "127.0.0.1", GATEWAY_PORT)
+
+
+def serve(latency, upstreams, ready):
+    from pymodbus.datastore import (ModbusSequentialDataBlock, ModbusServerContext,
+                                    ModbusSlaveContext)
+    from pymodbus.server import StartAsyncTcpServer
+
+    async def main():
+        store = ModbusSlaveContext(ir=ModbusSequentialDataBlock(0, list(range(10000))))
+        server = asyncio.ensure_future(StartAsyncTcpServer(
+            context=ModbusServerContext(slaves=store, single=True),
+            address=("127.0.0.1", SERVER_PORT)))
+        await asyncio.sleep(0.5)
+        if latency:
+            await _gateway(latency, upstreams)
+        ready.set()
+        await server
+
+    asyncio.run(main())
+
+
+async def measure(port, decoder, depth, connections, cycles):
+    frame = SampleFrame("BENCH", {"input_register_states": decoder})
+    async with PipelinedModbusClient("127.0.0.1", port, max_in_flight=depth,
+                                     connections=connections) as client:
+        times = []
+        for i in range(cycles + 5):
+            start = time.perf_counter()
+            failed = await read_registers(client, client.read_input_registers, decoder,
+                                          frame.values["input_register_states"])
+            if i >= 5:  # warm-up cycles are not counted
+                times.append(time.perf_counter() - start)
+            if failed:
+                raise RuntimeError(f"{failed} of {decoder.plan.requests} requests failed")
+    return times
+
+
+def run(blocks, latency_ms, depths, connections, cycles, device_concurrency):
+    # Addresses far enough apart that every block is its own request
+    addresses = [block * 500 + offset for block in range(1, blocks + 1) for offset in range(10)]
+    plan = compile_read_plan(addresses, MAX_REGISTERS_PER_REQUEST)
+    decoder = PointDecoder([Point(addr) for addr in addresses], plan)
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, daemon=True,
+                                     args=(latency_ms / 1000, device_concurrency, ready))
+    server.start()
+    try:
+        if not ready.wait(10):
+            raise RuntimeError("simulator did not start")
+        port = GATEWAY_PORT if latency_ms else SERVER_PORT
+        print(f"{plan.requests} requests per cycle, {latency_ms} ms round trip, "
+              f"{connections} connection(s), {cycles} cycles")
+        print(f"{'depth':>6} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'speedup':>8}")
+        baseline = None
+        for depth in depths:
+            times = sorted(asyncio.run(measure(port, decoder, depth, connections, cycles)))
+            mean = statistics.mean(times)
+            baseline = baseline or mean
+            print(f"{depth:>6} {mean * 1e3:>9.2f} {times[len(times) // 2] * 1e3:>9.2f} "
+                  f"{times[int(len(times) * 0.95)] * 1e3:>9.2f} {baseline / mean:>7.1f}x")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=15)
+    parser.add_argument("--latency", type=float, default=5.0, help="simulated round trip in ms")
+    parser.add_argument("--depths", default="1,2,4,8,16")
+    parser.add_argument("--connections", type=int, default=1)
+    parser.add_argument("--cycles", type=int, default=100)
+    parser.add_argument("--device-concurrency", type=int, default=16)
+    args = parser.parse_args()
+    run(args.blocks, args.latency, [int(d) for d in args.depths.split(",")], args.connections,
+        args.cycles, args.device_concurrency)
@@ -0,0 +1,222 @@
+"""
+How the adaptive rate control (rate_control.py) rides out an overloaded PLC.
+
+    python benchmarks/bench_rate_control.py
+    python benchmarks/bench_rate_control.py --slowdown 20 --queue 4 --output rate.json
+
+Polls one PLC that serves a single request at a time, taking ``--service`` ms
+each and queueing at most ``--queue`` requests (further ones are dropped
+unanswered, as by a device whose buffer is full).  For ``--overload`` seconds
+in the middle of the run every request takes ``--slowdown`` times longer.
+Each address kind is read as ``--blocks`` blocks: the first holds
+high-priority points, the first half of the rest normal and the others low
+priority.
+
+The poller runs as the service does (``main.run_client_loops``), once with
+"Adaptive Rate" on and once off.  Reported per phase (before, during and
+after the overload): reads per second of a block of each priority, requests
+timed out or dropped, samples stored, missed deadlines and how far the
+controller had backed off at the end of the phase.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_cache  # noqa: E402
+from address_map import ADDRESS_COLUMNS, PRIORITIES  # noqa: E402
+from bench_fleet import write_config  # noqa: E402
+from main import run_client_loops  # noqa: E402
+from metrics import PlcMetrics  # noqa: E402
+from pipeline import MBAP, READ_REQUEST  # noqa: E402
+from simulator import BLOCK_SPACING, AddressLayout  # noqa: E402
+from write_behind import get_write_queue  # noqa: E402
+
+DEVICE_PORT = 15030
+PHASES = ("before", "during", "after")
+
+
+def block_priority(index, blocks):
+    """Priority of the ``index``-th block of an address kind."""
+    if index == 0:
+        return "high"
+    return "normal" if index <= (blocks - 1) // 2 else "low"
+
+
+class SaturatingDevice:
+    """Modbus TCP device answering reads one at a time from a bounded queue."""
+
+    def __init__(self, service, queue, blocks):
+        self.service = service
+        self.slowdown = 1.0
+        self.blocks = blocks
+        self.queue = asyncio.Queue(queue)
+        self.served = Counter()  # priority -> requests answered
+        self.dropped = 0
+        self._server = None
+        self._worker = None
+
+    async def start(self, port):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+        self._worker = asyncio.ensure_future(self._serve())
+
+    def close(self):
+        self._worker.cancel()
+        self._server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                tid, _, length, unit_id = MBAP.unpack(await reader.readexactly(MBAP.size))
+                pdu = await reader.readexactly(length - 1)
+                if self.queue.full():
+                    self.dropped += 1
+                else:
+                    self.queue.put_nowait((writer, tid, unit_id, pdu))
+        except (asyncio.IncompleteReadError, OSError):
+            writer.close()
+
+    async def _serve(self):
+        while True:
+            writer, tid, unit_id, pdu = await self.queue.get()
+            await asyncio.sleep(self.service * self.slowdown)
+            function_code, address, count = READ_REQUEST.unpack(pdu[:READ_REQUEST.size])
+            size = (count + 7) // 8 if function_code in (1, 2) else 2 * count
+            body = bytes((function_code, size)) + bytes(size)
+            if not writer.is_closing():
+                writer.write(MBAP.pack(tid, 0, len(body) + 1, unit_id) + body)
+            self.served[block_priority(address // BLOCK_SPACING, self.blocks)] += 1
+
+
+def write_priorities(directory, name, layout, blocks):
+    """Add "Priority (...)" columns to the PLC's sheet."""
+    import pandas as pd
+
+    path = os.path.join(directory, "config", "saveAddress.xlsx")
+    sheet = pd.read_excel(path, sheet_name=name)
+    for kind, (column, offset) in ADDRESS_COLUMNS.items():
+        sheet[f"Priority ({kind})"] = [
+            None if addr != addr else block_priority((int(addr) - offset - 1) // BLOCK_SPACING, blocks)
+            for addr in sheet[column]]
+    with pd.ExcelWriter(path) as writer:
+        sheet.to_excel(writer, sheet_name=name, index=False)
+
+
+def _counters(device, metrics):
+    return {"time": time.perf_counter(), "served": dict(device.served), "dropped": device.dropped,
+            "timeouts": metrics.timeouts.value, "missed": metrics.missed_deadlines.value,
+            "stored": get_write_queue().stats()["enqueued"]}
+
+
+async def measure(args, name, blocks_per_priority):
+    device = SaturatingDevice(args.service / 1000, args.queue, args.blocks)
+    await device.start(args.port)
+    metrics = PlcMetrics(name)
+    poller = asyncio.ensure_future(run_client_loops())
+    phases = {}
+    try:
+        await asyncio.sleep(args.warmup)
+        for phase, seconds in zip(PHASES, (args.before, args.overload, args.after)):
+            device.slowdown = args.slowdown if phase == "during" else 1.0
+            start = _counters(device, metrics)
+            await asyncio.sleep(seconds)
+            end = _counters(device, metrics)
+            elapsed = end["time"] - start["time"]
+            phases[phase] = {
+                "block_reads_per_s": {
+                    priority: (end["served"].get(priority, 0) - start["served"].get(priority, 0))
+                    / blocks_per_priority[priority] / elapsed
+                    for priority in PRIORITIES if blocks_per_priority[priority]},
+                "timeouts": end["timeouts"] - start["timeouts"],
+                "dropped": end["dropped"] - start["dropped"],
+                "stored_samples_per_s": (end["stored"] - start["stored"]) / elapsed,
+                "missed_deadlines": end["missed"] - start["missed"],
+                "backoff_steps": metrics.rate_level.value,
+                "in_flight_limit": metrics.in_flight_limit.value,
+            }
+    finally:
+        poller.cancel()
+        try:
+            await poller
+        except asyncio.CancelledError:
+            pass
+        device.close()
+    return phases
+
+
+def run(args):
+    layout = AddressLayout(args.coils, args.inputs, args.registers, args.holding, blocks=args.blocks)
+    blocks_per_priority = Counter()
+    for kind, addresses in layout.addresses.items():
+        for index in {(addr - 1) // BLOCK_SPACING for addr in addresses}:
+            blocks_per_priority[block_priority(index, args.blocks)] += 1
+
+    cwd = os.getcwd()
+    results = {}
+    for adaptive in (True, False):
+        with tempfile.TemporaryDirectory(prefix="bench_rate_") as directory:
+            options = {"Max In Flight": args.max_in_flight, "Adaptive Rate": int(adaptive)}
+            name, = write_config(directory, 1, [args.port], layout, args.interval, options)
+            write_priorities(directory, name, layout, args.blocks)
+            os.chdir(directory)  # config/ and modbus_data/ are relative to the working directory
+            try:
+                config_cache.invalidate()
+                results["adaptive" if adaptive else "fixed"] = asyncio.run(
+                    measure(args, name, blocks_per_priority))
+            finally:
+                os.chdir(cwd)
+    return {
+        "benchmark": "rate_control",
+        "timestamp": time.time(),
+        "config": {"interval_ms": args.interval, "service_ms": args.service, "queue": args.queue,
+                   "slowdown": args.slowdown, "max_in_flight": args.max_in_flight,
+                   "blocks_per_kind": args.blocks, "blocks": dict(blocks_per_priority),
+                   "phases_s": [args.before, args.overload, args.after]},
+        **results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=DEVICE_PORT)
+    parser.add_argument("--coils", type=int, default=64)
+    parser.add_argument("--inputs", type=int, default=64)
+    parser.add_argument("--registers", type=int, default=100)
+    parser.add_argument("--holding", type=int, default=50)
+    parser.add_argument("--blocks", type=int, default=5, help="blocks per address kind")
+    parser.add_argument("--interval", type=float, default=200, help="sampling interval in ms")
+    parser.add_argument("--service", type=float, default=2.0, help="ms the device takes per request")
+    parser.add_argument("--queue", type=int, default=16, help="requests the device can queue")
+    parser.add_argument("--slowdown", type=float, default=10.0,
+                        help="service time multiple during the overload")
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds")
+    parser.add_argument("--before", type=float, default=10.0, help="seconds")
+    parser.add_argument("--overload", type=float, default=20.0, help="seconds")
+    parser.add_argument("--after", type=float, default=30.0, help="seconds")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--log-level", default="ERROR", help="poller log level during the run")
+    args = parser.parse_args()
+
+    logging.getLogger("ModbusClient").setLevel(args.log_level.upper())
+    results = run(args)
+    for mode in ("adaptive", "fixed"):
+        for phase, result in results[mode].items():
+            reads = "  ".join(f"{priority} {rate:.1f}"
+                              for priority, rate in result["block_reads_per_s"].items())
+            print(f"{mode:8} {phase:6} block reads/s {reads}; {result['timeouts']} timeouts, "
+                  f"{result['dropped']} dropped, {result['missed_deadlines']} missed deadlines, "
+                  f"{result['backoff_steps']:g} steps back", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,255 @@
+"""
+Request throughput of the read-only Modbus server (modbus_server.py).
+
+    python benchmarks/bench_server.py --plcs 10 --clients 4 --duration 10
+    python benchmarks/bench_server.py --float32 50 --depth 8 --output server.json
+
+Publishes synthetic samples of ``--plcs`` PLCs into live tables every
+``--interval`` ms, exactly as the poller does, starts the server in its own
+process and loads it from ``--clients`` client processes, each keeping
+``--depth`` requests in flight.  Every client reads each address kind of a
+random PLC (one full-sheet request per kind, plus the status block) and
+checks the served values against the published ones.
+
+Reported: requests answered per second, request latency percentiles,
+exception responses, mismatched values and the value age the status block
+reported.  Clients and server share the machine, so the request rate is a
+lower bound.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_fleet import write_config  # noqa: E402
+from live_table import LiveTableWriter  # noqa: E402
+from modbus_server import STATUS_ADDRESS, start_server_process  # noqa: E402
+from simulator import AddressLayout  # noqa: E402
+
+PERCENTILES = (50, 90, 99)
+DEFAULT_SERVER_PORT = 15020
+
+
+class _Frame:
+    """Just what LiveTableWriter.publish reads from a SampleFrame."""
+
+    def __init__(self, addresses):
+        self.timestamp = 0.0
+        self.values = {register_type: np.zeros(len(addrs)) for register_type, addrs in addresses.items()}
+        self.received = dict.fromkeys(addresses, True)
+
+
+def layout_addresses(layout):
+    """Live table addresses of an AddressLayout, by register type."""
+    return {
+        "coil_states": layout.addresses["Coils"],
+        "input_status_states": layout.addresses["Input Bits"],
+        "input_register_states": layout.addresses["Analog Inputs"],
+        "holding_register_states": layout.addresses["Holding Registers"] + layout.float32,
+    }
+
+
+def expected_value(register_type, seq, index, typed):
+    """Deterministic value of a point in sample ``seq``, exact in its data type."""
+    if register_type in ("coil_states", "input_status_states"):
+        return (seq + index) & 1
+    if typed:
+        return ((seq * 7 + index) % 1000) * 0.25
+    return (seq * 31 + index) & 0xFFFF
+
+
+class Publisher(threading.Thread):
+    """Publishes a new sample of every PLC every ``interval`` seconds."""
+
+    def __init__(self, names, layout, interval):
+        super().__init__(name="publisher", daemon=True)
+        self.addresses = layout_addresses(layout)
+        self.typed = len(layout.addresses["Holding Registers"])
+        self.writers = [LiveTableWriter(name, self.addresses) for name in names]
+        self.frames = [_Frame(self.addresses) for _ in names]
+        self.interval = interval
+        self.seq = 0
+        self._stop_event = threading.Event()
+
+    def publish(self):
+        self.seq += 1
+        for writer, frame in zip(self.writers, self.frames):
+            for register_type, values in frame.values.items():
+                for i in range(len(values)):
+                    typed = register_type == "holding_register_states" and i >= self.typed
+                    values[i] = expected_value(register_type, self.seq, i, typed)
+            frame.timestamp = time.time()
+            writer.publish(frame)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.publish()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        for writer in self.writers:
+            writer.close()
+
+
+def _read_requests(addresses, float32):
+    """(function code, start, count) reading every address of each kind (0-based)."""
+    requests = []
+    for function_code, register_type in ((1, "coil_states"), (2, "input_status_states"),
+                                         (4, "input_register_states"), (3, "holding_register_states")):
+        addrs = addresses[register_type]
+        if register_type == "holding_register_states" and float32:
+            addrs = addrs[:-len(float32)]
+        if addrs:
+            requests.append((function_code, addrs[0] - 1, len(addrs), register_type))
+    return requests
+
+
+def _check(response, register_type, count):
+    """Served values of one response are one consistent sample; False if not."""
+    if register_type in ("coil_states", "input_status_states"):
+        bits = response.bits[:count]
+        return all(bits[i] != bits[i + 1] for i in range(count - 1))
+    registers = response.registers
+    return all((registers[i + 1] - registers[i]) & 0xFFFF == 1 for i in range(count - 1))
+
+
+async def _load(port, units, requests, depth, duration, seed):
+    from pipeline import PipelinedModbusClient
+
+    rng = random.Random(seed)
+    latencies = []
+    counts = {"requests": 0, "exceptions": 0, "mismatches": 0, "errors": 0}
+    ages = []
+    async with PipelinedModbusClient("127.0.0.1", port, max_in_flight=depth) as client:
+        if not client.connected:
+            raise RuntimeError(f"cannot connect to the server on port {port}")
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                unit_id = rng.choice(units)
+                function_code, start, count, register_type = rng.choice(requests)
+                sent = time.perf_counter()
+                try:
+                    response = await client.execute(function_code, start, count, unit_id=unit_id)
+                    status = await client.execute(4, STATUS_ADDRESS, 3, unit_id=unit_id)
+                except Exception:
+                    counts["errors"] += 1
+                    continue
+                latencies.append((time.perf_counter() - sent) / 2)
+                counts["requests"] += 2
+                if response.isError() or status.isError():
+                    counts["exceptions"] += 1
+                    continue
+                if not _check(response, register_type, count):
+                    counts["mismatches"] += 1
+                ages.append(struct.unpack(">I", status.data[:4])[0])
+
+        await asyncio.gather(*(worker() for _ in range(depth)))
+    return counts, latencies, ages
+
+
+def _client_main(port, units, requests, depth, duration, seed, results):
+    results.put(asyncio.run(_load(port, units, requests, depth, duration, seed)))
+
+
+def run(args):
+    layout = AddressLayout(args.coils, args.inputs, args.registers, args.holding, args.float32)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_server_") as directory:
+        names = write_config(directory, args.plcs, [502] * args.plcs, layout, args.interval, {})
+        import pandas as pd
+
+        plc_path = os.path.join(directory, "config", "plc_data.xlsx")
+        rows = pd.read_excel(plc_path)
+        rows["Server Unit ID"] = range(1, len(rows) + 1)
+        rows.to_excel(plc_path, index=False)
+        units = list(range(1, len(names) + 1))
+
+        os.chdir(directory)  # the server loads config/ relative to the working directory
+        publisher = Publisher(names, layout, args.interval / 1000)
+        publisher.publish()
+        publisher.start()
+        server = start_server_process(args.port, "127.0.0.1")
+        try:
+            time.sleep(args.warmup)
+            requests = _read_requests(publisher.addresses, layout.float32)
+            ctx = multiprocessing.get_context("spawn")
+            results = ctx.Queue()
+            clients = [ctx.Process(target=_client_main, args=(args.port, units, requests, args.depth,
+                                                              args.duration, i, results))
+                       for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            collected = [results.get(timeout=args.duration + 60) for _ in clients]
+            for client in clients:
+                client.join()
+        finally:
+            server.terminate()
+            publisher.stop()
+            os.chdir(cwd)
+
+    counts = {key: sum(c[key] for c, _, _ in collected) for key in collected[0][0]}
+    latencies = np.concatenate([np.asarray(lat, dtype=float) for _, lat, _ in collected])
+    ages = np.concatenate([np.asarray(age, dtype=float) for _, _, age in collected])
+    return {
+        "benchmark": "server",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"plcs": args.plcs, "points_per_plc": layout.points, "float32": args.float32,
+                   "interval_ms": args.interval, "clients": args.clients, "depth": args.depth,
+                   "duration_s": args.duration},
+        "requests_per_s": counts["requests"] / args.duration,
+        "latency_ms": {f"p{p:g}": float(np.percentile(latencies, p) * 1000) if latencies.size else None
+                       for p in PERCENTILES},
+        "value_age_ms": {"mean": float(ages.mean()) if ages.size else None,
+                         "max": float(ages.max()) if ages.size else None},
+        **counts,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--plcs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT)
+    parser.add_argument("--coils", type=int, default=64)
+    parser.add_argument("--inputs", type=int, default=64)
+    parser.add_argument("--registers", type=int, default=100)
+    parser.add_argument("--holding", type=int, default=50)
+    parser.add_argument("--float32", type=int, default=0, help="float32 holding points")
+    parser.add_argument("--interval", type=float, default=100, help="publish interval in ms")
+    parser.add_argument("--clients", type=int, default=2, help="client processes")
+    parser.add_argument("--depth", type=int, default=4, help="requests in flight per client")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    logging.getLogger("ModbusClient").setLevel(logging.ERROR)
+    results = run(args)
+    print(f"{results['requests_per_s']:.0f} requests/s, latency ms "
+          + "  ".join(f"{key} {value:.2f}" for key, value in results["latency_ms"].items()
+                      if value is not None)
+          + f", {results['exceptions']} exceptions, {results['mismatches']} mismatches",
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
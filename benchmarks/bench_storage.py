@@ -0,0 +1,109 @@
+"""
+Per-sample write latency of the storage backends as history grows.
+
+    python benchmarks/bench_storage.py --rows 2000000 --points 32
+    python benchmarks/bench_storage.py --backend excel --rows 2000
+    python benchmarks/bench_storage.py --compact --rows 20000
+
+Latency is reported for a window of samples at each checkpoint, so a flat
+column means appends cost the same at row 1,000 and at row 2,000,000.
+
+``--compact`` instead records expired history in small segments that close
+mid-interval, some on an address change, rolls it up and checks that every
+address has one rollup row per interval whose min/max/mean match the raw
+samples.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history import query  # noqa: E402
+from retention import DAY, RetentionPolicy, compact  # noqa: E402
+from storage import STORAGE_BACKENDS, SegmentStorage, list_segments  # noqa: E402
+
+
+def run(backend_name, rows, points, checkpoints, window):
+    with tempfile.TemporaryDirectory() as data_dir:
+        backend = STORAGE_BACKENDS[backend_name](data_dir=data_dir)
+        addresses = list(range(1, points + 1))
+        marks = {max(window, rows * i // checkpoints) for i in range(1, checkpoints + 1)}
+        samples = [{addr: random.randint(0, 65535) for addr in addresses} for _ in range(64)]
+        window_start = None
+        ts = time.time()
+
+        print(f"{backend_name}: {rows} rows x {points} points")
+        print(f"{'rows':>12} {'us/sample':>12}")
+        for n in range(1, rows + 1):
+            if n + window - 1 in marks:
+                window_start = time.perf_counter()
+            backend.append("BENCH", "input_register_states", ts + n, samples[n % 64])
+            if n in marks:
+                elapsed = time.perf_counter() - window_start
+                print(f"{n:>12} {elapsed / window * 1e6:>12.1f}")
+        backend.close()
+
+
+def run_compact(rows, points, interval=60, step=7.0, max_bytes=16 * 1024):
+    register_type = "input_register_states"
+    with tempfile.TemporaryDirectory() as data_dir:
+        storage = SegmentStorage(data_dir=data_dir, max_bytes=max_bytes)
+        addresses = list(range(1, points + 1))
+        start = (time.time() // DAY - 10) * DAY
+        raw = {address: {} for address in addresses}  # address -> bucket -> values
+        for n in range(rows):
+            ts = start + n * step
+            # Drop the last address for a while, so segments also close on address changes
+            recorded = addresses[:-1] if (n // 500) % 3 == 1 else addresses
+            sample = {address: random.randint(0, 65535) for address in recorded}
+            storage.append("BENCH", register_type, ts, sample)
+            for address, value in sample.items():
+                raw[address].setdefault(ts // interval * interval, []).append(value)
+        # A later sample in a segment of its own, kept raw as the newest one
+        storage.append("BENCH", register_type, start + 2 * DAY, dict.fromkeys(addresses, 0))
+        storage.close()
+        segments = len(list_segments("BENCH", register_type, data_dir))
+
+        began = time.perf_counter()
+        rolled, _ = compact("BENCH", RetentionPolicy(raw_days=1, aggregate_interval=interval), data_dir)
+        elapsed = time.perf_counter() - began
+
+        counts = {"rows": 0, "duplicates": 0, "missing": 0, "mismatches": 0}
+        for address in addresses:
+            expected = raw[address]
+            for stat, reduce in (("min", min), ("max", max), ("mean", np.mean)):
+                times, values = query("BENCH", register_type, address, data_dir=data_dir,
+                                      aggregate=stat)
+                counts["duplicates"] += len(times) - len(np.unique(times))
+                got = dict(zip(times.tolist(), values.tolist()))
+                counts["missing"] += len(expected.keys() - got.keys())
+                counts["mismatches"] += sum(1 for bucket, value in got.items()
+                                            if bucket not in expected
+                                            or abs(value - reduce(expected[bucket])) > 1e-6)
+                counts["rows"] += len(got)
+        print(f"compact: {rolled}/{segments - 1} segments rolled up in {elapsed:.2f}s, "
+              f"{counts['rows']} rollup values, {counts['duplicates']} duplicate intervals, "
+              f"{counts['missing']} missing, {counts['mismatches']} mismatches")
+        return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=sorted(STORAGE_BACKENDS), default="segment")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--points", type=int, default=32)
+    parser.add_argument("--checkpoints", type=int, default=10)
+    parser.add_argument("--window", type=int, default=1000)
+    parser.add_argument("--compact", action="store_true",
+                        help="check rollups of segments split inside an interval instead")
+    args = parser.parse_args()
+    if args.compact:
+        counts = run_compact(args.rows, args.points)
+        sys.exit(1 if counts["duplicates"] or counts["missing"] or counts["mismatches"] else 0)
+    run(args.backend, args.rows, args.points, args.checkpoints, min(args.window, args.rows))
@@ -0,0 +1,325 @@
+"""
+Fleet of local pymodbus TCP servers standing in for PLCs.
+
+    python benchmarks/simulator.py --plcs 10 --port 15100 --latency 5 --error-rate 0.01
+    python benchmarks/simulator.py --plcs 2 --units 30 --latency 10
+
+Every simulator listens on its own localhost port (``port``, ``port + 1``,
+...) and serves the addresses of an ``AddressLayout``: coils, discrete
+inputs, input and holding registers spread over a number of blocks, plus
+optional float32 holding points.  Each read can be delayed (``latency`` plus
+up to ``jitter`` seconds) and fail with a Modbus exception response with
+probability ``error_rate``.  With ``units`` > 1 a port acts as a Modbus
+TCP gateway to that many devices (unit IDs 1..units) on one serial bus: they
+answer one request at a time between them.  A fraction of the values changes every
+``update_interval`` so change filters and storage see realistic traffic.
+
+The pymodbus server answers one request per connection at a time, so
+against the simulators keep "Max In Flight" at 1 and use "Connections" for
+concurrency.  The fleet runs in a background thread of the calling process
+(``SimulatorFleet``) or in a child process of its own (``FleetProcess``).
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from address_map import ADDRESS_COLUMNS  # noqa: E402
+
+BASE_PORT = 15100
+BLOCK_SPACING = 500  # addresses between the starts of two blocks
+FLOAT32_START = 5001  # float32 holding points start at 45001
+UPDATE_INTERVAL = 0.1  # seconds
+UPDATE_FRACTION = 0.1  # of the values changed every update
+
+# Address kind -> pymodbus datastore
+DATASTORES = {"Coils": "co", "Input Bits": "di", "Analog Inputs": "ir", "Holding Registers": "hr"}
+BIT_KINDS = ("Coils", "Input Bits")
+
+
+def _spread(count, blocks):
+    """``count`` addresses (without reference offset) split over ``blocks`` runs."""
+    blocks = max(1, min(blocks, count or 1))
+    per_block, extra = divmod(count, blocks)
+    if per_block + (extra > 0) > BLOCK_SPACING:
+        raise ValueError(f"{count} addresses do not fit in {blocks} block(s) "
+                         f"of {BLOCK_SPACING}")
+    addresses = []
+    for block in range(blocks):
+        start = block * BLOCK_SPACING + 1
+        addresses.extend(range(start, start + per_block + (block < extra)))
+    if addresses and addresses[-1] >= FLOAT32_START:
+        raise ValueError(f"too many blocks; addresses must stay below {FLOAT32_START}")
+    return addresses
+
+
+class AddressLayout:
+    """The addresses every simulated PLC serves and the poller reads."""
+
+    def __init__(self, coils=64, inputs=64, registers=100, holding=50, float32=0, blocks=1):
+        counts = {"Coils": coils, "Input Bits": inputs, "Analog Inputs": registers,
+                  "Holding Registers": holding}
+        # Address kind -> addresses without the Modbus reference offset
+        self.addresses = {kind: _spread(count, blocks) for kind, count in counts.items()}
+        self.float32 = [FLOAT32_START + 2 * i for i in range(float32)]
+
+    @property
+    def points(self):
+        """Values read per poll cycle."""
+        return sum(len(addresses) for addresses in self.addresses.values()) + len(self.float32)
+
+    def sheet(self):
+        """The PLC's sheet of config/saveAddress.xlsx, as a DataFrame."""
+        import pandas as pd
+
+        columns = {}
+        for kind, (column, offset) in ADDRESS_COLUMNS.items():
+            addresses = self.addresses[kind]
+            if kind == "Holding Registers" and self.float32:
+                addresses = addresses + self.float32
+                columns[f"Data Type ({kind})"] = pd.Series(
+                    ["uint16"] * len(self.addresses[kind]) + ["float32"] * len(self.float32))
+            columns[column] = pd.Series([addr + offset for addr in addresses], dtype="Int64")
+        return pd.DataFrame(columns)
+
+
+class SimulatedFault(Exception):
+    """Raised by the datastore to make the server answer with an exception response."""
+
+
+def _datastore(layout, rng):
+    from pymodbus.datastore import ModbusSequentialDataBlock
+
+    stores = {}
+    for kind, name in DATASTORES.items():
+        addresses = layout.addresses[kind] + (layout.float32 if kind == "Holding Registers" else [])
+        size = (max(addresses) + 2) if addresses else 2
+        if kind in BIT_KINDS:
+            values = [rng.randint(0, 1) for _ in range(size)]
+        else:
+            values = [rng.randint(0, 65535) for _ in range(size)]
+        if kind == "Holding Registers":
+            for i, addr in enumerate(layout.float32):
+                values[addr:addr + 2] = struct.unpack(">HH", struct.pack(">f", i * 1.5))
+        stores[name] = ModbusSequentialDataBlock(0, values)
+    return stores
+
+
+def _device_class():
+    from pymodbus.datastore import ModbusSlaveContext
+
+    class SimulatedDevice(ModbusSlaveContext):
+        """Slave context that delays reads and fails some of them on purpose."""
+
+        def __init__(self, layout, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+            self.random = random.Random(seed)
+            super().__init__(**_datastore(layout, self.random))
+            self.layout = layout
+            self.latency = latency
+            self.jitter = jitter
+            self.error_rate = error_rate
+            self.requests = 0
+            self.errors = 0
+            self.bus = None  # lock shared by the devices behind one gateway
+            # (datastore, indices changed by updates); float32 points only
+            # change their low word so they stay ordinary numbers
+            self._mutable = []
+            for kind, name in DATASTORES.items():
+                indices = list(layout.addresses[kind])
+                if kind == "Holding Registers":
+                    indices += [addr + 1 for addr in layout.float32]
+                if indices:
+                    self._mutable.append((self.store[name[0]], indices, kind in BIT_KINDS))
+
+        async def async_getValues(self, fc_as_hex, address, count=1):
+            if self.bus is None:
+                return await self._get_values(fc_as_hex, address, count)
+            async with self.bus:
+                return await self._get_values(fc_as_hex, address, count)
+
+        async def _get_values(self, fc_as_hex, address, count):
+            self.requests += 1
+            delay = self.latency + self.jitter * self.random.random()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                raise SimulatedFault(f"injected fault at address {address}")
+            return self.getValues(fc_as_hex, address, count)
+
+        def update(self, fraction):
+            """Change a random ``fraction`` of the served values."""
+            for block, indices, bits in self._mutable:
+                values = block.values
+                for index in self.random.sample(indices, max(1, int(len(indices) * fraction))):
+                    values[index] = 1 - values[index] if bits else (values[index] + 1) & 0xFFFF
+
+    return SimulatedDevice
+
+
+class SimulatorFleet:
+    """
+    N simulated PLCs (or gateways of ``units`` devices each) on consecutive
+    localhost ports, served from one event loop thread.
+    """
+
+    def __init__(self, plcs, layout=None, base_port=BASE_PORT, latency=0.0, jitter=0.0,
+                 error_rate=0.0, update_interval=UPDATE_INTERVAL,
+                 update_fraction=UPDATE_FRACTION, seed=0, units=1):
+        self.layout = layout or AddressLayout()
+        self.ports = [base_port + i for i in range(plcs)]
+        self.units = max(1, units)
+        self.update_interval = update_interval
+        self.update_fraction = update_fraction
+        device_class = _device_class()
+        # Port index * units + unit index
+        self.devices = [device_class(self.layout, latency, jitter, error_rate, seed=seed + i)
+                        for i in range(plcs * self.units)]
+        self._servers = []
+        self._updater = None
+        self._loop = None
+        self._thread = None
+
+    async def _start_servers(self):
+        from pymodbus.datastore import ModbusServerContext
+        from pymodbus.server import ModbusTcpServer
+
+        for i, port in enumerate(self.ports):
+            devices = self.devices[i * self.units:(i + 1) * self.units]
+            if self.units == 1:
+                context = ModbusServerContext(slaves=devices[0], single=True)
+            else:
+                bus = asyncio.Lock()
+                for device in devices:
+                    device.bus = bus
+                context = ModbusServerContext(
+                    slaves={unit_id: device for unit_id, device in enumerate(devices, start=1)},
+                    single=False)
+            server = ModbusTcpServer(context, address=("127.0.0.1", port))
+            await server.serve_forever(background=True)
+            self._servers.append(server)
+        if self.update_interval:
+            self._updater = asyncio.ensure_future(self._update_values())
+
+    async def _update_values(self):
+        while True:
+            await asyncio.sleep(self.update_interval)
+            for device in self.devices:
+                device.update(self.update_fraction)
+
+    def start(self, timeout=10.0):
+        """Start serving in a background thread; returns once every port listens."""
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="simulator-fleet",
+                                        daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_servers(), self._loop).result(timeout)
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            if self._updater is not None:
+                self._updater.cancel()
+            for server in self._servers:
+                await server.shutdown()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop.close()
+        self._loop = None
+
+    def stats(self):
+        return {
+            "requests": sum(device.requests for device in self.devices),
+            "injected_errors": sum(device.errors for device in self.devices),
+        }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _serve(ready, stop, kwargs):
+    fleet = SimulatorFleet(**kwargs).start()
+    ready.set()
+    stop.wait()
+    fleet.stop()
+
+
+class FleetProcess:
+    """A SimulatorFleet in a child process, so it does not share the caller's CPU and memory."""
+
+    def __init__(self, plcs, layout=None, **kwargs):
+        self.layout = layout or AddressLayout()
+        self.ports = [kwargs.get("base_port", BASE_PORT) + i for i in range(plcs)]
+        self._kwargs = dict(kwargs, plcs=plcs, layout=self.layout)
+        self._stop = multiprocessing.Event()
+        self._process = None
+
+    def start(self, timeout=30.0):
+        ready = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=_serve, name="simulator-fleet", daemon=True,
+                                                args=(ready, self._stop, self._kwargs))
+        self._process.start()
+        if not ready.wait(timeout):
+            self._process.terminate()
+            raise RuntimeError("simulator fleet did not start")
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._stop.set()
+            self._process.join(10)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+
+    def stats(self):
+        return {}  # counted in the child process
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--plcs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=BASE_PORT, help="port of the first simulator")
+    parser.add_argument("--coils", type=int, default=64)
+    parser.add_argument("--inputs", type=int, default=64)
+    parser.add_argument("--registers", type=int, default=100)
+    parser.add_argument("--holding", type=int, default=50)
+    parser.add_argument("--float32", type=int, default=0)
+    parser.add_argument("--blocks", type=int, default=1, help="blocks per address kind")
+    parser.add_argument("--units", type=int, default=1, help="unit IDs served on each port")
+    parser.add_argument("--latency", type=float, default=0.0, help="ms added to every read")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many ms more")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    layout = AddressLayout(args.coils, args.inputs, args.registers, args.holding, args.float32,
+                           args.blocks)
+    fleet = SimulatorFleet(args.plcs, layout, args.port, args.latency / 1000, args.jitter / 1000,
+                           args.error_rate, units=args.units).start()
+    print(f"{args.plcs} simulators of {args.units} unit(s) on "
+          f"127.0.0.1:{fleet.ports[0]}-{fleet.ports[-1]}, {layout.points} points each; "
+          f"Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fleet.stop()
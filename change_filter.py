@@ -0,0 +1,88 @@
+"""
+Report-by-exception filtering between reading and storing samples.
+
+Coils and discrete inputs are recorded whenever any bit changes state.  Input
+registers are recorded when any value moves past the PLC's deadband ("Change
+in Data" as an absolute amount and/or "Deadband Percent" of the last recorded
+value).  A heartbeat row is recorded regardless once ``heartbeat`` seconds
+pass without one, so quiet signals still show up in the history.
+
+Samples are the value arrays of a SampleFrame; the last recorded values are
+kept in a preallocated copy per register type.
+"""
+import time
+
+import numpy as np
+
+BIT_TYPES = ("coil_states", "input_status_states")
+DEFAULT_HEARTBEAT = 60.0  # seconds
+
+
+class ChangeFilter:
+    """Decide per register type whether a new sample is worth storing."""
+
+    def __init__(self, deadband=0, deadband_percent=0, heartbeat=DEFAULT_HEARTBEAT,
+                 clock=time.monotonic):
+        self.deadband = deadband or 0
+        self.deadband_percent = deadband_percent or 0
+        self.heartbeat = heartbeat if heartbeat and heartbeat > 0 else DEFAULT_HEARTBEAT
+        self._clock = clock
+        self._last = {}       # register type -> last recorded values
+        self._last_time = {}  # register type -> when they were recorded
+        self.seen = {}
+        self.recorded = {}
+
+    def _exceeds_deadband(self, values, last):
+        delta = np.abs(np.subtract(values, last, dtype=np.float64))
+        if self.deadband and (delta > self.deadband).any():
+            return True
+        if self.deadband_percent and (delta > np.abs(last) * (self.deadband_percent / 100)).any():
+            return True
+        if not self.deadband and not self.deadband_percent:
+            return bool(delta.any())
+        return False
+
+    def should_record(self, register_type, values):
+        """Return True (and remember the sample) if the ``values`` array should be stored."""
+        if not len(values):
+            return False
+        self.seen[register_type] = self.seen.get(register_type, 0) + 1
+        now = self._clock()
+        last = self._last.get(register_type)
+
+        if last is None or last.shape != values.shape or last.dtype != values.dtype:
+            record = True
+            last = None
+        elif now - self._last_time[register_type] >= self.heartbeat:
+            record = True
+        elif register_type in BIT_TYPES:
+            record = not np.array_equal(values, last)
+        else:
+            record = self._exceeds_deadband(values, last)
+
+        if record:
+            if last is None:
+                self._last[register_type] = values.copy()
+            else:
+                np.copyto(last, values)
+            self._last_time[register_type] = now
+            self.recorded[register_type] = self.recorded.get(register_type, 0) + 1
+        return record
+
+    def stats(self):
+        return {register_type: f"{self.recorded.get(register_type, 0)}/{seen}"
+                for register_type, seen in self.seen.items()}
+
+
+def change_filter_from_config(plc):
+    """
+    Build a ChangeFilter from a plc_data.xlsx row, or None to store every
+    sample when "Change in Data", "Deadband Percent" and "Heartbeat" are all
+    blank.
+    """
+    deadband = plc.get("Change in Data")
+    deadband_percent = plc.get("Deadband Percent")
+    heartbeat = plc.get("Heartbeat")
+    if deadband is None and deadband_percent is None and heartbeat is None:
+        return None
+    return ChangeFilter(deadband=deadband, deadband_percent=deadband_percent, heartbeat=heartbeat)
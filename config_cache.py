@@ -0,0 +1,275 @@
+"""
+Compiled configuration cache.
+
+Parsing config/plc_data.xlsx and every sheet of config/saveAddress.xlsx with
+pandas and openpyxl takes seconds for a large fleet, and importing pandas
+alone costs more than starting the poller should.  ``load_config`` compiles
+both workbooks once into a validated JSON cache next to them:
+
+* the PLC rows, with numbers normalised and invalid values dropped,
+* each sheet's addresses, typed points and priorities,
+* the read plans of each PLC's sheet at that PLC's "Gap Threshold",
+* the sheet rows shown by the UI.
+
+Later loads only ``stat`` the workbooks and read the JSON while their
+modification times match those recorded in the cache; pandas is imported
+only to recompile after a workbook changed.  Within a process the loaded
+configuration is reused until the workbooks change.
+"""
+import json
+import logging
+import math
+import os
+import threading
+
+from address_map import ADDRESS_COLUMNS, REGISTER_KINDS, AddressMap, parse_sheet
+from points import Point, register_addresses
+from read_plan import (MAX_BITS_PER_REQUEST, MAX_REGISTERS_PER_REQUEST, compile_read_plan,
+                       gap_points, plan_from_blocks)
+
+logger = logging.getLogger("ModbusClient")
+
+CONFIG_DIR = "config"
+PLC_CONFIG_FILE = "plc_data.xlsx"
+SAVED_ADDRESS_FILE = "saveAddress.xlsx"
+CACHE_FILE = ".compiled_config.json"
+CACHE_VERSION = 4
+CONFIG_CHECK_INTERVAL = 5.0  # seconds between workbook mtime checks by long-running readers
+
+# plc_data.xlsx columns holding numbers; anything else there is logged and ignored
+NUMERIC_COLUMNS = ("Port", "Unit ID", "Server Unit ID", "Sampling Frequency", "Change in Data", "Deadband Percent",
+                   "Heartbeat", "Gap Threshold", "Max In Flight", "Connections", "Adaptive Rate",
+                   "Raw Retention Days", "Aggregate Retention Days")
+
+
+def _plain(value):
+    """A workbook cell as a JSON value: NaN -> None, numpy scalars -> int/float."""
+    if value is None:
+        return None
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        return int(value) if value.is_integer() else value
+    if isinstance(value, (bool, int, str)):
+        return value.strip() if isinstance(value, str) else value
+    return str(value)
+
+
+def _validate_plcs(rows):
+    """Normalise plc_data.xlsx rows, logging and dropping what cannot be used."""
+    plcs = []
+    seen = set()
+    for number, row in enumerate(rows, start=2):  # row 1 is the header
+        row = {str(column): _plain(value) for column, value in row.items()}
+        name = row.get("PLC")
+        if name is None or name == "":
+            if any(value is not None for value in row.values()):
+                logger.error(f"plc_data.xlsx row {number}: no PLC name; row ignored")
+            continue
+        row["PLC"] = name = str(name)
+        if name in seen:
+            logger.error(f"plc_data.xlsx row {number}: duplicate PLC '{name}'; row ignored")
+            continue
+        seen.add(name)
+        for column in NUMERIC_COLUMNS:
+            value = row.get(column)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                      or value < 0):
+                logger.error(f"plc_data.xlsx row {number}: {column} of {name} must be a "
+                             f"non-negative number, not {value!r}; ignored")
+                row[column] = None
+        port = row.get("Port")
+        if port is not None and not (isinstance(port, int) and 0 < port < 65536):
+            logger.error(f"plc_data.xlsx row {number}: invalid port {port!r} for {name}")
+            row["Port"] = None
+        for column in ("Unit ID", "Server Unit ID"):
+            unit_id = row.get(column)
+            if unit_id is not None and not (isinstance(unit_id, int) and unit_id <= 255):
+                logger.error(f"plc_data.xlsx row {number}: invalid {column} {unit_id!r} for {name}; "
+                             "ignored")
+                row[column] = None
+        if row.get("IP Address") is not None:
+            row["IP Address"] = str(row["IP Address"])
+        plcs.append(row)
+    return plcs
+
+
+def kind_plan(address_map, kind, gap_threshold=None):
+    """
+    Read plan for one address kind of a sheet at a PLC's "Gap Threshold",
+    compiled on first use and kept on the AddressMap.  Points of different
+    priorities are read by separate requests.
+    """
+    bits = kind not in REGISTER_KINDS
+    gap = gap_points(gap_threshold, bits=bits)
+    plan = address_map.plans.get((kind, gap))
+    if plan is None:
+        if bits:
+            plan = compile_read_plan(address_map[kind], MAX_BITS_PER_REQUEST, gap,
+                                     address_map.read_priorities(kind))
+        else:
+            plan = compile_read_plan(register_addresses(address_map.points[kind]),
+                                     MAX_REGISTERS_PER_REQUEST, gap,
+                                     address_map.read_priorities(kind))
+        address_map.plans[(kind, gap)] = plan
+    return plan
+
+
+class CompiledConfig:
+    """PLC rows, address maps and UI rows of one pair of workbooks."""
+
+    def __init__(self, sources, plcs, address_maps, rows):
+        self.sources = sources  # {"plcs": mtime_ns, "addresses": mtime_ns}
+        self.plcs = plcs
+        self.address_maps = address_maps  # sheet name -> AddressMap
+        self.rows = rows  # sheet name -> [{column: value}]
+
+    def to_json(self):
+        return {
+            "version": CACHE_VERSION,
+            "sources": self.sources,
+            "plcs": self.plcs,
+            "sheets": {name: _map_to_json(address_map)
+                       for name, address_map in self.address_maps.items()},
+            "rows": self.rows,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        mtime = data["sources"]["addresses"]
+        address_maps = {name: _map_from_json(name, mtime, sheet)
+                        for name, sheet in data["sheets"].items()}
+        return cls(data["sources"], data["plcs"], address_maps, data["rows"])
+
+
+def _map_to_json(address_map):
+    return {
+        "addresses": {kind: addresses.tolist() for kind, addresses in address_map.addresses.items()},
+        # Only points that are not plain uint16 registers
+        "points": {kind: [point.spec for point in address_map.points[kind] if not point.raw]
+                   for kind in REGISTER_KINDS},
+        "priorities": {kind: sorted(priorities.items())
+                       for kind, priorities in address_map.priorities.items() if priorities},
+        "plans": [[kind, gap, plan.naive_requests,
+                   [[block.start, block.count] for block in plan.blocks]]
+                  for (kind, gap), plan in address_map.plans.items()],
+    }
+
+
+def _map_from_json(name, mtime, data):
+    points = {kind: [Point(*point) for point in data["points"].get(kind, ())]
+              for kind in REGISTER_KINDS}
+    address_map = AddressMap(name, mtime, data["addresses"], points, data["priorities"])
+    for kind, gap, naive_requests, blocks in data["plans"]:
+        addresses = (register_addresses(address_map.points[kind]) if kind in REGISTER_KINDS
+                     else address_map[kind])
+        address_map.plans[(kind, gap)] = plan_from_blocks(addresses, blocks, naive_requests)
+    return address_map
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def compile_config(plc_path, address_path, sources=None):
+    """Parse both workbooks with pandas into a CompiledConfig."""
+    import pandas as pd
+
+    sources = sources or {"plcs": _mtime(plc_path), "addresses": _mtime(address_path)}
+    plcs = []
+    if sources["plcs"] is not None:
+        try:
+            plcs = _validate_plcs(pd.read_excel(plc_path).to_dict("records"))
+        except Exception as e:
+            logger.error(f"Error loading PLC config: {e}")
+
+    address_maps = {}
+    rows = {}
+    if sources["addresses"] is not None:
+        try:
+            sheets = pd.read_excel(address_path, sheet_name=None)
+        except Exception as e:
+            logger.error(f"Error reading Excel file: {e}")
+            sheets = {}
+        for sheet_name, df in sheets.items():
+            address_maps[sheet_name] = parse_sheet(sheet_name, df, sources["addresses"])
+            rows[sheet_name] = [{str(column): _plain(value) for column, value in record.items()}
+                                for record in df.to_dict("records")]
+
+    # Precompute every plan the poller will ask for
+    for plc in plcs:
+        address_map = address_maps.get(plc["PLC"])
+        if address_map is not None:
+            for kind in ADDRESS_COLUMNS:
+                kind_plan(address_map, kind, plc.get("Gap Threshold"))
+    return CompiledConfig(sources, plcs, address_maps, rows)
+
+
+def _read_cache(cache_path, sources):
+    try:
+        with open(cache_path) as f:
+            data = json.load(f)
+        if data.get("version") == CACHE_VERSION and data.get("sources") == sources:
+            return CompiledConfig.from_json(data)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable config cache {cache_path}: {e}")
+    return None
+
+
+def _write_cache(cache_path, config):
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(config.to_json(), f, separators=(",", ":"))
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"Could not write config cache {cache_path}: {e}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+_loaded = {}  # (plc_path, address_path) -> CompiledConfig
+_lock = threading.Lock()
+
+
+def load_config(plc_path=None, address_path=None, cache_path=None):
+    """
+    The compiled configuration of the workbooks, from memory or the cache
+    while they are unchanged, else recompiled (and the cache rewritten).
+    """
+    address_path = address_path or os.path.join(CONFIG_DIR, SAVED_ADDRESS_FILE)
+    plc_path = plc_path or os.path.join(os.path.dirname(address_path), PLC_CONFIG_FILE)
+    cache_path = cache_path or os.path.join(os.path.dirname(address_path), CACHE_FILE)
+    key = (plc_path, address_path)
+    sources = {"plcs": _mtime(plc_path), "addresses": _mtime(address_path)}
+
+    config = _loaded.get(key)
+    if config is not None and config.sources == sources:
+        return config
+    with _lock:
+        config = _loaded.get(key)
+        if config is not None and config.sources == sources:
+            return config
+        config = _read_cache(cache_path, sources)
+        if config is None:
+            logger.info(f"Compiling configuration from {plc_path} and {address_path}")
+            config = compile_config(plc_path, address_path, sources)
+            if sources["plcs"] is not None or sources["addresses"] is not None:
+                _write_cache(cache_path, config)
+        _loaded[key] = config
+    return config
+
+
+def invalidate():
+    """Forget the configurations loaded in this process."""
+    with _lock:
+        _loaded.clear()
@@ -0,0 +1,153 @@
+"""
+Hot reload of config/plc_data.xlsx and config/saveAddress.xlsx.
+
+``ConfigWatcher`` owns one client loop task per configured PLC.  Every few
+seconds it reloads the compiled configuration (a ``stat`` of each workbook
+while nothing changed; the recompile after an edit runs in a worker thread
+so polling continues meanwhile) and applies only the difference to what is
+running:
+
+* new PLCs get a client loop, removed ones have theirs cancelled;
+* a changed endpoint ("IP Address", "Port", "Unit ID", "Max In Flight",
+  "Connections") or "Adaptive Rate" restarts that PLC's loop;
+* a changed "Sampling Frequency", deadband, "Gap Threshold" or address
+  sheet is handed to the running loop through its PollerControl and takes
+  effect between two cycles, without reconnecting;
+* retention settings are passed to the maintenance thread.
+
+PLCs whose rows and sheets did not change are not touched.
+"""
+import asyncio
+import logging
+
+from change_filter import change_filter_from_config
+from config_cache import CONFIG_CHECK_INTERVAL, load_config
+from retention import retention_policy_from_config
+
+logger = logging.getLogger("ModbusClient")
+
+
+# Columns whose change needs a new connection, hence a restarted loop
+RESTART_COLUMNS = ("IP Address", "Port", "Unit ID", "Max In Flight", "Connections",
+                   "Adaptive Rate")
+FILTER_COLUMNS = ("Change in Data", "Deadband Percent", "Heartbeat")
+RETENTION_COLUMNS = ("Raw Retention Days", "Aggregate Retention Days")
+
+
+def _changed(old, new, columns):
+    return any(old.get(column) != new.get(column) for column in columns)
+
+
+def _layout_key(config, plc_id):
+    address_map = config.address_maps.get(plc_id)
+    return address_map.layout_key() if address_map is not None else None
+
+
+class _RunningPlc:
+    __slots__ = ("row", "layout", "task", "control")
+
+    def __init__(self, row, layout, task, control):
+        self.row = row
+        self.layout = layout
+        self.task = task
+        self.control = control
+
+
+class ConfigWatcher:
+    """Keep one client loop per configured PLC in step with the workbooks."""
+
+    def __init__(self, start_plc, filter_plcs=None, maintenance=None,
+                 interval=CONFIG_CHECK_INTERVAL):
+        """
+        ``start_plc(plc, control)`` returns the client loop coroutine of a
+        plc_data.xlsx row; ``filter_plcs`` drops rows that cannot be polled.
+        """
+        self._start_plc = start_plc
+        self._filter_plcs = filter_plcs or (lambda plcs: plcs)
+        self.maintenance = maintenance
+        self.interval = interval
+        self.running = {}  # PLC name -> _RunningPlc
+        self._config = None
+
+    def _start(self, plc, layout):
+        from ModBus import PollerControl
+
+        control = PollerControl()
+        task = asyncio.ensure_future(self._start_plc(plc, control))
+        self.running[plc["PLC"]] = _RunningPlc(plc, layout, task, control)
+
+    async def _stop(self, plc_id):
+        running = self.running.pop(plc_id)
+        running.task.cancel()
+        try:
+            await running.task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Client loop for PLC {plc_id} failed while stopping: {e}")
+
+    async def apply(self, config):
+        """Start, stop, restart or update client loops to match ``config``."""
+        plcs = {plc["PLC"]: plc for plc in self._filter_plcs(config.plcs)}
+        for plc_id in [plc_id for plc_id in self.running if plc_id not in plcs]:
+            logger.info(f"PLC {plc_id} removed from the configuration; stopping its client loop")
+            await self._stop(plc_id)
+
+        for plc_id, plc in plcs.items():
+            layout = _layout_key(config, plc_id)
+            running = self.running.get(plc_id)
+            if running is None:
+                if self._config is not None:
+                    logger.info(f"PLC {plc_id} added to the configuration; starting its client loop")
+                self._start(plc, layout)
+                continue
+            old = running.row
+            if _changed(old, plc, RESTART_COLUMNS):
+                logger.info(f"PLC {plc_id} endpoint changed; restarting its client loop")
+                await self._stop(plc_id)
+                self._start(plc, layout)
+                continue
+
+            settings = {}
+            if old.get("Sampling Frequency") != plc.get("Sampling Frequency"):
+                settings["sampling_frequency"] = plc.get("Sampling Frequency")
+            if layout != running.layout or old.get("Gap Threshold") != plc.get("Gap Threshold"):
+                settings["address_map"] = config.address_maps.get(plc_id)
+                settings["gap_threshold"] = plc.get("Gap Threshold")
+            if "address_map" in settings or _changed(old, plc, FILTER_COLUMNS):
+                # Its last values refer to the old layout, so start a fresh filter
+                settings["change_filter"] = change_filter_from_config(plc)
+            if settings:
+                running.control.update(**settings)
+            running.row = plc
+            running.layout = layout
+
+        if self.maintenance is not None:
+            old_rows = self._config.plcs if self._config is not None else []
+            old_policies = {plc["PLC"]: plc for plc in old_rows}
+            if (plcs.keys() != old_policies.keys()
+                    or any(_changed(old_policies[plc_id], plc, RETENTION_COLUMNS)
+                           for plc_id, plc in plcs.items())):
+                # Replaced, not mutated: the maintenance thread may be iterating the old one
+                self.maintenance.policies = {plc_id: retention_policy_from_config(plc)
+                                             for plc_id, plc in plcs.items()}
+        self._config = config
+
+    async def run(self):
+        """Poll the configured PLCs, following workbook changes until cancelled."""
+        loop = asyncio.get_running_loop()
+        try:
+            await self.apply(load_config())
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    config = await loop.run_in_executor(None, load_config)
+                except Exception as e:
+                    logger.error(f"Error reloading the configuration: {e}")
+                    continue
+                if config is not self._config:
+                    logger.info("Configuration changed; applying it to the running PLCs")
+                    await self.apply(config)
+        finally:
+            for plc_id in list(self.running):
+                await self._stop(plc_id)
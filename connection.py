@@ -0,0 +1,67 @@
+"""
+Passive connection health tracking and reconnect backoff.
+
+The outcome of every real read updates a PLC's ``ConnectionHealth``; an
+explicit probe is only needed after a failure or when the connection has
+been idle long enough that a silent drop is possible.
+"""
+import random
+import time
+
+
+class Backoff:
+    """Exponential reconnect delay with jitter."""
+
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.1):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def reset(self):
+        self.attempts = 0
+
+
+class ConnectionHealth:
+    """Connection state of one PLC, derived from the results of its reads."""
+
+    def __init__(self, idle_timeout=30.0, clock=time.monotonic):
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self.connected = False
+        self.consecutive_failures = 0
+        self.reconnects = 0
+        self.last_success = None
+        self.last_error = None
+
+    def record_success(self):
+        if not self.connected and self.last_success is not None:
+            self.reconnects += 1
+        self.connected = True
+        self.consecutive_failures = 0
+        self.last_success = self._clock()
+
+    def record_failure(self, error=None):
+        self.connected = False
+        self.consecutive_failures += 1
+        self.last_error = str(error) if error else None
+
+    def needs_probe(self):
+        """True after a failure, before the first success, or once idle too long."""
+        if not self.connected or self.last_success is None:
+            return True
+        return self._clock() - self.last_success > self.idle_timeout
+
+    def state(self):
+        return {
+            "connected": self.connected,
+            "consecutive_failures": self.consecutive_failures,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+        }
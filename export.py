@@ -0,0 +1,369 @@
+"""
+Streaming export of recorded history to CSV, XLSX or Parquet.
+
+    python export.py PLC1 PLC2 --start 2026-09-01 --end 2026-10-01 --format csv --output exports
+    python export.py PLC2 --addresses 30012 40001 --format xlsx
+    python export.py --all --format parquet --aggregate mean --jobs 4
+
+Every PLC is written to one file, ``<output>/<plc>.<format>``: a wide table
+with a time column and one column per Modbus reference (00001 coils, 10001
+input bits, 30001 input registers, 40001 holding registers).  Its register
+types are recorded to separate segment streams (see storage.py); the export
+merges them by timestamp.  Samples of the same poll cycle share their
+timestamp and land on one row.  Register types that were not stored in a
+cycle, because their values had not changed enough, keep their previous
+values in that row (``fill=False`` leaves them empty).
+
+Nothing is loaded whole.  Each stream yields at most ``CHUNK_CELLS`` values
+at a time from a memory-mapped (or, for compressed segments, one inflated)
+segment.  The merge emits rows up to the earliest timestamp all streams have
+reached, and each chunk is written out before the next is read.  Memory stays
+flat whatever the time range:
+
+* CSV formatted a chunk at a time;
+* XLSX through openpyxl's write-only mode (a new sheet every 1,048,575 rows);
+* Parquet through pyarrow, one row group per chunk.  pyarrow is optional and
+  only needed for this format.
+
+PLCs are exported in parallel with ``jobs`` > 1.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from history import REFERENCE_RANGES, parse_reference, segments
+from storage import DATA_DIR, REGISTER_TYPES
+
+logger = logging.getLogger("ModbusClient")
+
+FORMATS = ("csv", "xlsx", "parquet")
+CHUNK_CELLS = 1_000_000  # values merged and written per chunk
+XLSX_MAX_ROWS = 1_048_575  # data rows per sheet below the header
+
+# Register type -> Modbus reference offset of its column names
+REFERENCE_OFFSETS = {register_type: offset for _, _, register_type, offset in REFERENCE_RANGES}
+
+
+class Column:
+    """One output column: a stored address and the kind of its values."""
+
+    __slots__ = ("register_type", "address", "kind")
+
+    def __init__(self, register_type, address, kind):
+        self.register_type = register_type
+        self.address = address
+        self.kind = kind  # "bit", "uint16" or "float"
+
+    @property
+    def name(self):
+        return f"{REFERENCE_OFFSETS[self.register_type] + self.address:05}"
+
+
+def _kind(typecode):
+    return {"B": "bit", "H": "uint16"}.get(typecode, "float")
+
+
+def plan_columns(plc_id, start=None, end=None, references=None, data_dir=DATA_DIR, aggregate=None):
+    """
+    Columns of a PLC's export: every address recorded in the range (or only
+    the given Modbus ``references``), by register type and address.
+    """
+    wanted = None
+    if references:
+        wanted = {parse_reference(reference) for reference in references}
+    columns = []
+    for register_type in REGISTER_TYPES:
+        kinds = {}
+        for info in segments(plc_id, register_type, start, end, data_dir, aggregate):
+            kind = _kind(info.typecode)
+            for address in info.addresses:
+                if wanted is None or (register_type, address) in wanted:
+                    # An address typed later in its history needs a float column
+                    kinds[address] = kind if kinds.get(address, kind) == kind else "float"
+        columns.extend(Column(register_type, address, kinds[address]) for address in sorted(kinds))
+    return columns
+
+
+def _type_chunks(plc_id, register_type, column_index, start, end, chunk_rows, data_dir, aggregate):
+    """
+    Yield (timestamps, output column indices, float64 values) chunks of one
+    register type, in time order, reading at most one segment at a time.
+    """
+    for info in segments(plc_id, register_type, start, end, data_dir, aggregate):
+        pairs = [(i, column_index[(register_type, address)])
+                 for i, address in enumerate(info.addresses)
+                 if (register_type, address) in column_index]
+        if not pairs:
+            continue
+        source = np.array([i for i, _ in pairs], dtype=np.intp)
+        target = np.array([j for _, j in pairs], dtype=np.intp)
+        records = info.select(start, end)
+        for i in range(0, len(records), chunk_rows):
+            part = records[i:i + chunk_rows]
+            yield (np.array(part["ts"]), target,
+                   part["values"][:, source].astype(np.float64))
+        del records
+
+
+class _Stream:
+    """Buffered chunks of one register type during the merge."""
+
+    __slots__ = ("chunks", "ts", "target", "values", "exhausted")
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.ts = None
+        self.exhausted = False
+
+    def fill(self):
+        """Make sure there are buffered rows, unless the stream has ended."""
+        while not self.exhausted and (self.ts is None or not len(self.ts)):
+            try:
+                self.ts, self.target, self.values = next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+                self.ts = None
+
+    def take(self, until):
+        """Buffered rows with timestamps <= ``until``."""
+        n = int(np.searchsorted(self.ts, until, side="right"))
+        taken = self.ts[:n], self.target, self.values[:n]
+        self.ts, self.values = self.ts[n:], self.values[n:]
+        return taken
+
+
+def merge_chunks(streams, columns, fill=True):
+    """
+    Merge per-type chunk iterators into wide (timestamps, values) chunks,
+    one row per distinct timestamp and NaN where a column has no value.
+    """
+    streams = [_Stream(chunks) for chunks in streams]
+    last = np.full(columns, np.nan)
+    while True:
+        for stream in streams:
+            stream.fill()
+        active = [stream for stream in streams if stream.ts is not None]
+        if not active:
+            return
+        # Every stream with more to come has reached at least this timestamp
+        until = min(stream.ts[-1] for stream in active)
+        parts = [stream.take(until) for stream in active]
+        times = np.unique(np.concatenate([ts for ts, _, _ in parts]))
+        out = np.full((len(times), columns), np.nan)
+        for ts, target, values in parts:
+            if len(ts):
+                out[np.searchsorted(times, ts)[:, None], target] = values
+        if fill:
+            block = np.vstack([last[None, :], out])
+            index = np.where(np.isnan(block), 0, np.arange(len(block))[:, None])
+            np.maximum.accumulate(index, axis=0, out=index)
+            block = block[index, np.arange(columns)]
+            out, last = block[1:], block[-1]
+        yield times, out
+
+
+def _local_time_strings(ts):
+    """Epoch seconds -> local "YYYY-MM-DD HH:MM:SS.fff" strings."""
+    first = datetime.fromtimestamp(ts[0]).astimezone().utcoffset()
+    if first == datetime.fromtimestamp(ts[-1]).astimezone().utcoffset():
+        local = np.round((ts + first.total_seconds()) * 1000).astype("int64").astype("datetime64[ms]")
+        return np.char.replace(np.datetime_as_string(local, unit="ms"), "T", " ")
+    # The chunk spans a daylight saving change
+    return np.array([datetime.fromtimestamp(t).isoformat(sep=" ", timespec="milliseconds")
+                     for t in ts.tolist()])
+
+
+def _cells(values, integers, missing):
+    """Values as Python objects: ints for bit and uint16 columns, ``missing`` for NaN."""
+    cells = values.astype(object)
+    if len(integers):
+        cells[:, integers] = np.nan_to_num(values[:, integers]).astype(np.int64)
+    cells[np.isnan(values)] = missing
+    return cells
+
+
+def _integer_columns(columns):
+    return np.array([j for j, column in enumerate(columns) if column.kind != "float"], dtype=np.intp)
+
+
+class CsvWriter:
+    def __init__(self, path, columns):
+        self.columns = columns
+        self._integers = _integer_columns(columns)
+        self._row = "%s," * len(columns) + "%s\n"
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._file.write(",".join(["Time"] + [column.name for column in columns]) + "\n")
+
+    def write(self, times, values):
+        # One string formatting call per chunk instead of one per cell
+        rows = np.empty((len(times), len(self.columns) + 1), dtype=object)
+        rows[:, 0] = _local_time_strings(times)
+        rows[:, 1:] = _cells(values, self._integers, "")
+        self._file.write((self._row * len(times)) % tuple(rows.ravel().tolist()))
+
+    def close(self):
+        self._file.close()
+
+
+class XlsxWriter:
+    def __init__(self, path, columns):
+        from openpyxl import Workbook
+
+        self.path = path
+        self.columns = columns
+        self._workbook = Workbook(write_only=True)
+        self._header = ["Time"] + [column.name for column in columns]
+        self._integers = _integer_columns(columns)
+        self._sheets = 0
+        self._rows = XLSX_MAX_ROWS  # start a sheet on the first write
+
+    def _new_sheet(self):
+        self._sheets += 1
+        title = "Data" if self._sheets == 1 else f"Data ({self._sheets})"
+        self._sheet = self._workbook.create_sheet(title)
+        self._sheet.append(self._header)
+        self._rows = 0
+
+    def write(self, times, values):
+        for t, row in zip(times.tolist(), _cells(values, self._integers, None).tolist()):
+            if self._rows >= XLSX_MAX_ROWS:
+                self._new_sheet()
+            self._sheet.append([datetime.fromtimestamp(t)] + row)
+            self._rows += 1
+
+    def close(self):
+        if not self._sheets:
+            self._new_sheet()
+        self._workbook.save(self.path)
+
+
+class ParquetWriter:
+    def __init__(self, path, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)") from None
+        self._pa = pa
+        self.columns = columns
+        types = {"bit": pa.uint8(), "uint16": pa.uint16(), "float": pa.float64()}
+        self._schema = pa.schema([("time", pa.timestamp("ms", tz="UTC"))]
+                                 + [(column.name, types[column.kind]) for column in columns])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, times, values):
+        pa = self._pa
+        arrays = [pa.array(np.round(times * 1000).astype("int64"), type=self._schema.field(0).type)]
+        for j, column in enumerate(self.columns):
+            field_type = self._schema.field(j + 1).type
+            col = values[:, j]
+            missing = np.isnan(col)
+            if column.kind != "float":
+                col = np.where(missing, 0, col).astype(field_type.to_pandas_dtype())
+            arrays.append(pa.array(col, type=field_type, mask=missing))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {"csv": CsvWriter, "xlsx": XlsxWriter, "parquet": ParquetWriter}
+
+
+def export_plc(plc_id, out_path, start=None, end=None, references=None, fmt=None,
+               data_dir=DATA_DIR, aggregate=None, fill=True):
+    """
+    Stream one PLC's history between ``start`` and ``end`` (epoch seconds,
+    None for open-ended) to ``out_path``; returns the number of rows written.
+    """
+    fmt = fmt or os.path.splitext(out_path)[1].lstrip(".").lower()
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    columns = plan_columns(plc_id, start, end, references, data_dir, aggregate)
+    column_index = {(column.register_type, column.address): j for j, column in enumerate(columns)}
+    chunk_rows = max(1000, CHUNK_CELLS // max(1, len(columns)))
+    streams = [_type_chunks(plc_id, register_type, column_index, start, end, chunk_rows,
+                            data_dir, aggregate)
+               for register_type in REGISTER_TYPES
+               if any(column.register_type == register_type for column in columns)]
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    writer = WRITERS[fmt](out_path, columns)
+    rows = 0
+    try:
+        for times, values in merge_chunks(streams, len(columns), fill):
+            writer.write(times, values)
+            rows += len(times)
+    finally:
+        writer.close()
+    return rows
+
+
+def _export_job(args):
+    plc_id, out_path, kwargs = args
+    started = time.perf_counter()
+    rows = export_plc(plc_id, out_path, **kwargs)
+    return plc_id, out_path, rows, time.perf_counter() - started
+
+
+def export(plcs, output="export", fmt="csv", start=None, end=None, references=None,
+           data_dir=DATA_DIR, aggregate=None, fill=True, jobs=1):
+    """
+    Export several PLCs to ``<output>/<plc>.<fmt>``; yields (plc, path, rows,
+    seconds) as each one finishes.
+    """
+    kwargs = {"start": start, "end": end, "references": references, "fmt": fmt,
+              "data_dir": data_dir, "aggregate": aggregate, "fill": fill}
+    work = [(plc_id, os.path.join(output, f"{plc_id}.{fmt}"), kwargs) for plc_id in plcs]
+    if jobs <= 1 or len(work) <= 1:
+        for job in work:
+            yield _export_job(job)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(_export_job, work)
+
+
+def _parse_time(value):
+    """Epoch seconds from epoch seconds or a local ISO date/time."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("plcs", nargs="*", help="PLC names (see --all)")
+    parser.add_argument("--all", action="store_true", help="every PLC with recorded data")
+    parser.add_argument("--start", help="local ISO date/time or epoch seconds (default: all)")
+    parser.add_argument("--end", help="local ISO date/time or epoch seconds (default: all)")
+    parser.add_argument("--addresses", nargs="+", type=int, metavar="REFERENCE",
+                        help="Modbus references to export, e.g. 30012 40001 (default: all)")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--output", default="export", help="output directory")
+    parser.add_argument("--aggregate", choices=("min", "max", "mean"),
+                        help="export the rollups kept after raw data expires")
+    parser.add_argument("--no-fill", action="store_true",
+                        help="leave values that were not stored in a cycle empty")
+    parser.add_argument("--jobs", type=int, default=1, help="PLCs exported in parallel")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    args = parser.parse_args()
+
+    plcs = args.plcs
+    if args.all:
+        plcs = sorted(name for name in os.listdir(args.data_dir)
+                      if os.path.isdir(os.path.join(args.data_dir, name)))
+    if not plcs:
+        parser.error("name the PLCs to export, or use --all")
+    for plc, path, rows, seconds in export(plcs, args.output, args.format, _parse_time(args.start),
+                                           _parse_time(args.end), args.addresses, args.data_dir,
+                                           args.aggregate, not args.no_fill, args.jobs):
+        print(f"{plc}: {rows} rows -> {path} ({seconds:.1f}s)", file=sys.stderr)
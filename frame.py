@@ -0,0 +1,36 @@
+"""
+Preallocated sample frame of one PLC.
+
+The address order of every register type is fixed once, when the read plans
+are compiled, and each cycle the decoders write the new values into the same
+NumPy arrays in place.  The frame is then handed by reference to the change
+filter, the live table and the storage queue, which copy the values straight
+into their own preallocated buffers, so a poll cycle creates no Python
+objects per point.
+"""
+import numpy as np
+
+
+def record_dtype(value_dtype, count):
+    """On-disk segment record: little-endian float64 timestamp then ``count`` values."""
+    return np.dtype([("ts", "<f8"), ("values", np.dtype(value_dtype).newbyteorder("<"), (count,))])
+
+
+class SampleFrame:
+    """Latest values of every register type of one PLC, in fixed address order."""
+
+    __slots__ = ("plc_id", "timestamp", "addresses", "values", "received")
+
+    def __init__(self, plc_id, decoders):
+        """``decoders`` maps register type -> BitDecoder/PointDecoder."""
+        self.plc_id = plc_id
+        self.timestamp = 0.0
+        self.addresses = {register_type: decoder.addresses for register_type, decoder in decoders.items()}
+        self.values = {register_type: np.zeros(len(decoder.addresses), dtype=decoder.dtype)
+                       for register_type, decoder in decoders.items()}
+        # Per register type: did any request of the last cycle succeed
+        self.received = dict.fromkeys(decoders, False)
+
+    def as_dict(self, register_type):
+        """{address: value} of one register type, for logging and debugging."""
+        return dict(zip(self.addresses[register_type], self.values[register_type].tolist()))
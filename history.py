@@ -0,0 +1,238 @@
+"""
+Time-range queries over recorded samples.
+
+Each segment is indexed by its first and last timestamp (records are appended
+in time order), so a query only opens the segments overlapping the requested
+range.  Inside a segment the records are memory-mapped and the range is found
+by binary search on the timestamp column, so only the pages holding the
+requested rows are read.  Compressed segments keep their bounds uncompressed
+and are only inflated when they overlap the range.  Optional bucketing
+reduces a long range to at most ``buckets`` min/max/mean points for trend
+charts.  Ranges older than the raw retention can be read from the rollups
+with ``aggregate="min"``, ``"max"`` or ``"mean"``.
+
+    from history import query_point
+    times, values = query_point("PLC2", 30012, start, end)
+    trend = query_point("PLC2", 30012, start, end, buckets=1000)
+"""
+import os
+import struct
+import threading
+
+import numpy as np
+
+from storage import (COMPRESSED_SUFFIX, DATA_DIR, REGISTER_TYPES, is_compressed, list_segments,
+                     read_compressed_bounds, read_segment_body, read_segment_header, record_size,
+                     segment_dir)
+
+# Modbus reference ranges -> (register type, offset subtracted to get the stored address)
+REFERENCE_RANGES = (
+    (40001, 49999, "holding_register_states", 40000),
+    (30001, 39999, "input_register_states", 30000),
+    (10001, 19999, "input_status_states", 10000),
+    (1, 9999, "coil_states", 0),
+)
+
+_TIMESTAMP = struct.Struct("<d")
+
+
+def parse_reference(reference):
+    """Map a Modbus reference such as 30012 to ("input_register_states", 12)."""
+    for low, high, register_type, offset in REFERENCE_RANGES:
+        if low <= reference <= high:
+            return register_type, reference - offset
+    raise ValueError(f"Unsupported Modbus reference: {reference}")
+
+
+class SegmentInfo:
+    """Header and time bounds of one segment file."""
+
+    __slots__ = ("path", "typecode", "addresses", "header_size", "records", "start", "end", "_key")
+
+    def __init__(self, path):
+        stat = os.stat(path)
+        self._key = (stat.st_size, stat.st_mtime_ns)
+        self.path = path
+        with open(path, "rb") as f:
+            self.typecode, self.addresses, self.header_size = read_segment_header(f)
+            if is_compressed(path):
+                self.start, self.end, self.records = read_compressed_bounds(f)
+                return
+            size = record_size(self.typecode, len(self.addresses))
+            self.records = (stat.st_size - self.header_size) // size
+            self.start = self.end = None
+            if self.records:
+                self.start = _TIMESTAMP.unpack(f.read(_TIMESTAMP.size))[0]
+                f.seek(self.header_size + (self.records - 1) * size)
+                self.end = _TIMESTAMP.unpack(f.read(_TIMESTAMP.size))[0]
+
+    def dtype(self):
+        return np.dtype([("ts", "<f8"),
+                         ("values", np.dtype(self.typecode).newbyteorder("<"), (len(self.addresses),))])
+
+    def overlaps(self, start, end):
+        if not self.records:
+            return False
+        return (start is None or self.end >= start) and (end is None or self.start <= end)
+
+    def select(self, start=None, end=None):
+        """
+        The records within [start, end]: a view of the memory-mapped segment,
+        or of the inflated body of a compressed one.
+        """
+        if is_compressed(self.path):
+            records = np.frombuffer(read_segment_body(self.path)[2], dtype=self.dtype())
+        else:
+            records = np.memmap(self.path, dtype=self.dtype(), mode="r",
+                                offset=self.header_size, shape=(self.records,))
+        ts = records["ts"]
+        lo = 0 if start is None else int(np.searchsorted(ts, start, side="left"))
+        hi = len(records) if end is None else int(np.searchsorted(ts, end, side="right"))
+        return records[lo:hi]
+
+    def read(self, column, start=None, end=None):
+        """Timestamps and values of one address column within [start, end]."""
+        chunk = self.select(start, end)
+        return np.array(chunk["ts"]), np.array(chunk["values"][:, column])
+
+
+_index = {}  # segment directory -> {path: SegmentInfo}
+_index_lock = threading.Lock()
+
+
+def segment_info(path):
+    """Cached SegmentInfo, refreshed when the file grows or changes."""
+    directory = os.path.dirname(path)
+    info = _index.get(directory, {}).get(path)
+    stat = os.stat(path)
+    if info is None or info._key != (stat.st_size, stat.st_mtime_ns):
+        info = SegmentInfo(path)
+        with _index_lock:
+            _index.setdefault(directory, {})[path] = info
+    return info
+
+
+def forget_segment(path):
+    """Drop a deleted segment from the cache."""
+    directory = os.path.dirname(path)
+    with _index_lock:
+        cached = _index.get(directory)
+        if cached is not None:
+            cached.pop(path, None)
+            if not cached:
+                del _index[directory]
+
+
+def segments(plc_id, register_type, start=None, end=None, data_dir=DATA_DIR, aggregate=None):
+    """
+    SegmentInfo of every segment overlapping [start, end], oldest first.
+    Segments compressed or deleted since they were cached are dropped from
+    the cache, so it only ever holds the files that exist.
+    """
+    paths = list_segments(plc_id, register_type, data_dir, aggregate)
+    directory = segment_dir(plc_id, register_type, data_dir, aggregate)
+    with _index_lock:
+        cached = _index.get(directory)
+        if cached is not None:
+            listed = set(paths)
+            for path in [path for path in cached if path not in listed]:
+                del cached[path]
+            if not cached:
+                del _index[directory]
+    for path in paths:
+        try:
+            info = segment_info(path)
+        except FileNotFoundError:
+            # Replaced by its compressed copy since the directory was listed
+            try:
+                info = segment_info(os.path.splitext(path)[0] + COMPRESSED_SUFFIX)
+            except FileNotFoundError:
+                continue
+        if info.overlaps(start, end):
+            yield info
+
+
+def query(plc_id, register_type, address, start=None, end=None, buckets=None, data_dir=DATA_DIR,
+          aggregate=None):
+    """
+    Recorded values of one stored address between ``start`` and ``end``
+    (epoch seconds, inclusive; None for open-ended).
+
+    Returns ``(timestamps, values)`` NumPy arrays, or with ``buckets`` the
+    dict produced by ``downsample``.  ``aggregate`` reads the per-interval
+    "min", "max" or "mean" rollups kept after raw data expires.
+    """
+    if register_type not in REGISTER_TYPES:
+        raise ValueError(f"Unknown register type: {register_type}")
+    # Typed by every segment of the address, so the type does not change with the range
+    typecodes = {"d" if aggregate else REGISTER_TYPES[register_type][0]}
+    times, values = [], []
+    for info in segments(plc_id, register_type, data_dir=data_dir, aggregate=aggregate):
+        if address not in info.addresses:
+            continue
+        typecodes.add(info.typecode)
+        if not info.overlaps(start, end):
+            continue
+        ts, vals = info.read(info.addresses.index(address), start, end)
+        if aggregate:
+            # NaN: no samples of this address in the interval (see retention.rollup)
+            kept = ~np.isnan(vals)
+            ts, vals = ts[kept], vals[kept]
+        times.append(ts)
+        values.append(vals)
+
+    dtype = np.result_type(*typecodes)
+    timestamps = np.concatenate(times) if times else np.empty(0, dtype="f8")
+    result = np.concatenate(values).astype(dtype, copy=False) if values else np.empty(0, dtype=dtype)
+    if buckets:
+        if start is None:
+            start = timestamps[0] if len(timestamps) else 0.0
+        if end is None:
+            end = timestamps[-1] if len(timestamps) else start
+        return downsample(timestamps, result, start, end, buckets)
+    return timestamps, result
+
+
+def query_point(plc_id, reference, start=None, end=None, buckets=None, data_dir=DATA_DIR,
+                aggregate=None):
+    """``query`` addressed by Modbus reference (e.g. 30012 for input register 12)."""
+    register_type, address = parse_reference(reference)
+    return query(plc_id, register_type, address, start, end, buckets, data_dir, aggregate)
+
+
+def downsample(timestamps, values, start, end, buckets):
+    """
+    Reduce sorted samples to at most ``buckets`` equal-width time buckets.
+
+    Returns a dict of arrays with one entry per non-empty bucket:
+    ``time`` (bucket start), ``min``, ``max``, ``mean`` and ``count``.
+    """
+    if end <= start:
+        end = start + 1e-6
+    edges = np.linspace(start, end, buckets + 1)
+    bounds = np.searchsorted(timestamps, edges, side="left")
+    bounds[-1] = np.searchsorted(timestamps, end, side="right")
+    counts = np.diff(bounds)
+    nonempty = counts > 0
+    starts = bounds[:-1][nonempty]
+
+    values = values.astype(np.float64, copy=False)
+    if len(starts):
+        mins = np.minimum.reduceat(values, starts)
+        maxs = np.maximum.reduceat(values, starts)
+        sums = np.add.reduceat(values, starts)
+    else:
+        mins = maxs = sums = np.empty(0)
+    # reduceat runs each group up to the next start; trim groups to their bucket
+    trailing = bounds[-1] < len(values)
+    if trailing and len(starts):
+        last = slice(starts[-1], bounds[-1])
+        mins[-1], maxs[-1], sums[-1] = values[last].min(), values[last].max(), values[last].sum()
+
+    return {
+        "time": edges[:-1][nonempty],
+        "min": mins,
+        "max": maxs,
+        "mean": sums / counts[nonempty],
+        "count": counts[nonempty],
+    }
@@ -0,0 +1,110 @@
+"""
+Push changed live values to a UI window instead of having it poll.
+
+A ``DeltaPusher`` watches the shared-memory live tables of the PLCs a window
+subscribed to.  Checking a table's sequence counter is a single 8-byte read,
+so the watcher can look often; only when a new sample has been published does
+it copy the values, diff them against what the window already shows and hand
+the changed cells to ``send``.
+"""
+import logging
+import threading
+import time
+
+from live_table import REATTACH_AFTER, open_live_table
+
+logger = logging.getLogger("ModbusClient")
+
+PUSH_POLL_INTERVAL = 0.02  # seconds between sequence counter checks
+
+
+class _Subscription:
+    __slots__ = ("table", "values", "last_change")
+
+    def __init__(self):
+        self.table = None
+        self.values = None  # values last sent to the window
+        self.last_change = time.monotonic()
+
+    def detach(self):
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+
+
+class DeltaPusher:
+    """Background thread sending {plc, seq, timestamp, cells} deltas to one window."""
+
+    def __init__(self, send, poll_interval=PUSH_POLL_INTERVAL):
+        self._send = send
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # plc_name -> _Subscription
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, plc_name):
+        """Start pushing ``plc_name``; the first delta carries every value."""
+        with self._lock:
+            self._subscriptions.setdefault(plc_name, _Subscription())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="live-push", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, plc_name):
+        with self._lock:
+            subscription = self._subscriptions.pop(plc_name, None)
+        if subscription is not None:
+            subscription.detach()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            subscriptions, self._subscriptions = self._subscriptions, {}
+        for subscription in subscriptions.values():
+            subscription.detach()
+
+    def _delta(self, plc_name, subscription):
+        now = time.monotonic()
+        if subscription.table is None:
+            subscription.table = open_live_table(plc_name)
+            if subscription.table is None:
+                return None
+            subscription.last_change = now
+        table = subscription.table
+
+        if subscription.values is not None and table.peek_seq() == table.seq:
+            if now - subscription.last_change > REATTACH_AFTER:
+                # The poller may have restarted with a new table
+                subscription.detach()
+            return None
+
+        seq, timestamp, values = table.read()
+        subscription.last_change = now
+        cells = []
+        for register_type, current in values.items():
+            previous = subscription.values.get(register_type) if subscription.values else None
+            addresses = table.addresses[register_type]
+            if previous is None or len(previous) != len(current):
+                cells.extend([register_type, addr, value] for addr, value in zip(addresses, current))
+            else:
+                cells.extend([register_type, addresses[i], current[i]]
+                             for i in range(len(current)) if current[i] != previous[i])
+        subscription.values = values
+        if not cells:
+            return None
+        return {"plc": plc_name, "seq": seq, "timestamp": timestamp, "cells": cells}
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            with self._lock:
+                subscriptions = list(self._subscriptions.items())
+            for plc_name, subscription in subscriptions:
+                try:
+                    delta = self._delta(plc_name, subscription)
+                    if delta is not None:
+                        self._send(delta)
+                except Exception as e:
+                    logger.error(f"Live push for {plc_name} failed: {e}")
+                    subscription.detach()
+                    subscription.values = None
@@ -0,0 +1,185 @@
+"""
+Shared-memory table of the latest polled values, one block per PLC.
+
+The poller owns the block and overwrites it in place after every read; the
+UI process attaches by name and reads it without touching disk.  Layout:
+
+    header    seq (uint64), timestamp (float64), coil/input/register/holding counts (4 x uint32)
+    addresses uint32 per coil, input bit, input register and holding register, in read order
+    values    uint8 per coil and input bit, float64 per register (typed points are decoded)
+
+``seq`` is odd while a write is in progress; readers retry until they see the
+same even value before and after copying (a seqlock), so a snapshot never
+mixes two samples.
+"""
+import re
+import struct
+import sys
+import time
+from array import array
+from multiprocessing import shared_memory
+
+import numpy as np
+
+LIVE_TABLE_PREFIX = "nodeport_"
+READ_RETRIES = 100
+REATTACH_AFTER = 10.0  # seconds without a new sample before a reader re-attaches
+
+_HEADER = struct.Struct("<QdIIII")
+_SEQ = struct.Struct("<Q")
+_TIMESTAMP = struct.Struct("<d")
+
+# register type -> value typecode, in layout order
+LIVE_TYPES = (
+    ("coil_states", "B"),
+    ("input_status_states", "B"),
+    ("input_register_states", "d"),
+    ("holding_register_states", "d"),
+)
+
+
+def live_table_name(plc_id):
+    return LIVE_TABLE_PREFIX + re.sub(r"[^A-Za-z0-9_]", "_", str(plc_id))
+
+
+def _layout(counts):
+    """Byte offsets of each address and value array for the given counts."""
+    offset = _HEADER.size
+    address_offsets = []
+    for count in counts:
+        address_offsets.append(offset)
+        offset += 4 * count
+    value_offsets = []
+    for (_, typecode), count in zip(LIVE_TYPES, counts):
+        itemsize = array(typecode).itemsize
+        offset += -offset % itemsize
+        value_offsets.append(offset)
+        offset += itemsize * count
+    return address_offsets, value_offsets, offset
+
+
+def _pack(typecode, values):
+    arr = array(typecode, values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack(typecode, raw):
+    arr = array(typecode)
+    arr.frombytes(raw)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+class LiveTableWriter:
+    """Owner side: creates the block and publishes samples into it."""
+
+    def __init__(self, plc_id, addresses):
+        """``addresses`` maps register type -> address sequence in publish order."""
+        self.addresses = [list(addresses.get(register_type, ())) for register_type, _ in LIVE_TYPES]
+        counts = [len(addrs) for addrs in self.addresses]
+        address_offsets, self._value_offsets, size = _layout(counts)
+        name = live_table_name(plc_id)
+
+        try:
+            # A block left behind by a poller that did not exit cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        buf = self._shm.buf
+        _HEADER.pack_into(buf, 0, 0, 0.0, *counts)
+        for offset, addrs in zip(address_offsets, self.addresses):
+            buf[offset:offset + 4 * len(addrs)] = _pack("I", addrs)
+        self._seq = 0
+        # Value arrays viewed in place, so publishing is one copy per register type
+        self._views = [(register_type, np.ndarray(count, dtype=np.dtype(typecode).newbyteorder("<"),
+                                                  buffer=buf, offset=offset))
+                       for (register_type, typecode), count, offset
+                       in zip(LIVE_TYPES, counts, self._value_offsets)]
+
+    def publish(self, frame):
+        """
+        Write a SampleFrame (addresses in the order given at creation);
+        register types that returned nothing keep their last values.
+        """
+        buf = self._shm.buf
+        self._seq += 1
+        _SEQ.pack_into(buf, 0, self._seq)
+        for register_type, view in self._views:
+            if frame.received.get(register_type):
+                np.copyto(view, frame.values[register_type], casting="unsafe")
+        _TIMESTAMP.pack_into(buf, _SEQ.size, frame.timestamp)
+        self._seq += 1
+        _SEQ.pack_into(buf, 0, self._seq)
+
+    def close(self):
+        self._views = []  # release the exported buffer before closing
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class LiveTableReader:
+    """Reader side: attaches to a PLC's block by name."""
+
+    def __init__(self, plc_id):
+        self._shm = shared_memory.SharedMemory(name=live_table_name(plc_id))
+        if sys.platform != "win32":
+            # Attaching must not make this process responsible for unlinking the block
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+
+        buf = self._shm.buf
+        counts = _HEADER.unpack_from(buf, 0)[2:]
+        address_offsets, value_offsets, _ = _layout(counts)
+        self.addresses = {
+            register_type: _unpack("I", bytes(buf[offset:offset + 4 * count])).tolist()
+            for (register_type, _), offset, count in zip(LIVE_TYPES, address_offsets, counts)
+        }
+        # address -> position in the value array, built once per attach
+        self.index = {register_type: {addr: i for i, addr in enumerate(addrs)}
+                      for register_type, addrs in self.addresses.items()}
+        self._slices = [(register_type, typecode, offset, offset + array(typecode).itemsize * count)
+                        for (register_type, typecode), offset, count
+                        in zip(LIVE_TYPES, value_offsets, counts)]
+        self.seq = 0
+
+    def peek_seq(self):
+        """Current sequence counter; differs from ``seq`` once a newer sample is published."""
+        return _SEQ.unpack_from(self._shm.buf, 0)[0]
+
+    def read(self):
+        """Return (seq, timestamp, {register type: array of values}) from one sample."""
+        buf = self._shm.buf
+        for _ in range(READ_RETRIES):
+            seq = _SEQ.unpack_from(buf, 0)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            timestamp = _TIMESTAMP.unpack_from(buf, _SEQ.size)[0]
+            raw = [(register_type, typecode, bytes(buf[start:end]))
+                   for register_type, typecode, start, end in self._slices]
+            if _SEQ.unpack_from(buf, 0)[0] == seq:
+                self.seq = seq
+                return seq, timestamp, {register_type: _unpack(typecode, data)
+                                        for register_type, typecode, data in raw}
+        raise TimeoutError("live table is being rewritten too often to read")
+
+    def close(self):
+        self._shm.close()
+
+
+def open_live_table(plc_id):
+    """Attach to a PLC's live table, or return None if its poller is not running."""
+    try:
+        return LiveTableReader(plc_id)
+    except FileNotFoundError:
+        return None
@@ -1,11 +1,17 @@
+import argparse
 import asyncio
 import logging
 import os
 import sys
 
-import numpy as np
-import pandas as pd
 from ModBus import modbus_client_loop, logger
+from change_filter import change_filter_from_config
+from config_cache import load_config
+from config_watcher import ConfigWatcher
+from metrics import metrics_port, start_metrics_server
+from modbus_server import server_port, start_server_process
+from retention import start_maintenance
+from write_behind import close_write_queue
 
 # Configure logging
 logging.basicConfig(
@@ -22,19 +28,12 @@ logging.getLogger("pymodbus").setLevel(logging.INFO)
 
 
 def load_plc_config():
-    plc_config_path = 'config\\plc_data.xlsx'
-    """Load PLC configuration data"""
+    """Load PLC configuration data (from the compiled cache while the workbook is unchanged)"""
+    plc_config_path = os.path.join('config', 'plc_data.xlsx')
     if not os.path.exists(plc_config_path):
         print(f"Error: File '{plc_config_path}' not found.")
         return []
-
-    try:
-        df = pd.read_excel(plc_config_path)
-        df.replace({np.nan: None}, inplace=True)
-        return df.to_dict('records')
-    except Exception as e:
-        print(f"Error loading PLC config: {e}")
-        return []
+    return load_config(plc_path=plc_config_path).plcs
 
 def get_plc_data():
     """Get list of available PLCs from config"""
@@ -45,29 +44,82 @@ def filter_plc_data(plc_data):
     """Filter out invalid PLC entries."""
     return [
         plc for plc in plc_data
-        if plc["IP Address"] and plc["Port"] > 0  # Only include PLCs with valid IP and port
+        if plc.get("IP Address") and plc.get("Port")  # Only include PLCs with valid IP and port
     ]
 
-async def run_plc_client(plc):
-    """Run the Modbus client loop for a single PLC."""
+async def run_plc_client(plc, control=None):
+    """Run the Modbus client loop for a single PLC (``control`` passes in config changes)."""
     try:
-        await modbus_client_loop(plc["PLC"], plc["IP Address"], plc["Port"],plc["Sampling Frequency"])
+        await modbus_client_loop(plc["PLC"], plc["IP Address"], plc["Port"], plc["Sampling Frequency"],
+                                 gap_threshold=plc.get("Gap Threshold"),
+                                 change_filter=change_filter_from_config(plc),
+                                 max_in_flight=plc.get("Max In Flight"),
+                                 connections=plc.get("Connections"),
+                                 control=control,
+                                 unit_id=plc.get("Unit ID"),
+                                 adaptive=plc.get("Adaptive Rate") != 0)
     except Exception as e:
         logger.error(f"Error running Modbus client for PLC {plc['PLC']}: {e}")
 
-async def run_client_loops():
-    """Run multiple Modbus client loops concurrently."""
-    plc_data = get_plc_data()
-    filtered_plc_data = filter_plc_data(plc_data)
-    if not filtered_plc_data:
+async def run_client_loops(plc_data=None, metrics_port=0, only=None):
+    """
+    Run multiple Modbus client loops concurrently.
+    By default all configured PLCs are polled and edits to the workbooks are
+    applied while running (see config_watcher.py); ``only``, a set of PLC
+    names such as a worker's shard, limits both to those PLCs.  An explicit
+    ``plc_data`` list is polled as given.  With a ``metrics_port`` the poller's metrics are
+    served on it while it runs.
+    """
+    def filter_plcs(rows):
+        rows = filter_plc_data(rows)
+        return rows if only is None else [plc for plc in rows if plc["PLC"] in only]
+
+    watch = plc_data is None
+    if watch:
+        plc_data = get_plc_data()
+    filtered_plc_data = filter_plcs(plc_data)
+    if not filtered_plc_data and not watch:
         print("No valid PLC data found.")
         return
 
-    # Create a list of tasks for each PLC
-    tasks = [run_plc_client(plc) for plc in filtered_plc_data]
+    # Compress, compact and expire recorded segments in the background
+    maintenance = start_maintenance(filtered_plc_data)
+    metrics_server = start_metrics_server(metrics_port) if metrics_port else None
 
-    # Run all tasks concurrently
-    await asyncio.gather(*tasks)
+    # Run all tasks concurrently; flush queued samples to disk on the way out
+    try:
+        if watch:
+            if not filtered_plc_data:
+                print("No valid PLC data found; waiting for config/plc_data.xlsx to change.")
+            await ConfigWatcher(run_plc_client, filter_plcs, maintenance).run()
+        else:
+            await asyncio.gather(*(run_plc_client(plc) for plc in filtered_plc_data))
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        maintenance.stop()
+        close_write_queue()
 
 if __name__ == "__main__":
-    asyncio.run(run_client_loops())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Poll the PLCs listed in config/plc_data.xlsx")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="shard PLCs across this many worker processes (0 = one per CPU core)")
+    parser.add_argument("--metrics-port", type=int, default=metrics_port(),
+                        help="serve metrics on http://127.0.0.1:PORT/metrics (0 = off)")
+    parser.add_argument("--server-port", type=int, default=server_port(),
+                        help="serve the latest values read-only over Modbus TCP on PORT (0 = off)")
+    args = parser.parse_args()
+
+    # A process of its own, reading the live tables of this process or of the workers
+    server = start_server_process(args.server_port)
+    try:
+        if args.workers is None:
+            asyncio.run(run_client_loops(metrics_port=args.metrics_port))
+        else:
+            from supervisor import Supervisor
+            Supervisor(filter_plc_data(get_plc_data()), workers=args.workers,
+                       metrics_port=args.metrics_port,
+                       load_plcs=lambda: filter_plc_data(get_plc_data())).run()
+    finally:
+        if server is not None:
+            server.terminate()
@@ -0,0 +1,340 @@
+"""
+In-process metrics of the poller.
+
+Counters, gauges and fixed-bucket histograms labelled per PLC, cheap enough
+to update on every request: an observation is one ``bisect`` and a couple of
+additions, with no locking and no allocation.  Values that already live
+elsewhere (write-behind queue depth, connection state) are read by
+collectors only when metrics are requested.
+
+``snapshot()`` returns everything as a JSON-friendly dict and
+``render_text()`` turns a snapshot into the Prometheus text format, which
+``MetricsServer`` serves on a local port (``/metrics``, and the snapshot as
+``/metrics.json``).  Readers run in other threads and may see a histogram
+mid-update; for monitoring that is good enough.
+"""
+import json
+import logging
+import math
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("ModbusClient")
+
+DEFAULT_METRICS_PORT = 9108  # NODEPORT_METRICS_PORT overrides; 0 disables
+METRICS_HOST = "127.0.0.1"
+PREFIX = "nodeport_"
+
+# Seconds; Modbus round trips and cycles range from sub-millisecond on a LAN
+# to the request timeout
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0)
+
+
+def metrics_port():
+    """Port of the local metrics endpoint from NODEPORT_METRICS_PORT (0 = disabled)."""
+    return int(os.environ.get("NODEPORT_METRICS_PORT", DEFAULT_METRICS_PORT))
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Counts per bucket (the last one is +Inf), plus the sum of observations."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricFamily:
+    """One metric name and its children, one per combination of label values."""
+
+    _kinds = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+    def __init__(self, name, kind, help, labels=(), buckets=LATENCY_BUCKETS):
+        if kind not in self._kinds:
+            raise ValueError(f"Unknown metric type: {kind}")
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) if kind == "histogram" else None
+        self.children = {}
+
+    def child(self, *values):
+        """The metric for these label values, created on first use."""
+        metric = self.children.get(values)
+        if metric is None:
+            if len(values) != len(self.labels):
+                raise ValueError(f"{self.name} takes labels {self.labels}")
+            metric = self.children[values] = (Histogram(self.buckets) if self.kind == "histogram"
+                                              else self._kinds[self.kind]())
+        return metric
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def snapshot(self):
+        samples = []
+        for values, metric in list(self.children.items()):
+            sample = {"labels": dict(zip(self.labels, values))}
+            if self.kind == "histogram":
+                sample.update(counts=list(metric.counts), sum=metric.sum, count=metric.count)
+            else:
+                sample["value"] = metric.value
+            samples.append(sample)
+        family = {"type": self.kind, "help": self.help, "samples": samples}
+        if self.kind == "histogram":
+            family["buckets"] = list(self.buckets)
+        return family
+
+
+class MetricsRegistry:
+    """Every metric family of the process, plus collectors run before each snapshot."""
+
+    def __init__(self):
+        self.families = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _family(self, name, kind, help, labels, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = MetricFamily(name, kind, help, labels, buckets)
+            elif family.kind != kind or family.labels != tuple(labels):
+                raise ValueError(f"Metric {name} already registered as a different {family.kind}")
+            return family
+
+    def counter(self, name, help, labels=()):
+        return self._family(PREFIX + name, "counter", help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._family(PREFIX + name, "gauge", help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._family(PREFIX + name, "histogram", help, labels, buckets)
+
+    def remove_label(self, label, value):
+        """Drop every child labelled ``label=value``, e.g. the metrics of a PLC that stopped."""
+        with self._lock:
+            families = list(self.families.values())
+        for family in families:
+            if label in family.labels:
+                index = family.labels.index(label)
+                for values in [values for values in family.children if values[index] == value]:
+                    family.remove(*values)
+
+    def add_collector(self, collector):
+        """Call ``collector(registry)`` before every snapshot, to update derived values."""
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        with self._lock:
+            families = list(self.families.values())
+        return {family.name: family.snapshot() for family in families}
+
+    def render(self):
+        return render_text(self.snapshot())
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels, *extra):
+    items = list(labels.items()) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+def render_text(snapshot):
+    """Prometheus text exposition format (version 0.0.4) of a snapshot."""
+    lines = []
+    for name, family in snapshot.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample in family["samples"]:
+            labels = sample["labels"]
+            if family["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip(family["buckets"] + [math.inf], sample["counts"]):
+                    cumulative += count
+                    le = ("le", _format_value(float(bound)))
+                    lines.append(f"{name}_bucket{_format_labels(labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(sample['sum'])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {sample['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(sample['value'])}")
+    return "\n".join(lines) + "\n"
+
+
+def merge_snapshots(snapshots, label="worker"):
+    """Combine {source: snapshot} into one, tagging every sample with its source."""
+    merged = {}
+    for source, snapshot in snapshots.items():
+        for name, family in snapshot.items():
+            target = merged.setdefault(name, {**family, "samples": []})
+            target["samples"].extend({**sample, "labels": {**sample["labels"], label: str(source)}}
+                                     for sample in family["samples"])
+    return merged
+
+
+registry = MetricsRegistry()
+
+
+class PlcMetrics:
+    """
+    The hot-path metrics of one PLC, looked up once when its loop starts;
+    ``remove`` takes them off the registry when the loop ends.
+    """
+
+    __slots__ = ("plc_id", "registry", "block_rtt", "timeouts", "read_errors", "cycle_duration",
+                 "jitter", "cycles", "missed_deadlines", "reconnects", "rate_level",
+                 "in_flight_limit", "deferred_reads", "held_blocks", "held_value_age")
+
+    def __init__(self, plc_id, registry=registry):
+        self.plc_id = plc_id
+        self.registry = registry
+        labels = ("plc",)
+        plc = str(plc_id)
+        self.block_rtt = registry.histogram(
+            "block_rtt_seconds", "Round trip time of one Modbus read request", labels).child(plc)
+        self.timeouts = registry.counter(
+            "request_timeouts_total", "Read requests that got no response in time", labels).child(plc)
+        self.read_errors = registry.counter(
+            "read_errors_total", "Read requests that failed or returned an exception", labels).child(plc)
+        self.cycle_duration = registry.histogram(
+            "cycle_duration_seconds", "Time to read, decode and queue one poll cycle", labels).child(plc)
+        self.jitter = registry.histogram(
+            "schedule_jitter_seconds", "Delay of a poll cycle behind its deadline", labels).child(plc)
+        self.cycles = registry.counter(
+            "cycles_total", "Poll cycles started", labels).child(plc)
+        self.missed_deadlines = registry.counter(
+            "missed_deadlines_total", "Sampling deadlines skipped after an overrun", labels).child(plc)
+        self.reconnects = registry.counter(
+            "reconnects_total", "Attempts to reopen the connection to the PLC", labels).child(plc)
+        self.rate_level = registry.gauge(
+            "rate_backoff_steps", "Steps the rate controller has thinned out or slowed the reads",
+            labels).child(plc)
+        self.in_flight_limit = registry.gauge(
+            "in_flight_limit", "Requests the rate controller lets the PLC have in flight",
+            labels).child(plc)
+        self.deferred_reads = registry.counter(
+            "deferred_reads_total", "Block reads put off to a later cycle by the rate controller",
+            labels).child(plc)
+        self.held_blocks = registry.gauge(
+            "held_blocks", "Read requests whose last read failed, so their points hold older values",
+            labels).child(plc)
+        self.held_value_age = registry.gauge(
+            "held_value_age_seconds", "Age of the oldest value held after a failed read",
+            labels).child(plc)
+
+    def remove(self):
+        """Stop reporting this PLC, so a removed PLC does not linger with its last values."""
+        self.registry.remove_label("plc", str(self.plc_id))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path not in ("/metrics", "/metrics.json"):
+            self.send_error(404)
+            return
+        try:
+            snapshot = self.server.snapshot()
+            if path == "/metrics":
+                body, content_type = render_text(snapshot), "text/plain; version=0.0.4"
+            else:
+                body, content_type = json.dumps(snapshot), "application/json"
+        except Exception as e:
+            logger.error(f"Error rendering metrics: {e}")
+            self.send_error(500)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes are not worth a log line
+
+
+class MetricsServer:
+    """Serves a snapshot callable as /metrics and /metrics.json from a daemon thread."""
+
+    def __init__(self, snapshot=None, port=DEFAULT_METRICS_PORT, host=METRICS_HOST):
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.snapshot = snapshot or registry.snapshot
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Metrics on http://{METRICS_HOST}:{self.port}/metrics")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def start_metrics_server(port=None, snapshot=None):
+    """Start the endpoint on ``port`` (NODEPORT_METRICS_PORT by default); None if disabled."""
+    port = metrics_port() if port is None else port
+    if not port:
+        return None
+    try:
+        return MetricsServer(snapshot, port).start()
+    except OSError as e:
+        logger.error(f"Metrics endpoint unavailable on port {port}: {e}")
+        return None
@@ -0,0 +1,396 @@
+"""
+Read-only Modbus TCP server over the latest polled values.
+
+HMIs and historians that poll the PLCs themselves add to the load on devices
+that are already busy answering the poller.  This server answers them from
+the shared-memory live tables the poller publishes (see live_table.py)
+instead, so it runs in a process of its own and never touches the polling
+path.
+
+Every PLC with a "Server Unit ID" in config/plc_data.xlsx is served under
+that unit ID, at the same addresses the poller reads from the PLC:
+
+* function codes 1-4 read coils, discrete inputs, holding and input
+  registers; anything else, writes included, is answered with an "illegal
+  function" exception;
+* typed points are encoded back into their registers (data type, byte and
+  word order, scale and offset as configured);
+* an address the poller does not read is answered with an "illegal data
+  address" exception, and a PLC that has not been sampled yet with "gateway
+  target device failed to respond";
+* input registers from 60000 report the age of the values (see
+  ``STATUS_ADDRESS``), so clients can tell stale data from a live PLC.
+
+Each PLC's values are kept as Modbus register and bit images.  They are
+refreshed from the live tables every ``REFRESH_INTERVAL``, and only for PLCs
+that published a new sample.  A request is parsed, sliced out of an image and
+answered inside ``data_received``, with no task or coroutine per request.
+
+    python modbus_server.py --port 5020
+    python main.py --server-port 5020    # alongside the poller
+"""
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from config_cache import CONFIG_CHECK_INTERVAL, load_config
+from live_table import LIVE_TYPES, REATTACH_AFTER, open_live_table
+from pipeline import (MBAP, READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS,
+                      READ_INPUT_REGISTERS, READ_REQUEST, valid_header)
+from points import Point, PointEncoder
+
+logger = logging.getLogger("ModbusClient")
+
+DEFAULT_SERVER_PORT = 0  # NODEPORT_SERVER_PORT overrides; 0 = no server
+DEFAULT_SERVER_HOST = "0.0.0.0"  # NODEPORT_SERVER_HOST overrides
+REFRESH_INTERVAL = 0.02  # seconds between live table checks
+STATS_LOG_INTERVAL = 60.0  # seconds
+
+# Input registers STATUS_ADDRESS + 0..4 of every unit:
+#   0-1  age of the values in milliseconds (uint32, 0xFFFFFFFF before the first sample)
+#   2    age in seconds (uint16, saturating)
+#   3-4  time of the last sample, Unix seconds (uint32)
+STATUS_ADDRESS = 60000
+STATUS_REGISTERS = 5
+
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+GATEWAY_TARGET_FAILED = 0x0B
+
+# Function code -> live table register type, and the most values one request may ask for
+FUNCTIONS = {
+    READ_COILS: ("coil_states", 2000),
+    READ_DISCRETE_INPUTS: ("input_status_states", 2000),
+    READ_HOLDING_REGISTERS: ("holding_register_states", 125),
+    READ_INPUT_REGISTERS: ("input_register_states", 125),
+}
+BIT_TYPES = ("coil_states", "input_status_states")
+# Live table register type -> address kind of the address map
+REGISTER_KINDS = {"input_register_states": "Analog Inputs",
+                  "holding_register_states": "Holding Registers"}
+
+_STATUS = struct.Struct(">IHI")
+
+
+def server_port():
+    """Port of the Modbus server from NODEPORT_SERVER_PORT (0 = disabled)."""
+    return int(os.environ.get("NODEPORT_SERVER_PORT", DEFAULT_SERVER_PORT))
+
+
+def server_host():
+    return os.environ.get("NODEPORT_SERVER_HOST", DEFAULT_SERVER_HOST)
+
+
+def _exception(function_code, code):
+    return bytes((function_code | 0x80, code))
+
+
+class _Table:
+    """Bit or register image of one register type, indexed by protocol address."""
+
+    __slots__ = ("values", "mapped")
+
+    def __init__(self, register_type, addresses):
+        size = max(addresses, default=-1) + 1
+        self.values = np.zeros(size, dtype=np.uint8 if register_type in BIT_TYPES else ">u2")
+        self.mapped = np.zeros(size, dtype=bool)
+        self.mapped[list(addresses)] = True
+
+    def read(self, register_type, address, count):
+        """Response data bytes, or None if any address in the range is not polled."""
+        end = address + count
+        if end > len(self.mapped) or not self.mapped[address:end].all():
+            return None
+        if register_type in BIT_TYPES:
+            return np.packbits(self.values[address:end], bitorder="little").tobytes()
+        return self.values[address:end].tobytes()
+
+
+class UnitImage:
+    """The latest values of one PLC as served under its unit ID."""
+
+    def __init__(self, plc_id, unit_id):
+        self.plc_id = plc_id
+        self.unit_id = unit_id
+        self.table = None  # LiveTableReader
+        self.tables = {}  # register type -> _Table
+        self.encoders = {}  # register type -> (positions in _Table, PointEncoder or None)
+        self.layout = None  # live table addresses the images were built for
+        self.timestamp = None  # of the last sample copied in
+        self.last_change = time.monotonic()
+        self.next_attach = 0.0
+
+    def detach(self):
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+
+    def attach(self, address_map):
+        """(Re)attach to the PLC's live table and rebuild the images if its addresses changed."""
+        self.detach()
+        self.table = open_live_table(self.plc_id)
+        self.last_change = time.monotonic()
+        if self.table is None or self.table.addresses == self.layout:
+            return
+        self.layout = self.table.addresses
+        self.tables = {}
+        self.encoders = {}
+        for register_type, _ in LIVE_TYPES:
+            # Poller addresses are 1-based; Modbus requests start at 0
+            addresses = self.layout[register_type]
+            if register_type in BIT_TYPES:
+                self.tables[register_type] = _Table(register_type, [addr - 1 for addr in addresses])
+                self.encoders[register_type] = (np.array(addresses, dtype=np.intp) - 1, None)
+                continue
+            typed = {}
+            if address_map is not None:
+                typed = {point.address: point
+                         for point in address_map.points[REGISTER_KINDS[register_type]]}
+            points = [typed.get(addr) or Point(addr) for addr in addresses]
+            registers = [addr - 1 for point in points for addr in point.registers()]
+            self.tables[register_type] = _Table(register_type, registers)
+            encoder = PointEncoder(points, {addr: addr - 1 for point in points
+                                            for addr in point.registers()})
+            self.encoders[register_type] = (None, encoder)
+        self.timestamp = None
+
+    def refresh(self):
+        """Copy in a newer sample from the live table; True if there was one."""
+        table = self.table
+        if table is None or table.peek_seq() == table.seq:
+            return False
+        _, timestamp, values = table.read()
+        if timestamp <= 0:
+            return False  # created, nothing published yet
+        for register_type, (positions, encoder) in self.encoders.items():
+            image = self.tables[register_type].values
+            if encoder is None:
+                image[positions] = np.frombuffer(values[register_type], dtype=np.uint8)
+            else:
+                encoder.encode_into(np.frombuffer(values[register_type], dtype=np.float64), image)
+        self.timestamp = timestamp
+        self.last_change = time.monotonic()
+        return True
+
+    def status(self):
+        """Data bytes of the STATUS_REGISTERS status block."""
+        if self.timestamp is None:
+            return _STATUS.pack(0xFFFFFFFF, 0xFFFF, 0)
+        age = max(0.0, time.time() - self.timestamp)
+        return _STATUS.pack(min(int(age * 1000), 0xFFFFFFFF), min(int(age), 0xFFFF),
+                            int(self.timestamp) & 0xFFFFFFFF)
+
+
+class LiveDatastore:
+    """Unit images of every served PLC, and the request handler answering from them."""
+
+    def __init__(self):
+        self.units = {}  # unit id -> UnitImage
+        self.address_maps = {}
+        self.requests = 0
+        self.exceptions = 0
+
+    def configure(self, config):
+        """Serve the PLCs of a CompiledConfig that have a "Server Unit ID"."""
+        units = {}
+        for plc in config.plcs:
+            unit_id = plc.get("Server Unit ID")
+            if unit_id is None:
+                continue
+            if unit_id in units:
+                logger.error(f"Server unit ID {unit_id} of PLC {plc['PLC']} already serves "
+                             f"PLC {units[unit_id].plc_id}; not served")
+                continue
+            image = self.units.get(unit_id)
+            if image is None or image.plc_id != plc["PLC"]:
+                image = UnitImage(plc["PLC"], unit_id)
+            elif config.address_maps.get(plc["PLC"]) is not self.address_maps.get(plc["PLC"]):
+                # Point settings may have changed; rebuild the images on the next refresh
+                image.detach()
+                image.layout = None
+                image.next_attach = 0.0
+            units[unit_id] = image
+        for unit_id, image in self.units.items():
+            if units.get(unit_id) is not image:
+                image.detach()
+        self.units = units
+        self.address_maps = config.address_maps
+        logger.info(f"Modbus server serving {len(units)} PLC(s)")
+
+    def refresh(self):
+        """Copy new samples into the images, re-attaching to recreated live tables."""
+        now = time.monotonic()
+        for image in self.units.values():
+            try:
+                if image.refresh():
+                    continue
+                # The poller recreates its table when the address map changes
+                if (image.table is None or now - image.last_change > REATTACH_AFTER) \
+                        and now >= image.next_attach:
+                    image.next_attach = now + 1.0
+                    image.attach(self.address_maps.get(image.plc_id))
+            except Exception as e:
+                logger.error(f"Error refreshing served values of PLC {image.plc_id}: {e}")
+                image.detach()
+
+    def close(self):
+        for image in self.units.values():
+            image.detach()
+
+    def respond(self, unit_id, pdu):
+        """The response PDU to a request PDU."""
+        self.requests += 1
+        function_code = pdu[0]
+        function = FUNCTIONS.get(function_code)
+        if function is None:
+            self.exceptions += 1
+            return _exception(function_code, ILLEGAL_FUNCTION)
+        register_type, limit = function
+        if len(pdu) != READ_REQUEST.size:
+            self.exceptions += 1
+            return _exception(function_code, ILLEGAL_DATA_VALUE)
+        _, address, count = READ_REQUEST.unpack(pdu)
+        if not 1 <= count <= limit:
+            self.exceptions += 1
+            return _exception(function_code, ILLEGAL_DATA_VALUE)
+        image = self.units.get(unit_id)
+        if image is None:
+            self.exceptions += 1
+            return _exception(function_code, GATEWAY_TARGET_FAILED)
+        if function_code == READ_INPUT_REGISTERS and address >= STATUS_ADDRESS:
+            start = address - STATUS_ADDRESS
+            data = image.status()[2 * start:2 * (start + count)] \
+                if start + count <= STATUS_REGISTERS else None
+        elif image.timestamp is None:
+            self.exceptions += 1
+            return _exception(function_code, GATEWAY_TARGET_FAILED)
+        else:
+            table = image.tables.get(register_type)
+            data = table.read(register_type, address, count) if table is not None else None
+        if data is None:
+            self.exceptions += 1
+            return _exception(function_code, ILLEGAL_DATA_ADDRESS)
+        return bytes((function_code, len(data))) + data
+
+
+class _ModbusProtocol(asyncio.Protocol):
+    """One client connection; requests may be pipelined."""
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        responses = []
+        while len(buffer) >= MBAP.size:
+            tid, protocol, length, unit_id = MBAP.unpack_from(buffer)
+            if not valid_header(protocol, length):
+                logger.warning("Closing Modbus server connection after an invalid frame")
+                self.transport.close()
+                return
+            end = MBAP.size - 1 + length
+            if len(buffer) < end:
+                break
+            response = self.datastore.respond(unit_id, bytes(buffer[MBAP.size:end]))
+            del buffer[:end]
+            responses.append(MBAP.pack(tid, 0, len(response) + 1, unit_id) + response)
+        if responses:
+            self.transport.write(b"".join(responses))
+
+
+class LiveModbusServer:
+    """Serves the LiveDatastore on ``host``:``port`` until cancelled."""
+
+    def __init__(self, port, host=DEFAULT_SERVER_HOST, refresh_interval=REFRESH_INTERVAL,
+                 config_interval=CONFIG_CHECK_INTERVAL):
+        self.port = port
+        self.host = host
+        self.refresh_interval = refresh_interval
+        self.config_interval = config_interval
+        self.datastore = LiveDatastore()
+        self._server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._config = await loop.run_in_executor(None, load_config)
+        self.datastore.configure(self._config)
+        self.datastore.refresh()
+        self._server = await loop.create_server(lambda: _ModbusProtocol(self.datastore),
+                                                self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Modbus server on {self.host}:{self.port}")
+        return self
+
+    async def run(self):
+        """Start (unless started) and refresh the served values until cancelled."""
+        if self._server is None:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        next_config = time.monotonic() + self.config_interval
+        next_stats_log = time.monotonic() + STATS_LOG_INTERVAL
+        try:
+            while True:
+                await asyncio.sleep(self.refresh_interval)
+                self.datastore.refresh()
+                now = time.monotonic()
+                if now >= next_config:
+                    next_config = now + self.config_interval
+                    try:
+                        config = await loop.run_in_executor(None, load_config)
+                    except Exception as e:
+                        logger.error(f"Error reloading the configuration: {e}")
+                    else:
+                        if config is not self._config:
+                            self._config = config
+                            self.datastore.configure(config)
+                if now >= next_stats_log:
+                    next_stats_log = now + STATS_LOG_INTERVAL
+                    logger.info(f"Modbus server: {self.datastore.requests} requests, "
+                                f"{self.datastore.exceptions} exception responses")
+        finally:
+            self._server.close()
+            self.datastore.close()
+
+
+def serve(port, host=DEFAULT_SERVER_HOST):
+    """Run the server until interrupted (the target of the server process)."""
+    try:
+        asyncio.run(LiveModbusServer(port, host).run())
+    except KeyboardInterrupt:
+        pass
+
+
+def start_server_process(port, host=None):
+    """
+    Run the server in a child process; None if disabled.  A plain subprocess
+    rather than multiprocessing, so it does not share the poller's resource
+    tracker, which would unlink the live tables it attaches to.
+    """
+    if not port:
+        return None
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--port", str(port),
+                             "--host", host or server_host()])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=server_port() or 5020)
+    parser.add_argument("--host", default=server_host())
+    args = parser.parse_args()
+    serve(args.port, args.host)
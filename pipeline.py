@@ -0,0 +1,408 @@
+"""
+Pipelined Modbus TCP client.
+
+pymodbus' AsyncModbusTcpClient sends one request per connection and waits for
+its response before sending the next, so a PLC read as 15 blocks pays 15 round
+trips.  Modbus TCP tags every request with a transaction ID and servers echo
+it back, which lets a client keep several requests in flight on one socket and
+match the responses as they arrive.  ``PipelinedModbusClient`` does that:
+
+* up to ``max_in_flight`` requests are outstanding per device at any time
+  (1 behaves like the sequential client, for PLCs that cannot queue requests);
+* ``connections`` > 1 spreads them over a small pool of sockets for devices
+  that serve each connection sequentially but accept several connections;
+* clients of the same IP:port share that pool, so the unit IDs behind one
+  Modbus TCP gateway (serial devices on a bridge) are polled over a single
+  connection.  A free in-flight slot goes to the unit IDs in turn, so a
+  unit read as many blocks cannot starve the others.  Each client can also
+  be held to fewer requests in flight than the pool allows
+  (``limit_in_flight``), which the rate controller does while its device
+  struggles.
+
+It mirrors the subset of the pymodbus client API the poller uses
+(``connect``, ``connected``, ``close``, ``read_coils``,
+``read_discrete_inputs``, ``read_input_registers``,
+``read_holding_registers``), and raises the pymodbus
+exception types, so callers handle errors the same way.  Given a
+``PlcMetrics`` it records the round trip time of every request and counts
+timeouts.
+"""
+import asyncio
+import logging
+import struct
+import time
+from collections import deque
+
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+logger = logging.getLogger("ModbusClient")
+
+DEFAULT_MAX_IN_FLIGHT = 1  # not every device can queue requests; raise per PLC
+DEFAULT_CONNECTIONS = 1
+DEFAULT_TIMEOUT = 3.0  # seconds to wait for one response
+DEFAULT_UNIT_ID = 1
+
+READ_COILS = 0x01
+READ_DISCRETE_INPUTS = 0x02
+READ_HOLDING_REGISTERS = 0x03
+READ_INPUT_REGISTERS = 0x04
+
+# transaction id, protocol id (0), length of what follows, unit id
+MBAP = struct.Struct(">HHHB")
+# MBAP length field: unit id plus a PDU of 1 (function code) to 253 bytes
+MIN_FRAME_LENGTH = 2
+MAX_FRAME_LENGTH = 254
+# Read request PDU: function code, starting address, count
+READ_REQUEST = struct.Struct(">BHH")
+
+# byte -> its 8 bits, least significant first (Modbus bit order)
+_BITS = [tuple(bool(byte >> i & 1) for i in range(8)) for byte in range(256)]
+
+
+class ReadResponse:
+    """
+    Read response holding the raw ``data`` bytes of the PDU: packed bits for
+    coils and discrete inputs, big-endian registers otherwise.  ``bits`` and
+    ``registers`` decode them on access.  ``rtt`` is the round trip time of
+    the request in seconds.
+    """
+
+    __slots__ = ("function_code", "data", "exception_code", "rtt")
+
+    def __init__(self, function_code, data=b"", exception_code=None):
+        self.function_code = function_code
+        self.data = data
+        self.exception_code = exception_code
+        self.rtt = None
+
+    @property
+    def bits(self):
+        bits = []
+        for byte in self.data:
+            bits.extend(_BITS[byte])
+        return bits
+
+    @property
+    def registers(self):
+        return list(struct.unpack(f">{len(self.data) // 2}H", self.data))
+
+    def isError(self):
+        return self.exception_code is not None
+
+
+def valid_header(protocol, length):
+    """Whether an MBAP header's protocol id and length can be trusted."""
+    return protocol == 0 and MIN_FRAME_LENGTH <= length <= MAX_FRAME_LENGTH
+
+
+def decode_response(function_code, payload):
+    """Split the PDU of a read response (function code already stripped)."""
+    if function_code & 0x80:
+        return ReadResponse(function_code & 0x7F, exception_code=payload[0] if payload else 0)
+    if not payload:
+        # No byte count: malformed, reported as a response without data
+        return ReadResponse(function_code)
+    return ReadResponse(function_code, data=payload[1:1 + payload[0]])
+
+
+class _Connection:
+    """One socket with its own transaction counter and reader task."""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.pending = {}  # transaction id -> future
+        self.next_tid = 0
+        self.task = None
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def open(self, host, port, timeout):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+        self.task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    def send(self, unit_id, pdu):
+        self.next_tid = self.next_tid % 0xFFFF + 1
+        while self.next_tid in self.pending:
+            self.next_tid = self.next_tid % 0xFFFF + 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_tid] = future
+        self.writer.write(MBAP.pack(self.next_tid, 0, len(pdu) + 1, unit_id) + pdu)
+        return self.next_tid, future
+
+    async def _read_loop(self):
+        error = ConnectionException("connection closed by peer")
+        try:
+            while True:
+                header = await self.reader.readexactly(MBAP.size)
+                tid, protocol, length, _ = MBAP.unpack(header)
+                if not valid_header(protocol, length):
+                    # Out of step with the stream; nothing after it can be trusted
+                    raise ModbusIOException(f"invalid frame (protocol {protocol}, length {length}); "
+                                            f"dropping the connection")
+                pdu = await self.reader.readexactly(length - 1)
+                future = self.pending.pop(tid, None)
+                if future is not None and not future.done():
+                    future.set_result(pdu)
+        except asyncio.CancelledError:
+            error = ConnectionException("connection closed")
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = ConnectionException(f"connection lost: {e}")
+        except ModbusIOException as e:
+            error = e
+        finally:
+            self.close(error)
+
+    def close(self, error=None):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error or ConnectionException("connection closed"))
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        self.task = None
+
+
+class FairSlots:
+    """
+    Semaphore handing free slots to waiting keys (unit IDs) in turn rather
+    than in arrival order.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.free = limit  # negative after shrinking, until enough slots come back
+        self._waiters = {}  # key -> deque of futures, in round-robin order
+
+    async def acquire(self, key):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # granted, then cancelled before use
+            else:
+                queue = self._waiters.get(key)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._waiters[key]
+            raise
+
+    def resize(self, limit):
+        """Change the number of slots; slots in use stay granted until released."""
+        grown = limit - self.limit
+        self.limit = limit
+        if grown < 0:
+            self.free += grown
+        for _ in range(grown):
+            self.release()
+
+    def release(self):
+        if self.free < 0:
+            self.free += 1
+            return
+        while self._waiters:
+            key = next(iter(self._waiters))
+            queue = self._waiters.pop(key)
+            future = queue.popleft()
+            if queue:
+                self._waiters[key] = queue  # back of the line
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+class ConnectionPool:
+    """The sockets to one IP:port and the in-flight slots shared by its clients."""
+
+    def __init__(self, host, port, max_in_flight, connections):
+        self.host = host
+        self.port = port
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.connections = [_Connection() for _ in range(max(1, int(connections)))]
+        self.slots = FairSlots(self.max_in_flight)
+        self.users = 0
+        self._connecting = None
+
+    @property
+    def connected(self):
+        return any(conn.connected for conn in self.connections)
+
+    @property
+    def in_flight(self):
+        return sum(len(conn.pending) for conn in self.connections)
+
+    async def connect(self, timeout):
+        # Clients of a gateway notice a drop together; open the sockets once for all of them
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open(timeout))
+        try:
+            return await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _open(self, timeout):
+        for conn in self.connections:
+            if not conn.connected:
+                try:
+                    await conn.open(self.host, self.port, timeout)
+                except (OSError, asyncio.TimeoutError):
+                    conn.close()
+        return self.connected
+
+    def close(self):
+        if self._connecting is not None:
+            self._connecting.cancel()
+            self._connecting = None
+        for conn in self.connections:
+            conn.close()
+
+
+_pools = {}  # (host, port) -> ConnectionPool
+
+
+def acquire_pool(host, port, max_in_flight=DEFAULT_MAX_IN_FLIGHT, connections=DEFAULT_CONNECTIONS):
+    """
+    The shared pool of an IP:port, created by its first client (whose
+    ``max_in_flight`` and ``connections`` it keeps; a later client asking
+    for others is warned about).
+    """
+    pool = _pools.get((host, port))
+    if pool is None:
+        pool = _pools[(host, port)] = ConnectionPool(host, port, max_in_flight, connections)
+    elif (max(1, int(max_in_flight)), max(1, int(connections))) != (pool.max_in_flight,
+                                                                     len(pool.connections)):
+        logger.warning(f"{host}:{port} is already polled with {pool.max_in_flight} request(s) in "
+                       f"flight over {len(pool.connections)} connection(s); ignoring Max In Flight "
+                       f"{max_in_flight:g} and Connections {connections:g} of another unit ID there")
+    pool.users += 1
+    return pool
+
+
+def release_pool(pool):
+    """Drop one client of ``pool``, closing its sockets after the last."""
+    pool.users -= 1
+    if pool.users <= 0:
+        pool.close()
+        if _pools.get((pool.host, pool.port)) is pool:
+            del _pools[(pool.host, pool.port)]
+
+
+class PipelinedModbusClient:
+    """
+    Modbus TCP client for one unit ID, keeping up to ``max_in_flight``
+    requests outstanding on the (possibly shared) connection pool.
+    ``limit_in_flight`` lowers that for this client alone.
+    """
+
+    def __init__(self, host, port=502, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 connections=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT, unit_id=DEFAULT_UNIT_ID,
+                 metrics=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.unit_id = DEFAULT_UNIT_ID if unit_id is None else int(unit_id)
+        self.metrics = metrics
+        self._max_in_flight = max_in_flight
+        self._connections = connections
+        self.pool = None
+        self._window = FairSlots(max(1, int(max_in_flight)))
+
+    @property
+    def max_in_flight(self):
+        return self.pool.max_in_flight if self.pool is not None else max(1, int(self._max_in_flight))
+
+    @property
+    def connected(self):
+        return self.pool is not None and self.pool.connected
+
+    @property
+    def in_flight(self):
+        return self.pool.in_flight if self.pool is not None else 0
+
+    @property
+    def in_flight_limit(self):
+        return min(self._window.limit, self.max_in_flight)
+
+    def limit_in_flight(self, limit):
+        """Keep at most ``limit`` (>= 1) of this client's requests in flight."""
+        self._window.resize(max(1, int(limit)))
+
+    async def connect(self):
+        """(Re)open every socket of the pool; True if at least one is up."""
+        if self.pool is None:
+            self.pool = acquire_pool(self.host, self.port, self._max_in_flight, self._connections)
+        return await self.pool.connect(self.timeout)
+
+    def close(self):
+        if self.pool is not None:
+            release_pool(self.pool)
+            self.pool = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def execute(self, function_code, address, count, unit_id=None):
+        """Send one read request and wait for its decoded response."""
+        pool = self.pool
+        if pool is None:
+            raise ConnectionException(f"not connected to {self.host}:{self.port}")
+        unit_id = self.unit_id if unit_id is None else unit_id
+        window = self._window
+        await window.acquire(None)
+        try:
+            await pool.slots.acquire(unit_id)
+            try:
+                live = [conn for conn in pool.connections if conn.connected]
+                if not live:
+                    raise ConnectionException(f"not connected to {self.host}:{self.port}")
+                conn = min(live, key=lambda c: len(c.pending))
+                sent = time.perf_counter()
+                tid, future = conn.send(unit_id, READ_REQUEST.pack(function_code, address, count))
+                try:
+                    pdu = await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    conn.pending.pop(tid, None)
+                    if self.metrics is not None:
+                        self.metrics.timeouts.inc()
+                    raise ModbusIOException(f"no response to transaction {tid} within "
+                                            f"{self.timeout}s")
+                rtt = time.perf_counter() - sent
+                if self.metrics is not None:
+                    self.metrics.block_rtt.observe(rtt)
+            finally:
+                pool.slots.release()
+        finally:
+            window.release()
+        response = decode_response(pdu[0], pdu[1:])
+        response.rtt = rtt
+        return response
+
+    async def read_coils(self, address, count=1):
+        return await self.execute(READ_COILS, address, count)
+
+    async def read_discrete_inputs(self, address, count=1):
+        return await self.execute(READ_DISCRETE_INPUTS, address, count)
+
+    async def read_input_registers(self, address, count=1):
+        return await self.execute(READ_INPUT_REGISTERS, address, count)
+
+    async def read_holding_registers(self, address, count=1):
+        return await self.execute(READ_HOLDING_REGISTERS, address, count)
@@ -0,0 +1,267 @@
+"""
+Typed register points and vectorized decoding of read responses.
+
+A point is a value spread over one or more consecutive 16-bit registers:
+
+    data type   int16, uint16 (default), int32, uint32, float32, float64
+    byte order  "big" (default) or "little": byte order inside each register
+    word order  "big" (default) or "little": whether the first register holds
+                the most significant word
+    scale, offset  engineering value = raw * scale + offset
+
+A ``PointDecoder`` is built once per read plan.  It precomputes, for every
+point, where its registers sit in the plan's preallocated response buffer,
+grouped by layout.  Decoding a cycle is then one gather, byte swap and
+``view`` per layout over an ``np.frombuffer`` view of the raw response bytes,
+written straight into the caller's array, instead of per-value Python.
+``BitDecoder`` does the same for the packed bits of coil and discrete input
+responses, and ``PointEncoder`` turns point values back into registers.
+"""
+import time
+
+import numpy as np
+
+# data type -> (registers, big-endian NumPy dtype)
+DATA_TYPES = {
+    "int16": (1, ">i2"),
+    "uint16": (1, ">u2"),
+    "int32": (2, ">i4"),
+    "uint32": (2, ">u4"),
+    "float32": (2, ">f4"),
+    "float64": (4, ">f8"),
+}
+DEFAULT_DATA_TYPE = "uint16"
+BYTE_ORDERS = ("big", "little")
+
+
+class Point:
+    """One typed value starting at register ``address``."""
+
+    __slots__ = ("address", "data_type", "byte_order", "word_order", "scale", "offset")
+
+    def __init__(self, address, data_type=None, byte_order=None, word_order=None,
+                 scale=None, offset=None):
+        self.address = int(address)
+        self.data_type = (data_type or DEFAULT_DATA_TYPE).strip().lower()
+        self.byte_order = (byte_order or "big").strip().lower()
+        self.word_order = (word_order or "big").strip().lower()
+        self.scale = 1.0 if scale is None else float(scale)
+        self.offset = 0.0 if offset is None else float(offset)
+        if self.data_type not in DATA_TYPES:
+            raise ValueError(f"unknown data type {data_type!r} at register {address}")
+        if self.byte_order not in BYTE_ORDERS or self.word_order not in BYTE_ORDERS:
+            raise ValueError(f"byte/word order must be 'big' or 'little' at register {address}")
+
+    @property
+    def words(self):
+        return DATA_TYPES[self.data_type][0]
+
+    @property
+    def raw(self):
+        """True for a plain unscaled 16-bit register."""
+        return self.data_type == DEFAULT_DATA_TYPE and self.scale == 1.0 and self.offset == 0.0
+
+    @property
+    def layout(self):
+        return self.data_type, self.byte_order, self.word_order
+
+    @property
+    def spec(self):
+        """Every setting of the point, as ``Point(*spec)`` arguments."""
+        return self.address, self.data_type, self.byte_order, self.word_order, self.scale, self.offset
+
+    def registers(self):
+        return range(self.address, self.address + self.words)
+
+    def __repr__(self):
+        return f"Point({self.address}, {self.data_type})"
+
+
+def register_addresses(points):
+    """Every register the points occupy, sorted, for compiling a read plan."""
+    return sorted({addr for point in points for addr in point.registers()})
+
+
+def _layout_groups(points, positions):
+    """
+    Where the registers of ``points`` sit, for decoding and encoding them
+    with one gather or scatter per layout.  ``positions`` maps a register
+    address to its index in the word array.  Returns ``(groups, scale,
+    offset)``: per layout the indices of its points, their word positions
+    (most significant word first), whether to swap the bytes of each word,
+    and the big-endian dtype; then the scales and offsets of the points,
+    None where all are 1 and 0.
+    """
+    layouts = {}
+    for i, point in enumerate(points):
+        layouts.setdefault(point.layout, []).append(
+            (i, [positions[addr] for addr in point.registers()]))
+    groups = []
+    for (data_type, byte_order, word_order), members in layouts.items():
+        index = np.array([words for _, words in members], dtype=np.intp)
+        if word_order == "little":
+            index = index[:, ::-1]
+        groups.append((np.array([i for i, _ in members], dtype=np.intp),
+                       np.ascontiguousarray(index), byte_order == "little",
+                       np.dtype(DATA_TYPES[data_type][1])))
+    scale = np.array([point.scale for point in points])
+    offset = np.array([point.offset for point in points])
+    return (groups, None if np.all(scale == 1.0) else scale,
+            None if np.all(offset == 0.0) else offset)
+
+
+def response_error(response, size):
+    """
+    Why a block's response (or the exception raised reading it) is no good,
+    or None if it carries the ``size`` data bytes expected.
+    """
+    if isinstance(response, Exception):
+        return f"no response ({response!r})"
+    if response.isError():
+        return f"exception response {getattr(response, 'exception_code', '?')}"
+    if len(response.data) != size:
+        return f"{len(response.data)} data bytes instead of {size}"
+    return None
+
+
+class ResponseBuffer:
+    """
+    Preallocated buffer receiving the raw response bytes of a plan's blocks
+    back to back.  A block that fails, or is not read in a cycle, keeps the
+    bytes of its last good response, so its points hold their previous
+    values (zero until the block first answers).  ``errors`` holds why the
+    last read of each block failed (None after a good one) and ``read_at``
+    when each last answered, for telling how old a held value is.
+    """
+
+    def __init__(self, plan, block_bytes):
+        self.plan = plan
+        self._slices = []
+        size = 0
+        for block in plan.blocks:
+            self._slices.append((size, size + block_bytes(block.count)))
+            size += block_bytes(block.count)
+        self.buffer = bytearray(size)
+        self.errors = [None] * len(self._slices)
+        self.read_at = [time.time()] * len(self._slices)
+
+    def fill(self, responses, indices=None):
+        """
+        Copy each good response into place.  With ``indices`` the responses
+        are those of these blocks only.  Returns the error of each response
+        (see ``response_error``), None for the good ones.
+        """
+        buffer = self.buffer
+        now = time.time()
+        errors = []
+        for i, response in zip(range(len(self._slices)) if indices is None else indices, responses):
+            start, end = self._slices[i]
+            error = response_error(response, end - start)
+            if error is None:
+                buffer[start:end] = response.data
+                self.read_at[i] = now
+            self.errors[i] = error
+            errors.append(error)
+        return errors
+
+    def held(self, now):
+        """(blocks whose last read failed, age in seconds of the oldest value they hold)"""
+        ages = [now - read_at for error, read_at in zip(self.errors, self.read_at)
+                if error is not None]
+        return len(ages), max(ages, default=0.0)
+
+
+class BitDecoder(ResponseBuffer):
+    """Picks coil or discrete input states out of the packed bit responses of a plan."""
+
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, addresses, plan):
+        super().__init__(plan, lambda count: (count + 7) // 8)
+        self.addresses = tuple(sorted(set(addresses)))
+        positions = {}
+        for block, (start, _) in zip(plan.blocks, self._slices):
+            for addr, offset in zip(block.addresses, block.offsets):
+                positions[addr] = 8 * start + offset
+        self._index = np.array([positions[addr] for addr in self.addresses], dtype=np.intp)
+        self._bytes = np.frombuffer(self.buffer, dtype=np.uint8)
+
+    def decode_into(self, out):
+        """Write the state (0/1) of every address, in ``addresses`` order, into ``out``."""
+        np.take(np.unpackbits(self._bytes, bitorder="little"), self._index, out=out)
+
+
+class PointDecoder(ResponseBuffer):
+    """Decodes the register responses of one read plan into point values."""
+
+    def __init__(self, points, plan):
+        super().__init__(plan, lambda count: 2 * count)
+        points = sorted(points, key=lambda point: point.address)
+        self.addresses = tuple(point.address for point in points)
+        # Plain registers stay uint16; anything typed or scaled is float64
+        self.raw = all(point.raw for point in points)
+        self.dtype = np.dtype(np.uint16 if self.raw else np.float64)
+        self._words = np.frombuffer(self.buffer, dtype=">u2")
+
+        # register address -> position in the response buffer (in registers)
+        positions = {}
+        for block, (start, _) in zip(plan.blocks, self._slices):
+            for addr, offset in zip(block.addresses, block.offsets):
+                positions[addr] = start // 2 + offset
+
+        self._groups, self._scale, self._offset = _layout_groups(points, positions)
+        self._raw_index = (np.array([positions[point.address] for point in points], dtype=np.intp)
+                           if self.raw else None)
+
+    def decode_into(self, out):
+        """Write every point value, in ``addresses`` order, into ``out``."""
+        words = self._words
+        if self.raw:
+            np.take(words, self._raw_index, out=out)
+            return
+        for members, index, swap_bytes, dtype in self._groups:
+            gathered = words[index]
+            if swap_bytes:
+                gathered = gathered.byteswap()
+            out[members] = gathered.view(dtype).ravel()
+        if self._scale is not None:
+            out *= self._scale
+        if self._offset is not None:
+            out += self._offset
+
+    def decode(self, buffer=None):
+        """Point values as a new array (optionally from the given raw bytes first)."""
+        if buffer is not None:
+            self.buffer[:] = buffer
+        out = np.empty(len(self.addresses), dtype=self.dtype)
+        self.decode_into(out)
+        return out
+
+
+class PointEncoder:
+    """
+    The inverse of a PointDecoder: writes point values back into the 16-bit
+    registers they were decoded from, for serving them over Modbus.
+    """
+
+    def __init__(self, points, positions):
+        """``positions`` maps a register address to its index in the target word array."""
+        self.addresses = tuple(point.address for point in points)
+        self._groups, self._scale, self._offset = _layout_groups(points, positions)
+
+    def encode_into(self, values, words):
+        """Write ``values`` (in ``addresses`` order) into the register array ``words``."""
+        raw = np.nan_to_num(np.asarray(values, dtype=np.float64))
+        if self._offset is not None:
+            raw = raw - self._offset
+        if self._scale is not None:
+            raw = raw / self._scale
+        for members, index, swap_bytes, dtype in self._groups:
+            group = raw[members]
+            if dtype.kind in "iu":
+                info = np.iinfo(dtype)
+                group = np.clip(np.rint(group), info.min, info.max)
+            encoded = group.astype(dtype).view(">u2").reshape(index.shape)
+            if swap_bytes:
+                encoded = encoded.byteswap()
+            words[index] = encoded
@@ -0,0 +1,336 @@
+"""
+Adaptive per-PLC rate control.
+
+A device that slows down under load only gets worse when it is polled at full
+rate: requests queue up in it, time out, and whole cycles return nothing.
+``RateController`` watches every request of a PLC's cycles and backs off
+while the device is in trouble, then steps back up once it has been healthy
+for a while.  It has two handles:
+
+* the requests kept in flight at the PLC, halved (down to one) while round
+  trips grow because requests queue up in the device: a smoothed round trip
+  time above LATENCY_FACTOR times its recent minimum, the unloaded latency.
+  They grow back one at a time, and a depth at which requests went
+  unanswered is only retried after PROBE_CYCLES quiet cycles;
+* the work per cycle, while reading takes more than CYCLE_BUDGET of the
+  interval (smoothed, so a single slow cycle does not count).  Blocks of
+  low-priority points are read only every 2nd, 4th, then 8th cycle, then
+  normal-priority blocks likewise, and last the sampling interval itself
+  is doubled, up to 8 times the configured one.
+
+Timeouts, lost connections and "busy" answers pull both.  The highest
+priority present on a sheet is never thinned out, so its points keep their
+rate until the interval has to give.  Points are normal priority unless
+their sheet sets "Priority (...)"; read plans never merge points of
+different priorities into one request (see config_cache.py).
+
+A step back is taken at most every ESCALATE_CYCLES cycles, so the effect of
+the last one shows first.  After RECOVER_CYCLES trouble-free cycles in a row
+one step is undone, the work per cycle first, provided the cycle would still
+fit RECOVER_BUDGET of the interval with that step undone.
+
+Blocks the device answers with another Modbus exception (an address it does
+not have, typically), or with the wrong amount of data, are a configuration
+problem rather than load.  Each is retried after 2, 4, ... up to
+BLOCK_BACKOFF_MAX cycles on its own, without slowing the rest of the PLC;
+its points hold their last values meanwhile and the rest of its register
+type is still stored.
+"""
+import logging
+
+from address_map import DEFAULT_PRIORITY, PRIORITIES
+
+logger = logging.getLogger("ModbusClient")
+
+LATENCY_FACTOR = 4.0  # smoothed RTT over the baseline that counts as trouble
+LATENCY_MARGIN = 0.02  # seconds; and by at least this much, so LAN jitter does not count as trouble
+CYCLE_BUDGET = 0.8  # share of the interval reading may take
+RECOVER_BUDGET = 0.6  # ... and would take after a step up, for the step to be taken
+ESCALATE_CYCLES = 3  # cycles between two steps back
+RECOVER_CYCLES = 10  # trouble-free cycles in a row before a step up
+PROBE_CYCLES = 100  # ... before going back to an in-flight depth that lost requests
+SLOWDOWNS = (2, 4, 8)  # read every nth cycle / interval multiples
+BLOCK_BACKOFF_MAX = 64  # cycles between retries of a block that keeps failing
+BLOCK_BACKOFF_LOG = 3  # exception responses in a row before a block's backoff is logged
+SMOOTHING = 0.2  # weight of the newest sample in smoothed times and error rates
+BASELINE_DRIFT = 1.01  # per cycle, so the baseline RTT follows a lasting change
+# Exception codes meaning "too busy" rather than "wrong request": server
+# device busy, gateway path unavailable, gateway target failed to respond
+BUSY_EXCEPTIONS = (0x06, 0x0A, 0x0B)
+
+
+class BlockSchedule:
+    """
+    The blocks of one read plan: the priority of each, its smoothed round
+    trip time and error rate, and the cycle it is next due after failing.
+    """
+
+    __slots__ = ("controller", "blocks", "offset", "priorities", "rtt", "errors", "failures",
+                 "next_due", "requested")
+
+    def __init__(self, controller, plan, priorities, offset=0):
+        self.controller = controller
+        self.blocks = plan.blocks
+        self.offset = offset  # blocks of the PLC's plans before this one
+        # A block only holds points of one priority
+        self.priorities = [priorities.get(block.addresses[0], DEFAULT_PRIORITY)
+                           if block.addresses else DEFAULT_PRIORITY for block in self.blocks]
+        self.rtt = [None] * len(self.blocks)
+        self.errors = [0.0] * len(self.blocks)
+        self.failures = [0] * len(self.blocks)  # exception responses in a row
+        self.next_due = [0] * len(self.blocks)
+        self.requested = 0
+
+    def due(self):
+        """Indices of the blocks to read this cycle."""
+        controller = self.controller
+        cycle = controller.cycle + self.offset
+        divisors = controller.divisors
+        # Offset by the block's place in the PLC's plans, so thinned-out blocks
+        # are spread evenly over the cycles
+        due = [i for i, priority in enumerate(self.priorities)
+               if self.next_due[i] <= controller.cycle and (cycle + i) % divisors[priority] == 0]
+        self.requested = len(due)
+        deferred = len(self.blocks) - len(due)
+        if deferred:
+            controller.deferred += deferred
+            if controller.metrics is not None:
+                controller.metrics.deferred_reads.inc(deferred)
+        return due
+
+    def record(self, indices, responses, errors):
+        """
+        Account for the responses (or exceptions) of the blocks at ``indices``
+        and their errors, None for a good response (see points.response_error).
+        """
+        controller = self.controller
+        for i, response, error in zip(indices, responses, errors):
+            if isinstance(response, Exception):
+                # No answer: a timeout or a lost connection
+                controller.timeouts += 1
+                self.errors[i] += SMOOTHING * (1.0 - self.errors[i])
+                continue
+            rtt = getattr(response, "rtt", None)
+            if rtt is not None:
+                controller.rtt_sum += rtt
+                controller.rtt_count += 1
+                last = self.rtt[i]
+                self.rtt[i] = rtt if last is None else last + SMOOTHING * (rtt - last)
+            if error is None:
+                self.errors[i] -= SMOOTHING * self.errors[i]
+                if self.failures[i] >= BLOCK_BACKOFF_LOG:
+                    logger.info(f"PLC {controller.plc_id} block {self.name(i)} answers again")
+                self.failures[i] = 0
+                continue
+            self.errors[i] += SMOOTHING * (1.0 - self.errors[i])
+            if getattr(response, "exception_code", None) in BUSY_EXCEPTIONS:
+                controller.busy += 1
+            elif controller.enabled:
+                # Another exception or a malformed response: the block, not the load
+                self.failures[i] += 1
+                backoff = min(2 ** self.failures[i], BLOCK_BACKOFF_MAX)
+                self.next_due[i] = controller.cycle + backoff
+                if self.failures[i] == BLOCK_BACKOFF_LOG:
+                    logger.warning(f"PLC {controller.plc_id} block {self.name(i)} keeps failing "
+                                   f"({error}); retrying it less often, up to every "
+                                   f"{BLOCK_BACKOFF_MAX} cycles")
+
+    def name(self, i):
+        block = self.blocks[i]
+        return f"{block.start}+{block.count}"
+
+
+class RateController:
+    """
+    Backs a PLC's polling off while its device struggles and restores it
+    when it recovers.  ``schedules`` holds a BlockSchedule per register type;
+    call ``begin_cycle`` before reading and ``end_cycle`` after.  Disabled,
+    it keeps its statistics but never slows anything down.
+    """
+
+    def __init__(self, plc_id, scheduler, client, metrics=None, enabled=True):
+        self.plc_id = plc_id
+        self.scheduler = scheduler
+        self.client = client
+        self.metrics = metrics
+        self.enabled = enabled
+        self.interval = scheduler.interval  # as configured
+        self.max_depth = client.max_in_flight
+        self.depth = self.max_depth
+        self._failed_depth = None  # lowest depth at which requests went unanswered
+        self.schedules = {}
+        self.ladder = []  # (priority or "interval", divisor or factor) per step
+        self.level = 0  # steps of the ladder taken
+        self.divisors = dict.fromkeys(PRIORITIES, 1)
+        self.factor = 1
+        self.cycle = 0
+        self.deferred = 0
+        self.srtt = None
+        self.baseline = None
+        self.read_time = None  # smoothed time to read a cycle
+        self.error_rate = 0.0
+        self._calm = 0  # trouble-free cycles in a row
+        self._since_step = ESCALATE_CYCLES
+        self.begin_cycle()
+
+    def set_plans(self, plans, priorities):
+        """Track new read plans ({register type: plan}; priorities by register type)."""
+        self.schedules = {}
+        offset = 0
+        for register_type, plan in plans.items():
+            self.schedules[register_type] = BlockSchedule(
+                self, plan, priorities.get(register_type, {}), offset)
+            offset += len(plan.blocks)
+        present = {priority for schedule in self.schedules.values()
+                   for priority in schedule.priorities}
+        top = next((priority for priority in PRIORITIES if priority in present), DEFAULT_PRIORITY)
+        ladder = []
+        for priority in reversed(PRIORITIES[PRIORITIES.index(top) + 1:]):
+            if priority in present:
+                ladder.extend((priority, divisor) for divisor in SLOWDOWNS)
+        ladder.extend(("interval", factor) for factor in SLOWDOWNS)
+        self.ladder = ladder
+        self._apply(self.depth, min(self.level, len(ladder)))
+
+    def set_interval(self, interval):
+        """Change the configured sampling interval (seconds)."""
+        self.interval = interval
+        self.scheduler.set_interval(interval * self.factor)
+
+    def _settings(self, level):
+        divisors, factor = dict.fromkeys(PRIORITIES, 1), 1
+        for kind, value in self.ladder[:level]:
+            if kind == "interval":
+                factor = value
+            else:
+                divisors[kind] = value
+        return divisors, factor
+
+    def _reads(self, divisors):
+        """Block reads per cycle, on average, with these divisors."""
+        return sum(1 / divisors[priority] for schedule in self.schedules.values()
+                   for priority in schedule.priorities)
+
+    def _apply(self, depth, level):
+        self.depth = depth
+        self.level = level
+        self.divisors, self.factor = self._settings(level)
+        self.client.limit_in_flight(depth)
+        self.scheduler.set_interval(self.interval * self.factor)
+        if self.metrics is not None:
+            self.metrics.rate_level.set(level)
+            self.metrics.in_flight_limit.set(depth)
+
+    def describe(self):
+        if self.depth == self.max_depth and not self.level:
+            return "full rate"
+        parts = [f"{self.depth} request(s) in flight"]
+        parts += [f"{priority}-priority blocks every {divisor} cycles"
+                  for priority, divisor in self.divisors.items() if divisor > 1]
+        if self.factor > 1:
+            parts.append(f"interval {self.interval * self.factor * 1000:g} ms")
+        return ", ".join(parts)
+
+    def begin_cycle(self):
+        self.cycle += 1
+        self.timeouts = 0
+        self.busy = 0
+        self.rtt_sum = 0.0
+        self.rtt_count = 0
+
+    def end_cycle(self, duration):
+        """Weigh up the cycle that took ``duration`` seconds to read; step back or up."""
+        requested = sum(schedule.requested for schedule in self.schedules.values())
+        rtt = None
+        if self.rtt_count:
+            rtt = self.rtt_sum / self.rtt_count
+            self.srtt = rtt if self.srtt is None else self.srtt + SMOOTHING * (rtt - self.srtt)
+            baseline = self.baseline
+            self.baseline = rtt if baseline is None else min(baseline * BASELINE_DRIFT, rtt)
+        if self.read_time is None:
+            self.read_time = duration
+        else:
+            self.read_time += SMOOTHING * (duration - self.read_time)
+        failed = self.timeouts + self.busy
+        if requested:
+            self.error_rate += SMOOTHING * (failed / requested - self.error_rate)
+        if not self.enabled:
+            return
+
+        interval = self.scheduler.interval
+        overrun = self.read_time > CYCLE_BUDGET * interval
+        # This cycle's round trips too, so the smoothed one lagging behind does not count
+        limit = None if rtt is None else max(LATENCY_FACTOR * self.baseline,
+                                             self.baseline + LATENCY_MARGIN)
+        queueing = limit is not None and self.srtt > limit and rtt > limit
+        self._since_step += 1
+        if failed or overrun or queueing:
+            self._calm = 0
+            if self._since_step < ESCALATE_CYCLES:
+                return
+            depth, level = self.depth, self.level
+            if failed or queueing:
+                depth = max(1, depth // 2)
+                if failed and depth < self.depth:
+                    self._failed_depth = self.depth
+            if failed or overrun:
+                level = min(level + 1, len(self.ladder))
+            if (depth, level) != (self.depth, self.level):
+                reasons = []
+                if failed:
+                    reasons.append(f"{failed} of {requested} requests unanswered or busy")
+                if overrun:
+                    reasons.append(f"reading takes {self.read_time * 1000:.0f} ms of a "
+                                   f"{interval * 1000:g} ms interval")
+                if queueing:
+                    reasons.append(f"round trip {self.srtt * 1000:.1f} ms against "
+                                   f"{self.baseline * 1000:.1f} ms unloaded")
+                self._since_step = 0
+                self._apply(depth, level)
+                logger.warning(f"PLC {self.plc_id} is struggling ({'; '.join(reasons)}); "
+                               f"backing off to {self.describe()}")
+            return
+
+        if self.level:
+            # Would the cycle, with the blocks and interval of one step up, still fit?
+            divisors, factor = self._settings(self.level - 1)
+            expected = self.read_time * self._reads(divisors) / max(self._reads(self.divisors), 1e-9)
+            fits = expected < RECOVER_BUDGET * self.interval * factor
+            depth, level = self.depth, self.level - 1
+        else:
+            fits = self.read_time < RECOVER_BUDGET * interval
+            depth, level = min(self.depth + 1, self.max_depth), 0
+        if not fits or (depth, level) == (self.depth, self.level):
+            self._calm = 0
+            return
+        self._calm += 1
+        probing = self._failed_depth is not None and depth >= self._failed_depth
+        if self._calm >= (PROBE_CYCLES if probing else RECOVER_CYCLES):
+            self._calm = 0
+            self._since_step = 0
+            if probing:
+                self._failed_depth = None
+            self._apply(depth, level)
+            logger.info(f"PLC {self.plc_id} has recovered; back to {self.describe()}")
+
+    def stats(self):
+        """Current settings and response statistics, times in milliseconds."""
+        blocks = [(schedule.rtt[i], register_type, schedule.name(i))
+                  for register_type, schedule in self.schedules.items()
+                  for i in range(len(schedule.blocks)) if schedule.rtt[i] is not None]
+        failing = [f"{register_type} {schedule.name(i)}"
+                   for register_type, schedule in self.schedules.items()
+                   for i in range(len(schedule.blocks)) if schedule.failures[i]]
+        return {
+            "level": self.level,
+            "in_flight": self.depth,
+            "settings": self.describe(),
+            "read_ms": self.read_time * 1000 if self.read_time is not None else None,
+            "rtt_ms": self.srtt * 1000 if self.srtt is not None else None,
+            "baseline_rtt_ms": self.baseline * 1000 if self.baseline is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "deferred_reads": self.deferred,
+            "slowest_blocks": [f"{register_type} {name} {rtt * 1000:.1f} ms"
+                               for rtt, register_type, name in sorted(blocks, reverse=True)[:3]],
+            "failing_blocks": failing,
+        }
@@ -0,0 +1,151 @@
+"""
+Read plans: the list of Modbus requests needed to fetch a set of addresses.
+
+A plan is compiled once per address set and reused every cycle.  Contiguous
+runs are merged across small gaps when reading a few unused registers is
+cheaper than another round trip, without exceeding the protocol limit for a
+single request.
+"""
+from bisect import bisect_left
+from functools import lru_cache
+
+from address_map import contiguous_ranges
+
+MAX_BITS_PER_REQUEST = 2000
+MAX_REGISTERS_PER_REQUEST = 125
+
+# Widest gap (in 16-bit registers) bridged by a single request when the PLC
+# does not set "Gap Threshold".  Bit reads use 16 bits per register.
+DEFAULT_GAP_THRESHOLD = 8
+BITS_PER_REGISTER = 16
+
+
+class ReadBlock:
+    """One Modbus request: ``count`` points from ``start`` (1-based)."""
+
+    __slots__ = ("start", "count", "addresses", "offsets")
+
+    def __init__(self, start, count, addresses):
+        self.start = start
+        self.count = count
+        self.addresses = tuple(addresses)
+        self.offsets = tuple(addr - start for addr in self.addresses)
+
+    def __repr__(self):
+        return f"ReadBlock(start={self.start}, count={self.count}, points={len(self.addresses)})"
+
+
+class ReadPlan:
+    """Compiled requests for one address set."""
+
+    __slots__ = ("blocks", "addresses", "naive_requests", "words")
+
+    def __init__(self, blocks, addresses, naive_requests):
+        self.blocks = tuple(blocks)
+        self.addresses = tuple(addresses)
+        self.naive_requests = naive_requests
+        self.words = sum(block.count for block in self.blocks)
+
+    @property
+    def requests(self):
+        return len(self.blocks)
+
+    def __repr__(self):
+        return (f"ReadPlan({len(self.addresses)} points, {self.naive_requests} -> "
+                f"{self.requests} requests, {self.words} points read)")
+
+
+def _split_ranges(ranges, max_count):
+    """Split runs longer than max_count so each fits in one request."""
+    for start, count in ranges:
+        while count > max_count:
+            yield start, max_count
+            start += max_count
+            count -= max_count
+        yield start, count
+
+
+@lru_cache(maxsize=1024)
+def _compile(addresses, max_count, gap_threshold):
+    ranges = list(_split_ranges(contiguous_ranges(addresses), max_count))
+    n = len(ranges)
+
+    # best[i] = (requests, points read, first range of the last block) for ranges[:i]
+    best = [(0, 0, 0)] + [None] * n
+    for i in range(1, n + 1):
+        end = ranges[i - 1][0] + ranges[i - 1][1] - 1
+        for j in range(i - 1, -1, -1):
+            if j < i - 1:
+                gap = ranges[j + 1][0] - (ranges[j][0] + ranges[j][1])
+                if gap > gap_threshold:
+                    break
+            span = end - ranges[j][0] + 1
+            if span > max_count:
+                break
+            candidate = (best[j][0] + 1, best[j][1] + span, j)
+            if best[i] is None or candidate[:2] < best[i][:2]:
+                best[i] = candidate
+
+    blocks = []
+    i = n
+    wanted = iter(reversed(addresses))
+    addr = next(wanted, None)
+    while i > 0:
+        j = best[i][2]
+        start = ranges[j][0]
+        end = ranges[i - 1][0] + ranges[i - 1][1] - 1
+        block_addresses = []
+        while addr is not None and addr >= start:
+            block_addresses.append(addr)
+            addr = next(wanted, None)
+        blocks.append(ReadBlock(start, end - start + 1, reversed(block_addresses)))
+        i = j
+    blocks.reverse()
+    return ReadPlan(blocks, addresses, n)
+
+
+def compile_read_plan(addresses, max_count, gap_threshold=0, groups=None):
+    """
+    Compile the fewest requests covering ``addresses``.
+
+    Adjacent runs are merged when the gap between them is at most
+    ``gap_threshold`` points and the merged read fits in ``max_count``.
+    Among plans with the fewest requests the one reading fewest points wins.
+    ``groups`` maps addresses to a group (their priority); a request never
+    spans addresses of two groups, and unlisted addresses form one group.
+    """
+    addresses = tuple(sorted(set(addresses)))
+    gap_threshold = max(0, int(gap_threshold))
+    if not groups:
+        return _compile(addresses, max_count, gap_threshold)
+
+    # Compile each run of same-group addresses on its own
+    blocks = []
+    naive_requests = 0
+    start = 0
+    for i in range(1, len(addresses) + 1):
+        if i == len(addresses) or groups.get(addresses[i]) != groups.get(addresses[start]):
+            plan = _compile(addresses[start:i], max_count, gap_threshold)
+            blocks.extend(plan.blocks)
+            naive_requests += plan.naive_requests
+            start = i
+    return ReadPlan(blocks, addresses, naive_requests)
+
+
+def plan_from_blocks(addresses, blocks, naive_requests):
+    """Rebuild a compiled plan from its (start, count) blocks, e.g. out of a cache."""
+    addresses = tuple(sorted(set(addresses)))
+    read_blocks = []
+    i = 0
+    for start, count in blocks:
+        j = bisect_left(addresses, start + count, i)
+        read_blocks.append(ReadBlock(start, count, addresses[i:j]))
+        i = j
+    return ReadPlan(read_blocks, addresses, naive_requests)
+
+
+def gap_points(gap_threshold=None, bits=False):
+    """Convert a PLC's "Gap Threshold" (in registers) to points for a read type."""
+    if gap_threshold is None:
+        gap_threshold = DEFAULT_GAP_THRESHOLD
+    return int(gap_threshold) * (BITS_PER_REGISTER if bits else 1)
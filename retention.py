@@ -0,0 +1,229 @@
+"""
+Compression, retention and compaction of recorded segments.
+
+A background thread periodically:
+
+* compresses closed raw segments (every segment but the newest one of a PLC
+  and register type, once it has been untouched for ``COMPRESS_GRACE``);
+* rolls raw segments older than the PLC's raw retention into per-interval
+  min/max/mean rollups under ``<register_type>/aggregates/<stat>/`` and
+  deletes them;
+* deletes rollups older than the aggregate retention.
+
+Retention is configured per PLC with the optional "Raw Retention Days" and
+"Aggregate Retention Days" columns of config/plc_data.xlsx.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from history import forget_segment, segment_info
+from storage import (DATA_DIR, REGISTER_TYPES, SEGMENT_SUFFIX, COMPRESSED_SUFFIX, SegmentWriter,
+                     compress_segment, is_compressed, list_segments, read_segment_body, segment_dir)
+
+logger = logging.getLogger("ModbusClient")
+
+DEFAULT_RAW_RETENTION_DAYS = 30
+DEFAULT_AGGREGATE_RETENTION_DAYS = 365
+AGGREGATE_INTERVAL = 60  # seconds covered by one rollup row
+AGGREGATE_STATS = ("min", "max", "mean")
+COMPRESS_GRACE = 60  # seconds a closed segment must be untouched before compressing
+MAINTENANCE_INTERVAL = 300  # seconds between maintenance runs
+DAY = 86400
+
+
+class RetentionPolicy:
+    """How long one PLC keeps raw samples and rollups."""
+
+    def __init__(self, raw_days=DEFAULT_RAW_RETENTION_DAYS,
+                 aggregate_days=DEFAULT_AGGREGATE_RETENTION_DAYS,
+                 aggregate_interval=AGGREGATE_INTERVAL):
+        self.raw_days = raw_days
+        self.aggregate_days = aggregate_days
+        self.aggregate_interval = aggregate_interval
+
+
+def retention_policy_from_config(plc):
+    """Build a RetentionPolicy from a plc_data.xlsx row."""
+    return RetentionPolicy(
+        raw_days=plc.get("Raw Retention Days") or DEFAULT_RAW_RETENTION_DAYS,
+        aggregate_days=plc.get("Aggregate Retention Days") or DEFAULT_AGGREGATE_RETENTION_DAYS,
+    )
+
+
+def compress_closed_segments(plc_id, data_dir=DATA_DIR, now=None):
+    """Compress every raw segment except the one currently being written."""
+    now = time.time() if now is None else now
+    compressed = 0
+    for register_type in REGISTER_TYPES:
+        for path in list_segments(plc_id, register_type, data_dir)[:-1]:
+            if not is_compressed(path) and now - os.path.getmtime(path) > COMPRESS_GRACE:
+                compress_segment(path)
+                forget_segment(path)
+                compressed += 1
+    return compressed
+
+
+def _bucket(timestamp, interval):
+    return np.floor(timestamp / interval) * interval
+
+
+def rollup(path, interval=AGGREGATE_INTERVAL, carry=None, following=None):
+    """
+    Per-interval statistics of a segment.
+
+    A segment closed mid-interval (on rotation or an address change) shares
+    that interval with the next one, and the interval must still become one
+    row per address.  ``carry`` is the (addresses, timestamps, values) of the
+    previous segment's last interval, merged into the first row; with the
+    next segment's addresses as ``following``, the samples of the last
+    interval are returned as the new carry, and only the addresses the next
+    segment does not record keep their last row here.  NaN marks an address
+    with no samples in an interval.
+
+    Returns (addresses, bucket start times, {"min"|"max"|"mean": 2-D array}, carry).
+    """
+    info = segment_info(path)
+    records = np.frombuffer(read_segment_body(path)[2], dtype=info.dtype())
+    ts = records["ts"]
+    values = records["values"].astype(np.float64)
+    if carry is not None:
+        carry_addresses, carry_ts, carry_values = carry
+        carried = np.full((len(carry_ts), len(info.addresses)), np.nan)
+        for column, address in enumerate(info.addresses):
+            if address in carry_addresses:
+                carried[:, column] = carry_values[:, carry_addresses.index(address)]
+        ts = np.concatenate([carry_ts, ts])
+        values = np.vstack([carried, values])
+
+    buckets = _bucket(ts, interval)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    present = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = {
+            "min": np.fmin.reduceat(values, starts, axis=0),
+            "max": np.fmax.reduceat(values, starts, axis=0),
+            "mean": (np.add.reduceat(np.where(present, values, 0.0), starts, axis=0)
+                     / np.add.reduceat(present, starts, axis=0)),
+        }
+    times = buckets[starts]
+
+    carry = None
+    if following is not None:
+        carry = (info.addresses, ts[starts[-1]:], values[starts[-1]:])
+        moved = [column for column, address in enumerate(info.addresses) if address in following]
+        if len(moved) == len(info.addresses):
+            times = times[:-1]
+            stats = {stat: rows[:-1] for stat, rows in stats.items()}
+        else:
+            for rows in stats.values():
+                rows[-1, moved] = np.nan
+    return info.addresses, times, stats, carry
+
+
+def _write_rollups(plc_id, register_type, data_dir, name, addresses, times, stats):
+    for stat in AGGREGATE_STATS:
+        folder = segment_dir(plc_id, register_type, data_dir, aggregate=stat)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name + SEGMENT_SUFFIX)
+        # Left over from an interrupted run: start the rollup again
+        for stale in (path, os.path.join(folder, name + COMPRESSED_SUFFIX)):
+            if os.path.exists(stale):
+                os.remove(stale)
+        writer = SegmentWriter(path, "d", addresses)
+        for timestamp, row in zip(times.tolist(), stats[stat].tolist()):
+            writer.append(timestamp, row)
+        writer.close()
+        compress_segment(path)
+
+
+def compact(plc_id, policy, data_dir=DATA_DIR, now=None):
+    """Roll expired raw segments into rollups and drop expired rollups."""
+    now = time.time() if now is None else now
+    raw_cutoff = now - policy.raw_days * DAY
+    aggregate_cutoff = now - policy.aggregate_days * DAY
+    interval = policy.aggregate_interval
+    rolled = removed = 0
+
+    for register_type in REGISTER_TYPES:
+        paths = list_segments(plc_id, register_type, data_dir)
+        infos = [segment_info(path) for path in paths]
+        carry = None
+        handed_over = []  # rolled up, but their last interval is still to be merged
+        for index, (path, info) in enumerate(zip(paths[:-1], infos)):
+            if info.records and info.end >= raw_cutoff:
+                continue
+            if info.records:
+                following = None
+                later = next((later for later in infos[index + 1:] if later.records), None)
+                if later is not None and _bucket(later.start, interval) == _bucket(info.end, interval):
+                    if later is infos[-1] or later.end >= raw_cutoff:
+                        # Its last interval goes on in a segment still kept raw; roll
+                        # both up together once that one expires
+                        break
+                    following = later.addresses
+                addresses, times, stats, carry = rollup(path, interval, carry, following)
+                if len(times):
+                    name = os.path.basename(path).split(".")[0]
+                    _write_rollups(plc_id, register_type, data_dir, name, addresses, times, stats)
+                rolled += 1
+            handed_over.append(path)
+            if carry is None:
+                # Deleted only now, so an interrupted run rolls the whole chain up again
+                for done in handed_over:
+                    os.remove(done)
+                    forget_segment(done)
+                handed_over.clear()
+
+        for stat in AGGREGATE_STATS:
+            for path in list_segments(plc_id, register_type, data_dir, aggregate=stat):
+                info = segment_info(path)
+                if not info.records or info.end < aggregate_cutoff:
+                    os.remove(path)
+                    forget_segment(path)
+                    removed += 1
+    return rolled, removed
+
+
+def run_maintenance(policies, data_dir=DATA_DIR):
+    """One maintenance pass over ``policies`` (PLC id -> RetentionPolicy)."""
+    for plc_id, policy in policies.items():
+        try:
+            start = time.perf_counter()
+            compressed = compress_closed_segments(plc_id, data_dir)
+            rolled, removed = compact(plc_id, policy, data_dir)
+            if compressed or rolled or removed:
+                logger.info(f"PLC {plc_id} maintenance: {compressed} segments compressed, "
+                            f"{rolled} rolled up, {removed} rollups expired "
+                            f"in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"Maintenance of {plc_id} data failed: {e}")
+
+
+class MaintenanceThread(threading.Thread):
+    """Runs ``run_maintenance`` every ``interval`` seconds off the polling loop."""
+
+    def __init__(self, policies, data_dir=DATA_DIR, interval=MAINTENANCE_INTERVAL):
+        super().__init__(name="storage-maintenance", daemon=True)
+        self.policies = policies
+        self.data_dir = data_dir
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            run_maintenance(self.policies, self.data_dir)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def start_maintenance(plcs, data_dir=DATA_DIR, interval=MAINTENANCE_INTERVAL):
+    """Start background maintenance for the given plc_data.xlsx rows."""
+    thread = MaintenanceThread({plc["PLC"]: retention_policy_from_config(plc) for plc in plcs},
+                               data_dir, interval)
+    thread.start()
+    return thread
@@ -0,0 +1,123 @@
+"""
+Drift-free polling schedule.
+
+Ticks fire on absolute deadlines ``start + n * interval`` measured with the
+monotonic clock, so time spent reading and storing a sample never pushes the
+following samples back.  When a cycle overruns one or more whole periods the
+missed ticks are skipped and counted instead of being fired late in a burst.
+The time from one tick to the next call to ``wait`` is recorded as the
+cycle's duration, with the most recent ones kept for percentiles.  With a
+``PlcMetrics`` the cycles, jitter, durations and missed deadlines are also
+counted there.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+logger = logging.getLogger("ModbusClient")
+
+CYCLE_HISTORY = 1000  # recent cycle durations kept per schedule
+
+
+class PollScheduler:
+    """Wait for successive sampling deadlines and record the timing error."""
+
+    def __init__(self, interval, name="", clock=time.monotonic, history=None, metrics=None):
+        if interval <= 0:
+            raise ValueError("sampling interval must be positive")
+        self.interval = interval
+        self.name = name
+        self._clock = clock
+        self.next_deadline = clock()
+        self.cycle_times = deque(maxlen=CYCLE_HISTORY if history is None else history)
+        self.metrics = metrics
+        self._woke = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Start the timing statistics afresh (the schedule itself is unchanged)."""
+        self.ticks = 0
+        self.missed = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self._jitter_sum = 0.0
+        self._jitter_sq_sum = 0.0
+        self.cycles = 0
+        self.last_cycle = 0.0
+        self.max_cycle = 0.0
+        self._cycle_sum = 0.0
+        self.cycle_times.clear()
+
+    def _record_cycle(self, duration):
+        self.cycles += 1
+        self.last_cycle = duration
+        self.max_cycle = max(self.max_cycle, duration)
+        self._cycle_sum += duration
+        self.cycle_times.append(duration)
+        if self.metrics is not None:
+            self.metrics.cycle_duration.observe(duration)
+
+    async def wait(self):
+        """Sleep until the next deadline and return it (monotonic seconds)."""
+        deadline = self.next_deadline
+        now = self._clock()
+        if self._woke is not None:
+            self._record_cycle(now - self._woke)
+        if now < deadline:
+            await asyncio.sleep(deadline - now)
+            now = self._clock()
+
+        late = now - deadline
+        if late >= self.interval:
+            # Skip the ticks we overran rather than firing them back to back
+            skipped = int(late // self.interval)
+            self.missed += skipped
+            deadline += skipped * self.interval
+            late = now - deadline
+            logger.warning(f"PLC {self.name} missed {skipped} sampling deadline(s)")
+            if self.metrics is not None:
+                self.metrics.missed_deadlines.inc(skipped)
+
+        self.ticks += 1
+        self.last_jitter = late
+        self.max_jitter = max(self.max_jitter, late)
+        self._jitter_sum += late
+        self._jitter_sq_sum += late * late
+        if self.metrics is not None:
+            self.metrics.cycles.inc()
+            self.metrics.jitter.observe(late)
+        self.next_deadline = deadline + self.interval
+        self._woke = now
+        return deadline
+
+    def resync(self):
+        """Restart the schedule from now, e.g. after waiting out a reconnect."""
+        self.next_deadline = self._clock()
+        self._woke = None  # the wait is not part of a cycle
+
+    def set_interval(self, interval):
+        """Change the period; the next deadline keeps its place in time."""
+        if interval <= 0:
+            raise ValueError("sampling interval must be positive")
+        self.next_deadline += interval - self.interval
+        self.interval = interval
+
+    def stats(self):
+        """Timing statistics in milliseconds."""
+        mean = self._jitter_sum / self.ticks if self.ticks else 0.0
+        variance = self._jitter_sq_sum / self.ticks - mean * mean if self.ticks else 0.0
+        return {
+            "interval_ms": self.interval * 1000,
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "jitter_last_ms": self.last_jitter * 1000,
+            "jitter_mean_ms": mean * 1000,
+            "jitter_std_ms": math.sqrt(max(variance, 0.0)) * 1000,
+            "jitter_max_ms": self.max_jitter * 1000,
+            "cycles": self.cycles,
+            "cycle_last_ms": self.last_cycle * 1000,
+            "cycle_mean_ms": self._cycle_sum / self.cycles * 1000 if self.cycles else 0.0,
+            "cycle_max_ms": self.max_cycle * 1000,
+        }
@@ -0,0 +1,451 @@
+"""
+Append-only sample storage for polled Modbus data.
+
+Samples are written to fixed-width binary segment files, one directory per
+PLC and register type:
+
+    modbus_data/<plc>/<register_type>/<first sample time>.seg
+
+A segment starts with a small header (magic, value type and the address
+list) followed by one record per sample: a float64 epoch timestamp and one
+value per address (float64 when a PLC has typed register points, see
+points.py).  Appending a sample is a single write at the end of the
+file, so the cost stays the same no matter how much history already exists.
+XLSX files are only produced on demand through ``export_xlsx``.
+
+A new segment is started every ``SEGMENT_PERIOD`` (hour or day) or once the
+current one reaches ``SEGMENT_MAX_BYTES``.  Closed segments are compressed to
+``.segz`` files by the retention job: the same header, then the first and
+last timestamps and record count, then the zlib-compressed records.
+"""
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("ModbusClient")
+
+DATA_DIR = "modbus_data"
+SEGMENT_SUFFIX = ".seg"
+COMPRESSED_SUFFIX = ".segz"
+AGGREGATE_DIR = "aggregates"
+
+SEGMENT_PERIOD = "hour"  # "hour" or "day"
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+# Register type -> (value typecode, sheet title used for XLSX export)
+REGISTER_TYPES = {
+    "coil_states": ("B", "Coil States"),
+    "input_status_states": ("B", "Input Status States"),
+    "input_register_states": ("H", "Input Register States"),
+    "holding_register_states": ("H", "Holding Register States"),
+}
+# Value typecode of register samples holding typed (decoded or scaled) points
+TYPED_TYPECODE = "d"
+
+SEGMENT_MAGIC = b"NPSEG1\x00\x00"
+# magic, value typecode, address count
+_HEADER = struct.Struct("<8s4sI")
+_TIMESTAMP = struct.Struct("<d")
+# first timestamp, last timestamp, record count (compressed segments only)
+_BOUNDS = struct.Struct("<ddQ")
+
+
+def _to_little_endian(arr):
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+def segment_dir(plc_id, register_type, data_dir=DATA_DIR, aggregate=None):
+    """Raw segment directory, or with ``aggregate`` ("min"/"max"/"mean") its rollups."""
+    if aggregate:
+        return os.path.join(data_dir, plc_id, register_type, AGGREGATE_DIR, aggregate)
+    return os.path.join(data_dir, plc_id, register_type)
+
+
+def list_segments(plc_id, register_type, data_dir=DATA_DIR, aggregate=None):
+    """Return segment paths (plain and compressed) for a PLC/register type, oldest first."""
+    folder = segment_dir(plc_id, register_type, data_dir, aggregate)
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.endswith(SEGMENT_SUFFIX) or name.endswith(COMPRESSED_SUFFIX)]
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIX)
+
+
+def period_end(timestamp, period=SEGMENT_PERIOD):
+    """End (epoch seconds) of the local hour or day containing ``timestamp``."""
+    dt = datetime.fromtimestamp(timestamp)
+    if period == "day":
+        start = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        return (start + timedelta(days=1)).timestamp()
+    start = dt.replace(minute=0, second=0, microsecond=0)
+    return (start + timedelta(hours=1)).timestamp()
+
+
+def read_segment_header(f):
+    """Read a segment header, returning (typecode, addresses, header_size)."""
+    raw = f.read(_HEADER.size)
+    if len(raw) < _HEADER.size:
+        raise ValueError("truncated segment header")
+    magic, typecode, count = _HEADER.unpack(raw)
+    if magic != SEGMENT_MAGIC:
+        raise ValueError("not a segment file")
+    typecode = typecode.rstrip(b"\x00").decode("ascii")
+    addresses = array("I")
+    addresses.frombytes(f.read(count * addresses.itemsize))
+    _to_little_endian(addresses)
+    return typecode, addresses.tolist(), _HEADER.size + count * addresses.itemsize
+
+
+def record_size(typecode, address_count):
+    return _TIMESTAMP.size + array(typecode).itemsize * address_count
+
+
+def read_compressed_bounds(f):
+    """After the header of a compressed segment: (first ts, last ts, records)."""
+    return _BOUNDS.unpack(f.read(_BOUNDS.size))
+
+
+def read_segment_body(path):
+    """Return (typecode, addresses, raw record bytes) of a plain or compressed segment."""
+    with open(path, "rb") as f:
+        typecode, addresses, _ = read_segment_header(f)
+        if is_compressed(path):
+            read_compressed_bounds(f)
+            body = zlib.decompress(f.read())
+        else:
+            body = f.read()
+    size = record_size(typecode, len(addresses))
+    return typecode, addresses, body[:len(body) - len(body) % size]
+
+
+def read_segment(path):
+    """Read a whole segment, returning (addresses, timestamps, rows)."""
+    typecode, addresses, body = read_segment_body(path)
+    size = record_size(typecode, len(addresses))
+    timestamps, rows = [], []
+    for offset in range(0, len(body), size):
+        timestamps.append(_TIMESTAMP.unpack_from(body, offset)[0])
+        values = array(typecode)
+        values.frombytes(body[offset + _TIMESTAMP.size:offset + size])
+        rows.append(_to_little_endian(values).tolist())
+    return addresses, timestamps, rows
+
+
+def compress_segment(path):
+    """Replace a closed .seg file with a .segz file; returns the new path."""
+    typecode, addresses, body = read_segment_body(path)
+    size = record_size(typecode, len(addresses))
+    records = len(body) // size
+    first = _TIMESTAMP.unpack_from(body, 0)[0] if records else 0.0
+    last = _TIMESTAMP.unpack_from(body, len(body) - size)[0] if records else 0.0
+
+    with open(path, "rb") as f:
+        header_size = read_segment_header(f)[2]
+        f.seek(0)
+        header = f.read(header_size)
+    compressed_path = path[:-len(SEGMENT_SUFFIX)] + COMPRESSED_SUFFIX
+    tmp_path = compressed_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header + _BOUNDS.pack(first, last, records) + zlib.compress(body, 6))
+    os.replace(tmp_path, compressed_path)
+    os.remove(path)
+    return compressed_path
+
+
+class SegmentWriter:
+    """Append fixed-width records to one segment file."""
+
+    def __init__(self, path, typecode, addresses):
+        self.path = path
+        self.typecode = typecode
+        self.addresses = list(addresses)
+        self.record_size = record_size(typecode, len(self.addresses))
+        self.first_timestamp = None
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                _, _, self.header_size = read_segment_header(f)
+                first = f.read(_TIMESTAMP.size)
+            # Drop a partial record left behind by an interrupted write
+            body = os.path.getsize(path) - self.header_size
+            self.records = body // self.record_size
+            if self.records:
+                self.first_timestamp = _TIMESTAMP.unpack(first)[0]
+            self._file = open(path, "r+b")
+            self._file.truncate(self.header_size + self.records * self.record_size)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self.records = 0
+            self._file = open(path, "wb")
+            header = _HEADER.pack(SEGMENT_MAGIC, typecode.encode("ascii"), len(self.addresses))
+            header += _to_little_endian(array("I", self.addresses)).tobytes()
+            self.header_size = len(header)
+            self._file.write(header)
+
+    @property
+    def size(self):
+        return self.header_size + self.records * self.record_size
+
+    def append(self, timestamp, values):
+        """Append one sample; ``values`` follow the segment's address order."""
+        packed = _to_little_endian(array(self.typecode, values))
+        self._file.write(_TIMESTAMP.pack(timestamp) + packed.tobytes())
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.records += 1
+
+    def append_raw(self, data, count, first_timestamp):
+        """Append ``count`` records already in on-disk (little-endian) format."""
+        self._file.write(data)
+        if self.first_timestamp is None:
+            self.first_timestamp = first_timestamp
+        self.records += count
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def new_segment_path(folder, timestamp):
+    os.makedirs(folder, exist_ok=True)
+    name = datetime.fromtimestamp(timestamp).strftime("%Y%m%dT%H%M%S_%f") + SEGMENT_SUFFIX
+    return os.path.join(folder, name)
+
+
+def sample_typecode(register_type, values):
+    """Segment typecode for a sample: float64 once register values are decoded."""
+    if values and isinstance(values[0], float):
+        return TYPED_TYPECODE
+    return REGISTER_TYPES[register_type][0]
+
+
+def _open_segment(plc_id, register_type, addresses, timestamp, data_dir, reuse=True,
+                  period=SEGMENT_PERIOD, max_bytes=SEGMENT_MAX_BYTES, typecode=None):
+    """
+    Reuse the newest segment when its address list matches and it is still
+    within its period and size limit, else start a new one.
+    """
+    typecode = typecode or REGISTER_TYPES[register_type][0]
+    segments = list_segments(plc_id, register_type, data_dir) if reuse else []
+    if segments and not is_compressed(segments[-1]):
+        try:
+            with open(segments[-1], "rb") as f:
+                seg_typecode, seg_addresses, _ = read_segment_header(f)
+            if seg_typecode == typecode and seg_addresses == addresses:
+                writer = SegmentWriter(segments[-1], typecode, addresses)
+                if (writer.size < max_bytes and (writer.first_timestamp is None or
+                        timestamp < period_end(writer.first_timestamp, period))):
+                    return writer
+                writer.close()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable segment {segments[-1]}: {e}")
+
+    path = new_segment_path(segment_dir(plc_id, register_type, data_dir), timestamp)
+    return SegmentWriter(path, typecode, addresses)
+
+
+class StorageBackend:
+    """Interface for sample persistence backends."""
+
+    def append(self, plc_id, register_type, timestamp, data):
+        """Store one sample; ``data`` maps address -> value."""
+        raise NotImplementedError
+
+    def append_many(self, samples):
+        """Store a batch of (plc_id, register_type, timestamp, data) samples."""
+        for sample in samples:
+            try:
+                self.append(*sample)
+            except Exception as e:
+                logger.error(f"Error appending {sample[1]} for {sample[0]}: {e}")
+        self.flush()
+
+    def append_records(self, plc_id, register_type, addresses, records):
+        """
+        Store a NumPy array of records (``ts`` and ``values`` fields, see
+        frame.record_dtype) for one PLC and register type.
+        """
+        for timestamp, values in zip(records["ts"].tolist(), records["values"].tolist()):
+            self.append(plc_id, register_type, timestamp, dict(zip(addresses, values)))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SegmentStorage(StorageBackend):
+    """Append-only binary segment log (default backend)."""
+
+    def __init__(self, data_dir=DATA_DIR, period=SEGMENT_PERIOD, max_bytes=SEGMENT_MAX_BYTES):
+        self.data_dir = data_dir
+        self.period = period
+        self.max_bytes = max_bytes
+        self._writers = {}
+        self._period_ends = {}  # (plc_id, register_type) -> when the open segment's period ends
+
+    def append(self, plc_id, register_type, timestamp, data):
+        writer = self._write(plc_id, register_type, timestamp, data)
+        if writer is not None:
+            writer.flush()
+
+    def append_many(self, samples):
+        for sample in samples:
+            try:
+                self._write(*sample)
+            except Exception as e:
+                logger.error(f"Error appending {sample[1]} for {sample[0]}: {e}")
+        self.flush()
+
+    def _writer(self, plc_id, register_type, addresses, typecode, timestamp):
+        """The segment a sample at ``timestamp`` goes to, rolling over when needed."""
+        key = (plc_id, register_type)
+        writer = self._writers.get(key)
+        if (writer is None or writer.addresses != addresses or writer.typecode != typecode
+                or timestamp >= self._period_ends[key] or writer.size >= self.max_bytes):
+            if writer is not None:
+                writer.close()
+            writer = _open_segment(plc_id, register_type, addresses, timestamp, self.data_dir,
+                                   reuse=writer is None, period=self.period, max_bytes=self.max_bytes,
+                                   typecode=typecode)
+            self._writers[key] = writer
+            self._period_ends[key] = period_end(writer.first_timestamp or timestamp, self.period)
+        return writer
+
+    def _write(self, plc_id, register_type, timestamp, data):
+        if not data:
+            return None
+        addresses = sorted(data)
+        values = [data[addr] for addr in addresses]
+        writer = self._writer(plc_id, register_type, addresses,
+                              sample_typecode(register_type, values), timestamp)
+        writer.append(timestamp, values)
+        return writer
+
+    def append_records(self, plc_id, register_type, addresses, records):
+        """Write records as-is; they already have the segment record layout."""
+        addresses = list(addresses)
+        typecode = records.dtype["values"].base.char
+        timestamps = records["ts"]
+        start = 0
+        while start < len(records):
+            writer = self._writer(plc_id, register_type, addresses, typecode, float(timestamps[start]))
+            # Stop at the end of the segment's period or size limit
+            end = int(timestamps.searchsorted(self._period_ends[(plc_id, register_type)]))
+            room = max(1, (self.max_bytes - writer.size) // writer.record_size)
+            end = min(max(end, start + 1), start + room)
+            writer.append_raw(records[start:end].tobytes(), end - start, float(timestamps[start]))
+            start = end
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+
+class ExcelStorage(StorageBackend):
+    """
+    Legacy backend: rewrites modbus_data/<plc>/<register_type>.xlsx per sample.
+    Each append loads and saves the whole workbook, so only use it for short runs.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+
+    def append(self, plc_id, register_type, timestamp, data):
+        from openpyxl import Workbook, load_workbook
+
+        if not data:
+            return
+        folder_path = os.path.join(self.data_dir, plc_id)
+        os.makedirs(folder_path, exist_ok=True)
+        file_path = os.path.join(folder_path, f"{register_type}.xlsx")
+
+        if os.path.exists(file_path):
+            wb = load_workbook(file_path)
+            ws = wb.active
+        else:
+            wb = Workbook()
+            ws = wb.active
+            ws.title = REGISTER_TYPES[register_type][1]
+            ws.append(["Date", "Time"] + [f"{addr:05}" for addr in sorted(data)])
+
+        dt = datetime.fromtimestamp(timestamp)
+        ws.append([dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S")]
+                  + [data[addr] for addr in sorted(data)])
+        wb.save(file_path)
+
+
+STORAGE_BACKENDS = {
+    "segment": SegmentStorage,
+    "excel": ExcelStorage,
+}
+
+_storage = None
+
+
+def get_storage():
+    """Return the process-wide storage backend (NODEPORT_STORAGE selects it)."""
+    global _storage
+    if _storage is None:
+        name = os.environ.get("NODEPORT_STORAGE", "segment")
+        _storage = STORAGE_BACKENDS[name]()
+    return _storage
+
+
+def set_storage(backend):
+    """Replace the process-wide storage backend, closing the previous one."""
+    global _storage
+    if _storage is not None:
+        _storage.close()
+    _storage = backend
+
+
+def export_xlsx(plc_id, register_type, out_path=None, data_dir=DATA_DIR):
+    """Write the recorded history of one register type to an XLSX file."""
+    from openpyxl import Workbook
+
+    if out_path is None:
+        out_path = os.path.join(data_dir, plc_id, "export", f"{register_type}.xlsx")
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    is_bit = REGISTER_TYPES[register_type][0] == "B"
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(REGISTER_TYPES[register_type][1])
+    header = None
+    for path in list_segments(plc_id, register_type, data_dir):
+        addresses, timestamps, rows = read_segment(path)
+        if addresses != header:
+            # Address lists change between segments; repeat the header row
+            ws.append(["Date", "Time"] + [f"{addr:05}" for addr in addresses])
+            header = addresses
+        for ts, row in zip(timestamps, rows):
+            dt = datetime.fromtimestamp(ts)
+            values = [bool(v) for v in row] if is_bit else row
+            ws.append([dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S")] + values)
+    wb.save(out_path)
+    return out_path
+
+
+if __name__ == "__main__":
+    # Usage: python storage.py PLC1 [PLC2 ...]  -> export recorded data to XLSX
+    for plc in sys.argv[1:]:
+        for reg_type in REGISTER_TYPES:
+            if list_segments(plc, reg_type):
+                print(export_xlsx(plc, reg_type))
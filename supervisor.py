@@ -0,0 +1,233 @@
+"""
+Process-sharded runner for large PLC fleets.
+
+The PLC list is split across N worker processes, each running the usual
+asyncio client loops for its share, so CPU work for one PLC no longer delays
+PLCs handled by other cores.  The supervisor restarts workers that die and
+collects their periodic status reports into one view.  Each report carries
+the worker's metrics snapshot; the supervisor serves them merged, with a
+"worker" label, on the metrics endpoint.
+
+Every worker follows the workbooks for the PLCs of its shard, so their edits
+apply without a restart.  The shards themselves are fixed at start: a PLC
+added later is only logged, and polled once the supervisor is restarted.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+from config_cache import CONFIG_CHECK_INTERVAL
+from connection import Backoff
+from metrics import merge_snapshots, start_metrics_server
+
+logger = logging.getLogger("ModbusClient")
+
+STATUS_INTERVAL = 5.0  # seconds between worker status reports
+SUMMARY_INTERVAL = 60.0  # seconds between supervisor summary log lines
+STABLE_RUNTIME = 60.0  # a worker alive this long gets its restart backoff reset
+
+
+def shard_plcs(plcs, workers):
+    """
+    Deal PLC rows round-robin into ``workers`` shards (empty shards dropped),
+    keeping the unit IDs behind one IP:port together so they share a connection.
+    """
+    endpoints = {}
+    for plc in plcs:
+        endpoints.setdefault((plc.get("IP Address"), plc.get("Port")), []).append(plc)
+    groups = list(endpoints.values())
+    shards = [[plc for group in groups[i::workers] for plc in group] for i in range(workers)]
+    return [shard for shard in shards if shard]
+
+
+def _worker_status(worker_id):
+    from ModBus import plc_schedules, plc_state
+    from metrics import registry
+    from write_behind import get_write_queue
+
+    return {
+        "worker": worker_id,
+        "pid": os.getpid(),
+        "time": time.time(),
+        "plcs": {plc_id: {**state, **(plc_schedules[plc_id].stats() if plc_id in plc_schedules else {})}
+                 for plc_id, state in plc_state.items()},
+        "queue": get_write_queue().stats(),
+        "metrics": registry.snapshot(),
+    }
+
+
+async def _report_status(worker_id, status_queue, stop_event, main_task):
+    while not stop_event.is_set():
+        try:
+            status_queue.put_nowait(_worker_status(worker_id))
+        except Exception as e:
+            logger.error(f"Worker {worker_id} could not report status: {e}")
+        await asyncio.sleep(STATUS_INTERVAL)
+    main_task.cancel()
+
+
+async def _run_worker(worker_id, plcs, status_queue, stop_event):
+    from main import run_client_loops
+
+    main_task = asyncio.ensure_future(run_client_loops(only={plc["PLC"] for plc in plcs}))
+    reporter = asyncio.ensure_future(_report_status(worker_id, status_queue, stop_event, main_task))
+    try:
+        await main_task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        reporter.cancel()
+
+
+def worker_main(worker_id, plcs, status_queue, stop_event):
+    """Entry point of a worker process."""
+    logger.info(f"Worker {worker_id} (pid {os.getpid()}) polling "
+                f"{', '.join(str(plc['PLC']) for plc in plcs)}")
+    try:
+        asyncio.run(_run_worker(worker_id, plcs, status_queue, stop_event))
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """Start, watch and restart the worker processes."""
+
+    def __init__(self, plcs, workers=None, metrics_port=0, load_plcs=None):
+        """``load_plcs()`` returns the configured rows, to notice PLCs added while running."""
+        workers = workers or os.cpu_count() or 1
+        self.metrics_port = metrics_port
+        self.shards = shard_plcs(plcs, workers)
+        self._ctx = multiprocessing.get_context("spawn")
+        self.status_queue = self._ctx.Queue()
+        self.stop_event = self._ctx.Event()
+        self.processes = {}
+        self.started_at = {}
+        self.restarts = {worker_id: 0 for worker_id in range(len(self.shards))}
+        self._backoff = {worker_id: Backoff(initial=1.0, maximum=60.0)
+                         for worker_id in range(len(self.shards))}
+        self._restart_at = {}
+        self.worker_status = {}
+        self._load_plcs = load_plcs
+        self._unsharded = set()
+
+    def _start(self, worker_id):
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(worker_id, self.shards[worker_id], self.status_queue, self.stop_event),
+            name=f"modbus-worker-{worker_id}",
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self.started_at[worker_id] = time.monotonic()
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for worker_id, process in self.processes.items():
+            if process.is_alive():
+                if now - self.started_at[worker_id] > STABLE_RUNTIME:
+                    self._backoff[worker_id].reset()
+                continue
+            if worker_id not in self._restart_at:
+                delay = self._backoff[worker_id].next_delay()
+                self._restart_at[worker_id] = now + delay
+                logger.error(f"Worker {worker_id} exited with code {process.exitcode}; "
+                             f"restarting in {delay:.1f}s")
+            elif now >= self._restart_at[worker_id]:
+                del self._restart_at[worker_id]
+                self.restarts[worker_id] += 1
+                self._start(worker_id)
+
+    def _check_config(self):
+        try:
+            plcs = self._load_plcs()
+        except Exception as e:
+            logger.error(f"Error reloading the configuration: {e}")
+            return
+        if not plcs:
+            return  # unreadable while being saved, most likely
+        sharded = {plc["PLC"] for shard in self.shards for plc in shard}
+        added = {plc["PLC"] for plc in plcs} - sharded
+        for plc_id in sorted(added - self._unsharded):
+            logger.warning(f"PLC {plc_id} added to the configuration; in worker mode it is "
+                           "polled only after the supervisor is restarted")
+        self._unsharded = added
+
+    def _drain_status(self):
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.worker_status[status["worker"]] = status
+
+    def status(self):
+        """Aggregated status of all workers and the PLCs they poll."""
+        plcs = {}
+        for status in self.worker_status.values():
+            for plc_id, state in status["plcs"].items():
+                plcs[plc_id] = {**state, "worker": status["worker"]}
+        return {
+            "workers": {
+                worker_id: {
+                    "pid": process.pid,
+                    "alive": process.is_alive(),
+                    "restarts": self.restarts[worker_id],
+                    "plcs": [plc["PLC"] for plc in self.shards[worker_id]],
+                    "queue": self.worker_status.get(worker_id, {}).get("queue"),
+                }
+                for worker_id, process in self.processes.items()
+            },
+            "plcs": plcs,
+        }
+
+    def metrics_snapshot(self):
+        """Metrics of every worker as of its last status report."""
+        return merge_snapshots({worker_id: status.get("metrics", {})
+                                for worker_id, status in list(self.worker_status.items())})
+
+    def _log_summary(self):
+        status = self.status()
+        alive = sum(worker["alive"] for worker in status["workers"].values())
+        connected = sum(bool(plc.get("connected")) for plc in status["plcs"].values())
+        missed = sum(plc.get("missed", 0) for plc in status["plcs"].values())
+        logger.info(f"Supervisor: {alive}/{len(self.processes)} workers alive, "
+                    f"{connected}/{sum(len(shard) for shard in self.shards)} PLCs connected, "
+                    f"{missed} missed deadlines, {sum(self.restarts.values())} worker restarts")
+
+    def run(self):
+        """Run until interrupted, then stop the workers so they flush their data."""
+        logger.info(f"Supervisor starting {len(self.shards)} workers")
+        for worker_id in range(len(self.shards)):
+            self._start(worker_id)
+        metrics_server = (start_metrics_server(self.metrics_port, self.metrics_snapshot)
+                          if self.metrics_port else None)
+        next_summary = time.monotonic() + SUMMARY_INTERVAL
+        next_config_check = time.monotonic() + CONFIG_CHECK_INTERVAL
+        try:
+            while True:
+                time.sleep(1.0)
+                self._drain_status()
+                self._check_workers()
+                if self._load_plcs is not None and time.monotonic() >= next_config_check:
+                    self._check_config()
+                    next_config_check += CONFIG_CHECK_INTERVAL
+                if time.monotonic() >= next_summary:
+                    self._log_summary()
+                    next_summary += SUMMARY_INTERVAL
+        except KeyboardInterrupt:
+            logger.info("Supervisor stopping workers")
+        finally:
+            if metrics_server is not None:
+                metrics_server.stop()
+            self.stop()
+
+    def stop(self, timeout=30.0):
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
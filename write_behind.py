@@ -0,0 +1,269 @@
+"""
+Write-behind queue between the polling loops and the storage backend.
+
+Each PLC and register type gets a preallocated ring of fixed-width records
+laid out like a segment record.  Polling coroutines copy a frame's values
+into the next slot without blocking or allocating; a dedicated writer thread
+periodically copies out everything pending in one step per ring and hands it
+to the backend, so slow disks never block the event loop.  When a ring is
+full the oldest (or, with the "drop_newest" policy, the incoming) sample is
+dropped and counted.
+"""
+import atexit
+import logging
+import threading
+import time
+
+import numpy as np
+
+from frame import record_dtype
+from metrics import registry
+from storage import get_storage
+
+logger = logging.getLogger("ModbusClient")
+
+DEFAULT_MAX_SIZE = 10_000  # samples buffered per PLC and register type
+DEFAULT_RING_BYTES = 8 * 1024 * 1024  # ... unless that would take more memory
+MIN_RING_SIZE = 64
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds
+DROP_LOG_INTERVAL = 10.0  # seconds between "dropping samples" warnings
+
+
+class RecordRing:
+    """Preallocated ring of records for one PLC, register type and address list."""
+
+    def __init__(self, plc_id, register_type, addresses, value_dtype, maxsize):
+        self.plc_id = plc_id
+        self.register_type = register_type
+        self.addresses = addresses
+        self.value_dtype = np.dtype(value_dtype)
+        self.dtype = record_dtype(value_dtype, len(addresses))
+        self.capacity = max(MIN_RING_SIZE, min(maxsize, DEFAULT_RING_BYTES // self.dtype.itemsize))
+        self._records = np.zeros(self.capacity, dtype=self.dtype)
+        self._timestamps = self._records["ts"]
+        self._values = self._records["values"]
+        self.head = 0  # samples put so far
+        self.tail = 0  # samples taken (or dropped) so far
+
+    @property
+    def pending(self):
+        return self.head - self.tail
+
+    def put(self, timestamp, values):
+        slot = self.head % self.capacity
+        self._timestamps[slot] = timestamp
+        self._values[slot] = values
+        self.head += 1
+
+    def take(self):
+        """Copy out every pending record, oldest first."""
+        start = self.tail % self.capacity
+        end = start + self.pending
+        if end <= self.capacity:
+            records = self._records[start:end].copy()
+        else:
+            records = np.concatenate((self._records[start:], self._records[:end - self.capacity]))
+        self.tail = self.head
+        return records
+
+
+class WriteBehindQueue:
+    """Bounded sample rings flushed to a storage backend by a writer thread."""
+
+    def __init__(self, backend=None, maxsize=DEFAULT_MAX_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, policy="drop_oldest"):
+        if policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.backend = backend if backend is not None else get_storage()
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+
+        self._rings = {}  # (plc_id, register_type) -> RecordRing
+        self._retired = []  # rings replaced after an address change, still to drain
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = None
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._last_drop_log = 0.0
+        self._flush_seconds = registry.histogram(
+            "storage_flush_seconds", "Time to write and flush one batch to storage").child()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def _ring(self, plc_id, register_type, addresses, values):
+        key = (plc_id, register_type)
+        ring = self._rings.get(key)
+        if ring is None or ring.addresses is not addresses or ring.value_dtype != values.dtype:
+            if ring is not None and ring.pending:
+                self._retired.append(ring)
+            ring = self._rings[key] = RecordRing(plc_id, register_type, addresses, values.dtype,
+                                                 self.maxsize)
+        return ring
+
+    def put(self, plc_id, register_type, timestamp, values, addresses):
+        """
+        Queue one sample without blocking; returns False if it was dropped.
+        ``values`` is copied, so the caller may overwrite it afterwards.
+        """
+        with self._cond:
+            if self._closing:
+                return False
+            ring = self._ring(plc_id, register_type, addresses, values)
+            if ring.pending >= ring.capacity:
+                self.dropped += 1
+                now = time.monotonic()
+                if now - self._last_drop_log >= DROP_LOG_INTERVAL:
+                    self._last_drop_log = now
+                    logger.warning(f"Storage queue full ({ring.capacity} samples for {plc_id} "
+                                   f"{register_type}); {self.dropped} samples dropped so far")
+                if self.policy == "drop_newest":
+                    return False
+                ring.tail += 1
+                self._pending -= 1
+            ring.put(timestamp, values)
+            self.enqueued += 1
+            self._pending += 1
+            self.max_depth = max(self.max_depth, self._pending)
+            if self._pending >= self.batch_size:
+                self._cond.notify()
+            return True
+
+    def _drain(self):
+        """Take every pending record; call with the lock held."""
+        batch = [(ring.plc_id, ring.register_type, ring.addresses, ring.take())
+                 for ring in self._retired + list(self._rings.values()) if ring.pending]
+        self._retired.clear()
+        self._pending = 0
+        return batch
+
+    def _take_batch(self):
+        with self._cond:
+            deadline = time.monotonic() + self.flush_interval
+            while not self._closing and self._pending < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._drain()
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        for plc_id, register_type, addresses, records in batch:
+            try:
+                self.backend.append_records(plc_id, register_type, addresses, records)
+            except Exception as e:
+                logger.error(f"Error writing {len(records)} {register_type} samples for {plc_id}: {e}")
+        try:
+            self.backend.flush()
+        except Exception as e:
+            logger.error(f"Error flushing storage: {e}")
+        elapsed = time.perf_counter() - start
+        elapsed_ms = elapsed * 1000
+        self._flush_seconds.observe(elapsed)
+        self.flushes += 1
+        self.written += sum(len(records) for *_, records in batch)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+            elif self._closing:
+                with self._cond:
+                    if not self._pending:
+                        return
+
+    def close(self, timeout=30.0):
+        """Stop accepting samples, flush everything queued and close the backend."""
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error(f"Storage writer did not finish; {self._pending} samples not written")
+        else:
+            with self._cond:
+                batch = self._drain()
+            if batch:
+                self._write(batch)
+        self.backend.close()
+
+    def depth_by_plc(self):
+        """Samples waiting to be written, per PLC."""
+        depth = {}
+        with self._cond:
+            for ring in self._retired + list(self._rings.values()):
+                depth[ring.plc_id] = depth.get(ring.plc_id, 0) + ring.pending
+        return depth
+
+    def stats(self):
+        return {
+            "depth": self._pending,
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+        }
+
+
+_write_queue = None
+_write_queue_lock = threading.Lock()
+
+
+def get_write_queue():
+    """Return the process-wide write-behind queue, starting it on first use."""
+    global _write_queue
+    with _write_queue_lock:
+        if _write_queue is None:
+            _write_queue = WriteBehindQueue().start()
+            atexit.register(_write_queue.close)
+        return _write_queue
+
+
+def _collect_metrics(registry):
+    queue = _write_queue
+    if queue is None:
+        return
+    depth = registry.gauge("queue_depth", "Samples waiting for the storage writer", ("plc",))
+    for plc_id, pending in queue.depth_by_plc().items():
+        depth.child(str(plc_id)).set(pending)
+    stats = queue.stats()
+    for name, help, key in (("samples_queued_total", "Samples handed to the storage writer", "enqueued"),
+                            ("samples_written_total", "Samples written to storage", "written"),
+                            ("samples_dropped_total", "Samples dropped with the queue full", "dropped")):
+        registry.counter(name, help).child().value = stats[key]
+
+
+registry.add_collector(_collect_metrics)
+
+
+def close_write_queue():
+    """Flush and stop the process-wide queue (safe to call more than once)."""
+    global _write_queue
+    with _write_queue_lock:
+        queue, _write_queue = _write_queue, None
+    if queue is not None:
+        queue.close()